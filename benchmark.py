@@ -0,0 +1,166 @@
+""" Benchmark the pipeline scripts on synthetic coupon data
+
+Each step runs a script as its own process in a work directory with
+synthetic coupon files from synthetic_coupons.py. Wall time, cpu time
+and peak memory (RSS) of the process are measured, with throughput as
+input lines and bytes per second. Results are written as JSON lines with
+the git commit, so runs on different commits can be compared with
+--compare.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from time import gmtime, strftime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+YEAR = 2011
+QUARTERS = [1, 2, 3, 4]
+
+def getSteps(numRows, seed):
+    """ Return (name, script, args, input files) of each benchmark step in order,
+    with paths relative to the work directory """
+    coupons = "data/{}_{{}}_Coupon.csv".format(YEAR)
+    paths = "data/{}_{{}}_Coupon_paths.net".format(YEAR)
+    states = "data/{}_{{}}_Coupon_paths_states_{{}}.net".format(YEAR)
+    steps = [
+        ("synthetic_coupons", "synthetic_coupons.py", ["-y", str(YEAR), "-q"] + list(map(str, QUARTERS)) + ["-n", str(numRows), "-s", str(seed)], []),
+        ("make_paths_memory", "make_paths.py", [coupons.format(1), "data/{}_1_memory_paths.net".format(YEAR), "--no-cache"], [coupons.format(1)]),
+    ]
+    for quarter in QUARTERS:
+        steps.append(("make_paths_numpy_q{}".format(quarter), "make_paths.py", [coupons.format(quarter), "-e", "numpy", "--no-cache"], [coupons.format(quarter)]))
+    for order in [1, 2, 3]:
+        steps.append(("paths_to_states_o{}".format(order), "paths_to_states.py",
+            [paths.format(1), "-y", str(YEAR), "-q", "1", "-o", str(order), "--no-cache"], [paths.format(1)]))
+    for quarter in QUARTERS[1:]:
+        steps.append(("paths_to_states_o2_q{}".format(quarter), "paths_to_states.py",
+            [paths.format(quarter), "-y", str(YEAR), "-q", str(quarter), "-o", "2", "--no-cache"], [paths.format(quarter)]))
+    steps += [
+        ("paths_to_paths", "paths_to_paths.py", [paths.format(1), "data/{}_1_filtered.net".format(YEAR), "-w", "2", "-s", "0.2"], [paths.format(1)]),
+        ("paths_to_paths_stream", "paths_to_paths.py", [paths.format(1), "data/{}_1_filtered_stream.net".format(YEAR), "-w", "2", "-s", "0.2", "--stream"], [paths.format(1)]),
+        ("paths_to_multilayer", "paths_to_multilayer.py", ["-y", str(YEAR)], [paths.format(quarter) for quarter in QUARTERS]),
+        ("states_to_multilayer_states", "states_to_multilayer_states.py",
+            [states.format(quarter, 2) for quarter in QUARTERS] + ["data/{}_1_2_3_4_states_2_r15.net".format(YEAR)],
+            [states.format(quarter, 2) for quarter in QUARTERS]),
+    ]
+    return steps
+
+def countLines(filenames):
+    """ Return (number of lines, number of bytes) of the files """
+    numLines, numBytes = 0, 0
+    for filename in filenames:
+        with open(filename, mode='rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                numLines += block.count(b"\n")
+                numBytes += len(block)
+    return numLines, numBytes
+
+def runStep(workDir, script, args, logFile):
+    """ Run a script as a child process, returns (exit code, wall time, rusage of the child).
+    The peak memory of the child includes the memory of this process when started,
+    so this module doesn't import numpy """
+    t1 = time.time()
+    process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, script)] + args, cwd=workDir,
+        stdout=logFile, stderr=subprocess.STDOUT)
+    # wait4 gives the resource usage of only this child
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, time.time() - t1, rusage
+
+def getCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(workDir, numRows, seed, outFilename):
+    t0 = time.time()
+    os.makedirs(os.path.join(workDir, "data"), exist_ok=True)
+    steps = getSteps(numRows, seed)
+    info = {
+        'commit': getCommit(),
+        'date': strftime("%Y-%m-%d %H:%M:%S", gmtime()),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'rows': numRows,
+        'seed': seed,
+    }
+    logFilename = os.path.join(workDir, "benchmark.log")
+    print("Run {} steps, logging output to {}...".format(len(steps), logFilename))
+    results = []
+    with open(logFilename, mode='w') as logFile, open(outFilename, mode='w') as outfile:
+        for name, script, args, inputs in steps:
+            logFile.write("\n==== {} ====\n".format(name))
+            logFile.flush()
+            numLines, numBytes = countLines([os.path.join(workDir, filename) for filename in inputs if os.path.exists(os.path.join(workDir, filename))])
+            exitCode, wallTime, rusage = runStep(workDir, script, args, logFile)
+            result = dict(info, **{
+                'name': name,
+                'command': " ".join([script] + args),
+                'exitCode': exitCode,
+                'wallTime': wallTime,
+                'cpuTime': rusage.ru_utime + rusage.ru_stime,
+                # ru_maxrss is in kilobytes on Linux
+                'maxMemory': rusage.ru_maxrss / 1e3,
+                'inputLines': numLines,
+                'inputBytes': numBytes,
+                'linesPerSecond': numLines / wallTime if wallTime > 0 else None,
+                'megabytesPerSecond': numBytes / 1e6 / wallTime if wallTime > 0 else None,
+            })
+            outfile.write(json.dumps(result) + "\n")
+            outfile.flush()
+            results.append(result)
+            print("  {:<30} {:>8.2f}s {:>10.1f} MB{}".format(name, wallTime, result['maxMemory'], "" if exitCode == 0 else " failed!"))
+    printReport(results)
+    print("Results written to {}".format(outFilename))
+    print("Wall time:        {}".format(time.time() - t0))
+    return all(result['exitCode'] == 0 for result in results)
+
+def printReport(results):
+    print("\n==== Report ====")
+    print("  {:<30} {:>10} {:>10} {:>10} {:>14}".format("step", "wall (s)", "cpu (s)", "max MB", "lines/s"))
+    for result in results:
+        print("  {:<30} {:>10.2f} {:>10.2f} {:>10.1f} {:>14.0f}{}".format(result['name'], result['wallTime'], result['cpuTime'],
+            result['maxMemory'], result['linesPerSecond'] or 0, "" if result['exitCode'] == 0 else " failed!"))
+
+def readResults(filename):
+    with open(filename, mode='r') as infile:
+        return {result['name']: result for result in map(json.loads, infile) if result}
+
+def compare(baseFilename, newFilename):
+    """ Print the wall time and memory of each step in newFilename relative to baseFilename """
+    base, new = readResults(baseFilename), readResults(newFilename)
+    print("Compare {} ({}) to {} ({})...".format(newFilename, next(iter(new.values()), {}).get('commit'),
+        baseFilename, next(iter(base.values()), {}).get('commit')))
+    print("  {:<30} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format("step", "base (s)", "new (s)", "ratio", "base MB", "new MB", "ratio"))
+    for name, result in new.items():
+        if name not in base:
+            continue
+        old = base[name]
+        print("  {:<30} {:>10.2f} {:>10.2f} {:>8.2f} {:>10.1f} {:>10.1f} {:>8.2f}".format(name, old['wallTime'], result['wallTime'],
+            result['wallTime'] / old['wallTime'], old['maxMemory'], result['maxMemory'], result['maxMemory'] / old['maxMemory']))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic data.')
+    parser.add_argument('-n', '--rows', type=int, default=100000, help='Approximate number of coupon rows per quarter (default: 100000)')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed for the synthetic data (default: 0)')
+    parser.add_argument('-d', '--work-dir', default='bench', help='Directory for the synthetic data and outputs (default: bench)')
+    parser.add_argument('-o', '--output', help='JSON lines file for the results (default: {work-dir}/results_{commit}.jsonl)')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='Compare two results files instead of running')
+
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    outFilename = args.output or os.path.join(args.work_dir, "results_{}.jsonl".format(getCommit() or "local"))
+    os.makedirs(args.work_dir, exist_ok=True)
+    if not run(args.work_dir, args.rows, args.seed, outFilename):
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
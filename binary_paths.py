@@ -0,0 +1,158 @@
+""" Binary paths format
+
+  magic         8 bytes, b'PATHSBIN'
+  headerLength  uint64, length of the json header
+  header        json with version, numPaths, numNodes, ids and the dtype
+                of each array, padded with spaces to a multiple of 8 bytes
+  nodes         uint16 or int32[numNodes], index in ids of each node of all paths
+  offsets       uint32 or int64[numPaths + 1], start of each path in nodes
+  weights       uint32 or int64[numPaths], weight of each path
+
+Each array is padded to a multiple of 8 bytes and uses the smallest of
+the two types that fits its values. All integers are little endian.
+The path at index i is
+ids[nodes[offsets[i]:offsets[i+1]]] with weight weights[i].
+"""
+
+import argparse
+import json
+import sys
+import time
+from array import array
+from collections import namedtuple
+import numpy as np
+
+import network_io
+
+MAGIC = b'PATHSBIN'
+VERSION = 1
+
+BinaryPaths = namedtuple('BinaryPaths', ['ids', 'nodes', 'offsets', 'weights'])
+
+def isBinaryPaths(filename):
+    with open(filename, mode='rb') as infile:
+        return infile.read(len(MAGIC)) == MAGIC
+
+def smallestDtype(maxValue, small, large):
+    return small if maxValue <= np.iinfo(small).max else large
+
+def writeBinaryPaths(filename, paths):
+    """ Write BinaryPaths to filename """
+    numPaths = len(paths.weights)
+    arrays = [
+        np.asarray(paths.nodes).astype(smallestDtype(len(paths.ids) - 1, '<u2', '<i4')),
+        np.asarray(paths.offsets).astype(smallestDtype(len(paths.nodes), '<u4', '<i8')),
+        np.asarray(paths.weights).astype(smallestDtype(max(paths.weights, default=0), '<u4', '<i8')),
+    ]
+    header = json.dumps({
+        'version': VERSION,
+        'numPaths': numPaths,
+        'numNodes': len(paths.nodes),
+        'nodesDtype': arrays[0].dtype.str,
+        'offsetsDtype': arrays[1].dtype.str,
+        'weightsDtype': arrays[2].dtype.str,
+        'ids': list(paths.ids),
+    }).encode()
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+    with open(filename, mode='wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(np.uint64(len(header)).astype('<u8').tobytes())
+        outfile.write(header)
+        for data in arrays:
+            outfile.write(data.tobytes())
+            outfile.write(b'\0' * (-data.nbytes % 8))
+
+def readBinaryPaths(filename):
+    """ Memory map the arrays of a binary paths file, returns BinaryPaths """
+    with open(filename, mode='rb') as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            sys.exit("Not a binary paths file: {}".format(filename))
+        headerLength = int(np.frombuffer(infile.read(8), dtype='<u8')[0])
+        header = json.loads(infile.read(headerLength).decode())
+    if header['version'] != VERSION:
+        sys.exit("Binary paths version {} not supported in {}".format(header['version'], filename))
+    numPaths, numNodes = header['numPaths'], header['numNodes']
+    offset = len(MAGIC) + 8 + headerLength
+    def memmap(dtype, shape):
+        nonlocal offset
+        if shape == 0:
+            return np.empty(0, dtype=dtype)
+        data = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(shape,))
+        offset += data.nbytes + (-data.nbytes % 8)
+        return data
+    nodes = memmap(header['nodesDtype'], numNodes)
+    offsets = memmap(header['offsetsDtype'], numPaths + 1)
+    weights = memmap(header['weightsDtype'], numPaths)
+    return BinaryPaths(header['ids'], nodes, offsets, weights)
+
+def ngramsToBinaryPaths(ngrams):
+    """ Encode a Counter of space separated paths to BinaryPaths """
+    idIndex = {}
+    nodes = array('i')
+    offsets = array('q', [0])
+    weights = array('q')
+    for ngram, weight in ngrams.items():
+        for node in ngram.split():
+            index = idIndex.get(node)
+            if index is None:
+                index = idIndex[node] = len(idIndex)
+            nodes.append(index)
+        offsets.append(len(nodes))
+        weights.append(weight)
+    return BinaryPaths(list(idIndex), np.frombuffer(nodes, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64), np.frombuffer(weights, dtype=np.int64))
+
+def readTextPathRows(filename):
+    """ Generate the split rows in the *paths section of a text paths file """
+    with open(filename, mode='r') as infile:
+        isPaths = False
+        for line in infile:
+            if line[0] == '*':
+                isPaths = line.startswith("*paths")
+                continue
+            if isPaths and line[0] != '#':
+                yield line.split()
+
+def iterBinaryPathRows(paths, batchSize=100000):
+    """ Generate each path in BinaryPaths as a list of ids followed by the weight """
+    ids = paths.ids
+    numPaths = len(paths.weights)
+    for batchStart in range(0, numPaths, batchSize):
+        batchEnd = min(batchStart + batchSize, numPaths)
+        offsets = paths.offsets[batchStart:batchEnd + 1].tolist()
+        nodes = paths.nodes[offsets[0]:offsets[-1]].tolist()
+        weights = paths.weights[batchStart:batchEnd].tolist()
+        nodeStart = offsets[0]
+        for i, weight in enumerate(weights):
+            path = [ids[node] for node in nodes[offsets[i] - nodeStart:offsets[i+1] - nodeStart]]
+            path.append(weight)
+            yield path
+
+def readPathRows(filename):
+    """ Generate each path in a text or binary paths file as a list of ids followed by the weight """
+    if isBinaryPaths(filename):
+        return iterBinaryPathRows(readBinaryPaths(filename))
+    return readTextPathRows(filename)
+
+
+def run(inFilename, outFilename):
+    t1 = time.time()
+    if isBinaryPaths(inFilename):
+        print("Converting binary paths {} to text paths {}...".format(inFilename, outFilename))
+        with open(outFilename, mode='w') as outfile:
+            outfile.write("*paths\n")
+            network_io.writeTextPaths(outfile, readBinaryPaths(inFilename))
+    else:
+        print("Converting text paths {} to binary paths {}...".format(inFilename, outFilename))
+        writeBinaryPaths(outFilename, network_io.readTextPaths(inFilename))
+    print("Done in {} seconds!".format(time.time() - t1))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Convert paths between text and binary format.')
+    parser.add_argument('input', help='input text or binary paths file')
+    parser.add_argument('output', help='output file in the other format')
+
+    args = parser.parse_args()
+    run(args.input, args.output)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,111 @@
+""" Columnar cache of parsed coupon csv files
+
+The columns of each parsed coupon file are saved as a structured .npy
+array in a .coupon_cache directory next to the csv file, named by the
+csv filename, size and modification time so a changed file never reads
+a stale entry. Entries are memory mapped when loaded. The least recently
+used entries are removed when a cache directory grows over its size limit.
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+
+CACHE_DIRNAME = ".coupon_cache"
+
+class CouponCache:
+    def __init__(self, maxSize=4000):
+        """ Cache using at most maxSize MB in each cache directory """
+        self.maxSize = int(maxSize * 1e6)
+
+    def getCacheDir(self, filename):
+        return os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIRNAME)
+
+    def getEntryPrefix(self, filename):
+        return os.path.join(self.getCacheDir(filename), os.path.basename(filename) + "_")
+
+    def getEntryFilename(self, filename):
+        stat = os.stat(filename)
+        return "{}{}_{}.npy".format(self.getEntryPrefix(filename), stat.st_size, stat.st_mtime_ns)
+
+    def has(self, filename):
+        return os.path.exists(self.getEntryFilename(filename))
+
+    def load(self, filename):
+        """ Return the memory mapped coupon array cached for filename, or None if not cached """
+        entryFilename = self.getEntryFilename(filename)
+        try:
+            coupons = np.load(entryFilename, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used
+        os.utime(entryFilename)
+        print("Loaded {} cached coupon rows for {}".format(len(coupons), filename))
+        return coupons
+
+    def save(self, filename, coupons):
+        """ Cache the coupon array parsed from filename, replacing entries of older versions of the file """
+        entryFilename = self.getEntryFilename(filename)
+        cacheDir = self.getCacheDir(filename)
+        os.makedirs(cacheDir, exist_ok=True)
+        prefix = os.path.basename(self.getEntryPrefix(filename))
+        for name in os.listdir(cacheDir):
+            if name.startswith(prefix) and name.endswith(".npy") and name[len(prefix):].count("_") == 1:
+                os.remove(os.path.join(cacheDir, name))
+        print("Caching {} coupon rows to {}...".format(len(coupons), entryFilename))
+        tmpFilename = entryFilename + ".tmp"
+        with open(tmpFilename, mode='wb') as outfile:
+            np.save(outfile, coupons)
+        os.replace(tmpFilename, entryFilename)
+        self.evict(cacheDir)
+
+    def evict(self, cacheDir):
+        """ Remove least recently used entries until the cache directory fits in its size limit """
+        entries = []
+        for name in os.listdir(cacheDir):
+            if name.endswith(".npy"):
+                stat = os.stat(os.path.join(cacheDir, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+            print("Evicting {} from cache...".format(name))
+            os.remove(os.path.join(cacheDir, name))
+            totalSize -= size
+
+def listEntries(directory):
+    """ Return (name, size) of each entry in the cache directory next to the csv files in directory """
+    cacheDir = os.path.join(directory, CACHE_DIRNAME)
+    if not os.path.isdir(cacheDir):
+        return []
+    return [(name, os.path.getsize(os.path.join(cacheDir, name))) for name in sorted(os.listdir(cacheDir))]
+
+def clear(directory):
+    """ Remove the cache directory next to the csv files in directory """
+    cacheDir = os.path.join(directory, CACHE_DIRNAME)
+    for name, _ in listEntries(directory):
+        os.remove(os.path.join(cacheDir, name))
+    if os.path.isdir(cacheDir):
+        os.rmdir(cacheDir)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='List or clear the cache of parsed coupon csv files.')
+    parser.add_argument('directory', nargs='*', default=['data'], help='directories with coupon csv files (default: data)')
+    parser.add_argument('--clear', action='store_true', help='Remove all cached coupon files in the directories')
+
+    args = parser.parse_args()
+    for directory in args.directory:
+        entries = listEntries(directory)
+        print("{}: {} entries, {:.1f} MB".format(os.path.join(directory, CACHE_DIRNAME), len(entries),
+            sum(size for _, size in entries) / 1e6))
+        for name, size in entries:
+            print("  {} {:.1f} MB".format(name, size / 1e6))
+        if args.clear:
+            clear(directory)
+            print("Cleared!")
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,187 @@
+""" Local SQLite store of DB1B coupon rows
+
+Coupon csv files are loaded once in batched transactions to a table with
+indexes on (Year, Quarter), ItinID, OriginAirportID, DestAirportID and
+FileID. Subsets of itineraries can then be queried by year, quarter and
+airport without reading the csv files again, see make_paths.py --source store.
+
+Rows are stored in the order of the csv files, so itineraries come out in
+order of first appearance as when parsing the csv file directly.
+"""
+
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import time
+from itertools import islice
+
+# Stored columns with their names in prezipped and selected downloads, see make_paths.py
+COLUMNS = [
+    ("Year", ("Year", "YEAR")),
+    ("Quarter", ("Quarter", "QUARTER")),
+    ("ItinID", ("ItinID", "ITIN_ID")),
+    ("MktID", ("MktID", "MKT_ID")),
+    ("SeqNum", ("SeqNum", "SEQ_NUM")),
+    ("OriginAirportID", ("OriginAirportID", "ORIGIN_AIRPORT_ID")),
+    ("DestAirportID", ("DestAirportID", "DEST_AIRPORT_ID")),
+]
+
+INDEXES = {
+    "coupons_year_quarter": "Year, Quarter",
+    "coupons_itin": "ItinID",
+    "coupons_origin": "OriginAirportID",
+    "coupons_dest": "DestAirportID",
+    "coupons_file": "FileID",
+}
+
+class CouponStore:
+    def __init__(self, dbFilename):
+        self.dbFilename = dbFilename
+        self.connection = sqlite3.connect(dbFilename)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                FileID INTEGER PRIMARY KEY,
+                Path TEXT NOT NULL UNIQUE,
+                Size INTEGER NOT NULL,
+                Mtime INTEGER NOT NULL,
+                NumRows INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS coupons (
+                FileID INTEGER NOT NULL,
+                {}
+            );
+        """.format(",\n                ".join("{} INTEGER NOT NULL".format(column) for column, _ in COLUMNS)))
+
+    def close(self):
+        self.connection.close()
+
+    def isLoaded(self, filename):
+        """ True if filename is loaded and unchanged since """
+        stat = os.stat(filename)
+        row = self.connection.execute("SELECT Size, Mtime FROM files WHERE Path = ?", (os.path.abspath(filename),)).fetchone()
+        return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns
+
+    def getQuarterFile(self, year, quarter, fileId):
+        """ Path of another file than fileId with coupons in year and quarter, or None """
+        row = self.connection.execute("""SELECT Path FROM files WHERE FileID = (
+            SELECT FileID FROM coupons WHERE Year = ? AND Quarter = ? AND FileID != ? LIMIT 1)""", (year, quarter, fileId)).fetchone()
+        return row[0] if row else None
+
+    def removeFile(self, fileId):
+        with self.connection:
+            self.connection.execute("DELETE FROM coupons WHERE FileID = ?", (fileId,))
+            self.connection.execute("DELETE FROM files WHERE FileID = ?", (fileId,))
+
+    def load(self, filename, batchSize=100000):
+        """ Load the coupon rows of a csv file, replacing earlier rows of the same file.
+        Exits without loading if another file has coupons of the same year and quarter """
+        if self.isLoaded(filename):
+            print("Already loaded {}".format(filename))
+            return
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        with open(filename, mode='r', newline='') as csvfile:
+            header = csvfile.readline()
+        dialect = csv.Sniffer().sniff(header)
+        fieldnames = next(csv.reader([header], dialect=dialect))
+        usecols = []
+        for column, names in COLUMNS:
+            found = [name for name in names if name in fieldnames]
+            if not found:
+                sys.exit("Column {} not found in {}".format(column, filename))
+            usecols.append(fieldnames.index(found[0]))
+
+        print("Load coupons from {} to {}...".format(filename, self.dbFilename))
+        # Fast bulk loading, a crash while loading may need the file to be loaded again
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("PRAGMA journal_mode = MEMORY")
+        with self.connection:
+            oldFile = self.connection.execute("SELECT FileID FROM files WHERE Path = ?", (path,)).fetchone()
+            if oldFile is not None:
+                print("Remove old rows of changed file...")
+                self.connection.execute("DELETE FROM coupons WHERE FileID = ?", oldFile)
+                self.connection.execute("DELETE FROM files WHERE FileID = ?", oldFile)
+            fileId = self.connection.execute("INSERT INTO files (Path, Size, Mtime, NumRows) VALUES (?, ?, ?, 0)",
+                (path, stat.st_size, stat.st_mtime_ns)).lastrowid
+
+        insert = "INSERT INTO coupons VALUES ({})".format(", ".join(["?"] * (len(COLUMNS) + 1)))
+        numRows = 0
+        quarters = set()
+        with open(filename, mode='r', newline='') as csvfile:
+            reader = csv.reader(csvfile, dialect=dialect)
+            next(reader)
+            while True:
+                batch = [(fileId, *[int(row[i]) for i in usecols]) for row in islice(reader, batchSize) if row]
+                if not batch:
+                    break
+                # Rows of a quarter in two files would join the coupons of the same itineraries
+                for year, quarter in set((row[1], row[2]) for row in batch) - quarters:
+                    otherPath = self.getQuarterFile(year, quarter, fileId)
+                    if otherPath is not None:
+                        self.removeFile(fileId)
+                        sys.exit("Coupons of {} Q{} in {} are already loaded from {}, load them to another store".format(
+                            year, quarter, filename, otherPath))
+                    quarters.add((year, quarter))
+                # One transaction per batch
+                with self.connection:
+                    self.connection.executemany(insert, batch)
+                numRows += len(batch)
+                print("Processed {} rows...".format(numRows))
+        with self.connection:
+            self.connection.execute("UPDATE files SET NumRows = ? WHERE FileID = ?", (numRows, fileId))
+        print("Done loading {} rows!".format(numRows))
+
+    def createIndexes(self):
+        for name, columns in INDEXES.items():
+            print("Create index on {}...".format(columns))
+            self.connection.execute("CREATE INDEX IF NOT EXISTS {} ON coupons ({})".format(name, columns))
+        self.connection.execute("ANALYZE")
+        self.connection.commit()
+
+    def queryCoupons(self, years, quarters, airports=None):
+        """ Generate (itinId, mktId, seqNum, sourceId, targetId) of the coupons in the selected
+        years and quarters, in stored order. With airports, only itineraries with some coupon
+        from or to one of the airports """
+        selection = "Year IN ({}) AND Quarter IN ({})".format(",".join("?" * len(years)), ",".join("?" * len(quarters)))
+        parameters = list(years) + list(quarters)
+        if airports:
+            airportList = ",".join("?" * len(airports))
+            selection = """ItinID IN (
+                SELECT ItinID FROM coupons WHERE OriginAirportID IN ({airports}) AND {selection}
+                UNION
+                SELECT ItinID FROM coupons WHERE DestAirportID IN ({airports}) AND {selection}
+            ) AND {selection}""".format(airports=airportList, selection=selection)
+            parameters = list(airports) + parameters + list(airports) + parameters + parameters
+        query = "SELECT ItinID, MktID, SeqNum, OriginAirportID, DestAirportID FROM coupons WHERE {} ORDER BY rowid".format(selection)
+        return self.connection.execute(query, parameters)
+
+    def summary(self):
+        """ Return a list of (year, quarter, number of rows) """
+        return self.connection.execute("SELECT Year, Quarter, COUNT(*) FROM coupons GROUP BY Year, Quarter ORDER BY Year, Quarter").fetchall()
+
+
+def run(dbFilename, inFilenames, batchSize=100000):
+    t1 = time.time()
+    store = CouponStore(dbFilename)
+    for inFilename in inFilenames:
+        store.load(inFilename, batchSize)
+    store.createIndexes()
+    print("Stored coupons:")
+    for year, quarter, numRows in store.summary():
+        print("  {} Q{}: {} rows".format(year, quarter, numRows))
+    store.close()
+    print("Done in {} seconds!".format(time.time() - t1))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Load coupon csv files to a SQLite store.')
+    parser.add_argument('db', help='SQLite database file, created if missing')
+    parser.add_argument('input', nargs='+', help='input coupon csv files')
+    parser.add_argument('--batch-size', type=int, default=100000, help='Number of rows to insert per transaction (default: 100000)')
+
+    args = parser.parse_args()
+    run(args.db, args.input, args.batch_size)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
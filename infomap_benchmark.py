@@ -0,0 +1,204 @@
+""" Benchmark Infomap on state networks
+
+Runs Infomap on each combination of network file and argument string as
+its own process, in a bounded pool with a timeout per run, each with its
+own output directory. Codelength, number of levels and elapsed time are
+parsed from the output of Infomap, and the number of modules, module
+perplexity and overlap from the .clu file with statistics.py. Results are
+written as a tab separated table with the columns of the tables in
+'Airline Infomap Time Complexity.ipynb', read with
+
+    pd.read_csv(filename, sep='\\t')
+
+Year, quarters, order and layers are taken from network filenames like
+data/2011_12_34_states_2_r0.25.net, written by pipeline.py.
+"""
+
+import argparse
+import csv
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from collections import Counter, namedtuple
+from multiprocessing.pool import ThreadPool
+
+import statistics
+
+Job = namedtuple('Job', ['name', 'network', 'args'])
+
+# Arguments of the runs in 'Airline Infomap Time Complexity.ipynb'
+DEFAULT_ARGS = "-i states -zd -N10"
+
+# Relax rate like _r0.15, or like _r15 in percent in older filenames
+NETWORK_NAME = re.compile(r"(\d{4})_([\d_]+)_states_(\d+)(?:_r(\d*\.\d+|\d+))?$")
+
+COLUMNS = ["Year", "Quarters", "Markov order", "Layers", "Relax rate", "Physical nodes", "State nodes", "Links",
+    "Modules", "Module perplexity", "Overlap", "Levels", "Codelength", "Seconds",
+    "Wall seconds", "Max memory", "Status", "Network", "Arguments"]
+
+def getNetworkName(filename):
+    return os.path.basename(filename).rsplit(".", maxsplit=1)[0]
+
+def getRelaxRate(text):
+    """ Relax rate from its text in a filename, 0.15 from 0.15 or from 15 percent """
+    return float(text) if "." in text else int(text) / 100
+
+def getNetworkInfo(filename):
+    """ Year, quarters like 1+2,3+4, order, layers and relax rate from the network filename """
+    match = NETWORK_NAME.match(getNetworkName(filename))
+    if not match:
+        return {}
+    year, groups, order, relaxRate = match.groups()
+    groups = groups.split("_")
+    return {
+        "Year": int(year),
+        "Quarters": ",".join("+".join(group) for group in groups),
+        "Markov order": int(order),
+        "Layers": len(groups),
+        "Relax rate": getRelaxRate(relaxRate) if relaxRate else "",
+    }
+
+def getNetworkSize(filename):
+    """ Number of physical nodes, state nodes and links in a states network file """
+    physIds = set()
+    numStates = 0
+    numLinks = 0
+    section = None
+    with open(filename, mode='r') as infile:
+        for line in infile:
+            if line[0] == '*':
+                section = line.split(maxsplit=1)[0].lower()
+                continue
+            if line[0] == '#' or not line.strip():
+                continue
+            if section == '*states':
+                numStates += 1
+                physIds.add(line.split(maxsplit=2)[1])
+            elif section == '*links':
+                numLinks += 1
+    return {"Physical nodes": len(physIds), "State nodes": numStates, "Links": numLinks}
+
+def parseOutput(text):
+    """ Codelength, number of levels and elapsed seconds from the output of Infomap """
+    result = {}
+    total = re.search(r"Per level codelength total:.*\(sum: ([\d.]+)\)", text)
+    codelengths = re.findall(r"[Cc]odelength[^\d\n]*([\d]+\.[\d]+)", text)
+    if total:
+        result["Codelength"] = float(total.group(1))
+    elif codelengths:
+        result["Codelength"] = float(codelengths[-1])
+    levels = re.findall(r"(\d+) levels", text)
+    if levels:
+        result["Levels"] = int(levels[-1])
+    elapsed = re.search(r"Elapsed time: (\d+)d (\d+)h (\d+)m ([\d.]+)s", text)
+    if elapsed:
+        days, hours, minutes, seconds = elapsed.groups()
+        result["Seconds"] = ((int(days) * 24 + int(hours)) * 60 + int(minutes)) * 60 + float(seconds)
+    return result
+
+def getJobs(networks, argsList):
+    """ One job per network and argument string, named by the network and the index of the arguments if many.
+    Networks with the same filename in different directories get the index of the network added,
+    as the name is the output directory of the job """
+    counts = Counter(getNetworkName(network) for network in networks)
+    jobs = []
+    for n, network in enumerate(networks):
+        networkName = getNetworkName(network)
+        if counts[networkName] > 1:
+            networkName = "{}_n{}".format(networkName, n + 1)
+        for i, args in enumerate(argsList):
+            name = networkName if len(argsList) == 1 else "{}_a{}".format(networkName, i + 1)
+            jobs.append(Job(name, network, args))
+    duplicates = [name for name, count in Counter(job.name for job in jobs).items() if count > 1]
+    if duplicates:
+        sys.exit("Jobs with the same output directory: {}".format(", ".join(duplicates)))
+    return jobs
+
+def runJob(job, infomap, outDir, timeout):
+    """ Run Infomap on the network of job, returns the results of the run """
+    jobDir = os.path.join(outDir, job.name)
+    os.makedirs(jobDir, exist_ok=True)
+    result = {"Network": job.network, "Arguments": job.args}
+    t1 = time.time()
+    with open(os.path.join(jobDir, "infomap.log"), mode='w') as logFile:
+        try:
+            process = subprocess.Popen([infomap, job.network, jobDir] + shlex.split(job.args), stdout=logFile, stderr=subprocess.STDOUT)
+        except OSError as err:
+            result["Status"] = "error: {}".format(err)
+            return result
+        # Poll to get the resource usage of only this child with a timeout
+        timedOut = False
+        while True:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if timeout and time.time() - t1 > timeout:
+                timedOut = True
+                process.kill()
+                _, status, rusage = os.wait4(process.pid, 0)
+                break
+            time.sleep(0.01)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    result["Wall seconds"] = time.time() - t1
+    # ru_maxrss is in kilobytes on Linux
+    result["Max memory"] = rusage.ru_maxrss / 1e3
+    if timedOut:
+        result["Status"] = "timeout"
+        return result
+    result["Status"] = "ok" if process.returncode == 0 else "exit code {}".format(process.returncode)
+    with open(logFile.name, mode='r') as infile:
+        result.update(parseOutput(infile.read()))
+    result.setdefault("Seconds", result["Wall seconds"])
+    cluFilename = os.path.join(jobDir, "{}.clu".format(getNetworkName(job.network)))
+    if os.path.exists(cluFilename):
+        stats = statistics.getStatistics(cluFilename)
+        result["Modules"] = stats['numModules']
+        result["Module perplexity"] = stats['perplexity']
+        result["Overlap"] = stats['numModuleAssignments']
+    return result
+
+def writeResults(results, filename):
+    print('Write results to "{}"...'.format(filename))
+    with open(filename, mode='w') as outfile:
+        writer = csv.DictWriter(outfile, delimiter='\t', fieldnames=COLUMNS, lineterminator='\n')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+def run(networks, argsList, infomap, outDir, outFilename, workers=1, timeout=None):
+    t1 = time.time()
+    jobs = getJobs(networks, argsList)
+    print("Collect sizes of {} networks...".format(len(networks)))
+    sizes = {network: getNetworkSize(network) for network in networks}
+    print("Run {} Infomap jobs with {} workers...".format(len(jobs), workers))
+    results = {}
+    with ThreadPool(workers) as pool:
+        for job, result in pool.imap_unordered(lambda job: (job, runJob(job, infomap, outDir, timeout)), jobs):
+            print("  {:<50} {:>10.2f}s  {}".format(job.name, result.get("Wall seconds", 0), result["Status"]))
+            results[job.name] = dict(getNetworkInfo(job.network), **sizes[job.network], **result)
+    writeResults([results[job.name] for job in jobs], outFilename)
+    print("Done in {} seconds!".format(time.time() - t1))
+    return all(result["Status"] == "ok" for result in results.values())
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark Infomap on state networks.')
+    parser.add_argument('network', nargs='+', help='input state network files')
+    parser.add_argument('-a', '--args', action='append', help='Infomap arguments, use multiple times to run each network with each (default: "-i states -zd -N10")')
+    parser.add_argument('--infomap', default='./Infomap', help='Infomap executable (default: ./Infomap)')
+    parser.add_argument('-d', '--out-dir', default='data/infomap', help='Directory for the output of each run (default: data/infomap)')
+    parser.add_argument('-o', '--output', default='data/infomap_benchmark.tsv', help='Results table (default: data/infomap_benchmark.tsv)')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='Number of Infomap runs at once (default: 1)')
+    parser.add_argument('-t', '--timeout', type=float, help='Kill runs after this many seconds (default: no timeout)')
+
+    args = parser.parse_args()
+    if shutil.which(args.infomap) is None:
+        sys.exit("Couldn't find {}, please symlink it like 'ln -s path/to/Infomap .'".format(args.infomap))
+    if not run(args.network, args.args or [DEFAULT_ARGS], args.infomap, args.out_dir, args.output, args.workers, args.timeout):
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
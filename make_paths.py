@@ -1,9 +1,18 @@
 import argparse
 import csv, json
 import sys, getopt
-import resource, time
+import io, os, tempfile, warnings, zipfile
 from time import gmtime, strftime
-from collections import Counter, defaultdict, namedtuple
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from contextlib import ExitStack
+from multiprocessing import Pool
+import numpy as np
+
+import binary_paths
+from coupon_cache import CouponCache
+import coupon_store
+import metrics
+import network_io
 
 Bigram = namedtuple('Bigram', ['sourceId', 'targetId', 'itinId', 'mktId', 'seqNum'])
 
@@ -42,17 +51,72 @@ def getName(filename):
 def isPrezipped(filename):
     return not getName(filename).endswith("_min")
 
-def parseCsv(filename):
-    print('Parse airline data from "{}"...'.format(filename))
-    print("Group bigrams by itinierary id...")
-    tripIdToBigrams = defaultdict(list)
+def isZip(filename):
+    return filename.lower().endswith(".zip")
+
+def openCsv(filename):
+    """ Open a csv file for reading text, or the csv file in a zip archive as
+    downloaded from BTS, decompressed while reading """
+    if not isZip(filename):
+        return open(filename, mode='r')
+    with zipfile.ZipFile(filename) as archive:
+        members = [name for name in archive.namelist() if name.lower().endswith(".csv")]
+        if not members:
+            sys.exit("No csv file in {}".format(filename))
+        # The opened member keeps the zip file open until closed
+        return io.TextIOWrapper(archive.open(members[0]))
+
+def readHeader(filename):
+    """ Return (dialect, fieldnames, dataStart) of the csv file, where dataStart is the byte offset of the first row """
+    with open(filename, mode='rb') as csvfile:
+        header = csvfile.readline()
+        dataStart = csvfile.tell()
+    header = header.decode()
+    dialect = csv.Sniffer().sniff(header)
+    return dialect, next(csv.reader([header], dialect=dialect)), dataStart
+
+class ByteRange(io.RawIOBase):
+    """ Raw reader of the bytes in range [start, end) of a file """
+
+    def __init__(self, filename, start, end):
+        self.file = open(filename, mode='rb', buffering=0)
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        numBytes = self.file.readinto(memoryview(buffer)[:size])
+        self.remaining -= numBytes
+        return numBytes
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+def openRange(filename, start, end):
+    """ Open the rows in byte range [start, end) of a csv file for reading text,
+    with start and end at the start of rows as from findChunkBoundaries """
+    return io.TextIOWrapper(io.BufferedReader(ByteRange(filename, start, end)))
+
+def readBigrams(filename, start=None, end=None):
+    """ Generate (rowNr, Bigram) for each coupon row in the csv file,
+    or for each row starting in byte range [start, end) """
     if not isPrezipped(filename):
         print("Use non-prezipped file format")
         useNonPrezippedFormat()
-    with open(filename, mode='r') as csvfile:
-        dialect = csv.Sniffer().sniff(csvfile.readline())
-        csvfile.seek(0)
-        reader = csv.DictReader(csvfile, dialect=dialect)
+    with ExitStack() as stack:
+        csvfile = stack.enter_context(openCsv(filename))
+        header = csvfile.readline()
+        dialect = csv.Sniffer().sniff(header)
+        fieldnames = next(csv.reader([header], dialect=dialect))
+        if start is not None:
+            csvfile = stack.enter_context(openRange(filename, start, end))
+        reader = csv.DictReader(csvfile, fieldnames=fieldnames, dialect=dialect)
         rowNr = 0
         for row in reader:
             rowNr += 1
@@ -63,33 +127,386 @@ def parseCsv(filename):
             sourceId = row[ORIGIN_AIRPORT_ID]
             targetId = row[DEST_AIRPORT_ID]
             # print("======", itinId, sourceId, targetId)
-            bigrams = tripIdToBigrams[itinId]
-            bigrams.append(Bigram(sourceId, targetId, itinId, mktId, seqNum))
-            # bigrams.append((sourceId, targetId, itinId, mktId, seqNum))
-            
+            yield rowNr, Bigram(sourceId, targetId, itinId, mktId, seqNum)
+
             if rowNr % 100000 == 0:
                 print("Processed {} rows...".format(rowNr))
+
+def checkBigrams(bigrams):
+    """ Sort the bigrams of one itinerary on sequence number, return an error message if not a connected path """
+    bigrams.sort(key=lambda tup: tup.seqNum)
+    # assert a correct sequence order
+    for n, bigram in enumerate(bigrams, start=1):
+        if n != bigram.seqNum:
+            return "Bigram {} has not correct seqNum in bigrams {}".format(bigram, bigrams)
+        # targetId of previous bigram should be sourceId for current bigram
+        if n > 1 and bigrams[n-2].targetId != bigrams[n-1].sourceId:
+            return "Bigram {} doesn't connect to previous bigrams {}".format(bigram, bigrams)
+    return None
+
+def bigramsToNgram(bigrams):
+    """ Join the bigrams of one itinerary to a path """
+    error = checkBigrams(bigrams)
+    if error:
+        sys.exit(error)
+    # Get all connected by using targetId of all bigrams and prepend sourceId of first
+    return "{} {}".format(bigrams[0].sourceId, " ".join([bigram.targetId for bigram in bigrams]))
+
+def parseCsv(filename, start=None, end=None):
+    """ Count ngrams from all rows, or the rows in byte range [start, end),
+    returns the itinerary ids """
+    print('Parse airline data from "{}"...'.format(filename))
+    return countBigrams(readBigrams(filename, start, end))
+
+def countBigrams(rows):
+    """ Count ngrams from (rowNr, Bigram) rows grouped in memory, returns the itinerary ids """
+    print("Group bigrams by itinierary id...")
+    tripIdToBigrams = defaultdict(list)
+    with metrics.stage("group") as stage:
+        for rowNr, bigram in rows:
+            tripIdToBigrams[bigram.itinId].append(bigram)
+        stage.rows = sum(map(len, tripIdToBigrams.values()))
     print("Done grouping bigrams to {} trips!".format(len(tripIdToBigrams)))
     print("Aggregate to unique ngrams...")
-    for bigrams in tripIdToBigrams.values():
-        # sort bigrams on sequence number
-        # bigrams.sort(key=lambda tup: tup[4])  # sorts in place by seqNum
-        bigrams.sort(key=lambda tup: tup.seqNum)
-        # assert a correct sequence order
-        for n, bigram in enumerate(bigrams, start=1):
-            # if n != bigram[4]:
-            if n != bigram.seqNum:
-                sys.exit("Bigram {} has not correct seqNum in bigrams {}".format(bigram, bigrams))
-            # targetId of previous bigram should be sourceId for current bigram
-            # if n > 1 and bigrams[n-2][1] != bigrams[n-1][0]:
-            if n > 1 and bigrams[n-2].targetId != bigrams[n-1].sourceId:
-                sys.exit("Bigram {} doesn't connect to previous bigrams {}".format(bigram, bigrams))
-        # Get all connected by using targetId of all bigrams and prepend sourceId of first
-        ngrams["{} {}".format(bigrams[0].sourceId, " ".join([bigram.targetId for bigram in bigrams]))] += 1
-        # ngrams["{} {}".format(bigrams[0][0], " ".join([bigram[1] for bigram in bigrams]))] += 1
+    with metrics.stage("aggregate", rows=len(tripIdToBigrams)):
+        for bigrams in tripIdToBigrams.values():
+            ngrams[bigramsToNgram(bigrams)] += 1
+    print("Done ")
+    return tripIdToBigrams.keys()
+
+
+class BloomFilter:
+    """ Fixed size set of keys that may answer false positives but never false negatives """
+
+    def __init__(self, numBytes, numHashes=3):
+        self.numBits = max(8, int(numBytes) * 8)
+        self.numHashes = numHashes
+        self.bits = bytearray(self.numBits // 8)
+
+    def _positions(self, key):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + i * h2) % self.numBits for i in range(self.numHashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+# Streaming mode, see parseCsvStreaming
+ngramFirstRow = {}
+# Partitions per spill level, a power of two as each level uses the next bits of the hash
+SPILL_FANOUT_BITS = 4
+SPILL_FANOUT = 1 << SPILL_FANOUT_BITS
+SPILL_MAX_DEPTH = 3
+# Approximate bytes in memory per byte of spilled row data when grouped
+SPILL_EXPANSION = 20
+
+def countNgram(ngram, firstRowNr):
+    ngrams[ngram] += 1
+    if firstRowNr < ngramFirstRow.get(ngram, firstRowNr + 1):
+        ngramFirstRow[ngram] = firstRowNr
+
+def streamGroups(readRows, window, seen, suspects, spillFile):
+    """ Group rows on itinerary id in a window of the most recently used itineraries
+    and count the ngram of each itinerary as it leaves the window.
+
+    First pass (spillFile is None): itineraries seen again after leaving the window,
+    or leaving it with a broken sequence, are added to the suspects filter and
+    counting stops, returns True if any found.
+    Second pass: rows of suspected itineraries are written to spillFile instead.
+    """
+    openGroups = OrderedDict()
+    hasSuspects = False
+    for rowNr, bigram in readRows():
+        itinId = bigram.itinId
+        group = openGroups.get(itinId)
+        if group is not None:
+            group[1].append(bigram)
+            openGroups.move_to_end(itinId)
+            continue
+        if spillFile is not None:
+            if itinId in suspects:
+                spillFile.write("{} {} {} {} {} {}\n".format(rowNr, itinId, bigram.mktId, bigram.seqNum, bigram.sourceId, bigram.targetId))
+                continue
+        elif itinId in seen:
+            if not hasSuspects:
+                print("Itinerary {} on row {} is not clustered, collecting out-of-order itineraries...".format(itinId, rowNr))
+            suspects.add(itinId)
+            hasSuspects = True
+        else:
+            seen.add(itinId)
+        openGroups[itinId] = (rowNr, [bigram])
+        if len(openGroups) > window:
+            evictedId, (firstRowNr, bigrams) = openGroups.popitem(last=False)
+            if spillFile is None and checkBigrams(bigrams):
+                # May continue later in the file, let the second pass decide
+                suspects.add(evictedId)
+                hasSuspects = True
+            if not hasSuspects:
+                countNgram(bigramsToNgram(bigrams), firstRowNr)
+    if not hasSuspects:
+        for firstRowNr, bigrams in openGroups.values():
+            countNgram(bigramsToNgram(bigrams), firstRowNr)
+    return hasSuspects
+
+def aggregateSpill(filename, budgetBytes, depth=0):
+    """ Count ngrams from spilled rows, partition on itinerary id until it fits in memory """
+    if os.path.getsize(filename) * SPILL_EXPANSION <= budgetBytes or depth >= SPILL_MAX_DEPTH:
+        groups = {}
+        with open(filename, mode='r') as spillFile:
+            for line in spillFile:
+                rowNr, itinId, mktId, seqNum, sourceId, targetId = line.split()
+                group = groups.get(itinId)
+                if group is None:
+                    group = groups[itinId] = (int(rowNr), [])
+                group[1].append(Bigram(sourceId, targetId, itinId, mktId, int(seqNum)))
+        for firstRowNr, bigrams in groups.values():
+            countNgram(bigramsToNgram(bigrams), firstRowNr)
+        os.remove(filename)
+        return
+    if depth == 0:
+        print("Partition spilled rows in {} files...".format(SPILL_FANOUT))
+    partitionNames = ["{}_{}".format(filename, i) for i in range(SPILL_FANOUT)]
+    partitions = [open(name, mode='w') for name in partitionNames]
+    with open(filename, mode='r') as spillFile:
+        for line in spillFile:
+            itinId = line.split(maxsplit=2)[1]
+            partitions[(hash(itinId) >> (depth * SPILL_FANOUT_BITS)) & (SPILL_FANOUT - 1)].write(line)
+    for partition in partitions:
+        partition.close()
+    os.remove(filename)
+    for name in partitionNames:
+        if os.path.getsize(name) > 0:
+            aggregateSpill(name, budgetBytes, depth + 1)
+        else:
+            os.remove(name)
+
+def readStoreBigrams(dbFilename, years, quarters, airports=None):
+    """ Generate (rowNr, Bigram) for each coupon row selected from a coupon store, see coupon_store.py """
+    store = coupon_store.CouponStore(dbFilename)
+    try:
+        rowNr = 0
+        for itinId, mktId, seqNum, sourceId, targetId in store.queryCoupons(years, quarters, airports):
+            rowNr += 1
+            yield rowNr, Bigram(str(sourceId), str(targetId), str(itinId), str(mktId), seqNum)
+
+            if rowNr % 100000 == 0:
+                print("Processed {} rows...".format(rowNr))
+    finally:
+        store.close()
+
+def parseStore(dbFilename, years, quarters, airports=None):
+    """ Count ngrams of the itineraries in years and quarters from a coupon store,
+    only those through some of airports if given """
+    print('Query airline data from "{}" for years {}, quarters {}{}...'.format(dbFilename, years, quarters,
+        ", airports {}".format(airports) if airports else ""))
+    countBigrams(readStoreBigrams(dbFilename, years, quarters, airports))
+    return ngrams
+
+def getStoreOutputFilename(dbFilename, years, quarters, airports=None, binary=False):
+    selection = "_".join(["-".join(map(str, years)), "".join(map(str, quarters))] + (["-".join(map(str, airports))] if airports else []))
+    return "{}_{}_paths.{}".format(getName(dbFilename), selection, "bin" if binary else "net")
+
+
+def parseCsvStreaming(filename, memoryBudget=512, window=1000, spillDir=None, coupons=None):
+    """ Count ngrams without holding all rows in memory.
+
+    Rows are grouped in a window of open itineraries, relying on the coupon files
+    being mostly clustered by itinerary id. If some itinerary is found again after
+    leaving the window, the file is read a second time where rows of such
+    itineraries are spilled to disk and grouped separately. The ngrams get the same
+    order as in parseCsv by sorting on the first row of their first itinerary.
+    memoryBudget is in MB. Rows are read from the cached coupons array instead if given.
+    """
+    print('Stream airline data from "{}" with a memory budget of {} MB...'.format(filename, memoryBudget))
+    if coupons is None:
+        readRows = lambda: readBigrams(filename)
+    else:
+        readRows = lambda: iterCouponBigrams(coupons)
+    budgetBytes = memoryBudget * 1e6
+    seen = BloomFilter(budgetBytes / 4)
+    suspects = BloomFilter(budgetBytes / 16)
+    if streamGroups(readRows, window, seen, suspects, None):
+        del seen
+        ngrams.clear()
+        ngramFirstRow.clear()
+        print("Stream again and spill out-of-order itineraries to disk...")
+        with tempfile.TemporaryDirectory(prefix="make_paths_", dir=spillDir) as tmpDir:
+            spillFilename = os.path.join(tmpDir, "spill")
+            with open(spillFilename, mode='w') as spillFile:
+                streamGroups(readRows, window, None, suspects, spillFile)
+            print("Aggregate spilled rows...")
+            aggregateSpill(spillFilename, budgetBytes)
+    print("Sort {} unique ngrams on first appearance...".format(len(ngrams)))
+    ordered = sorted(ngrams.items(), key=lambda item: ngramFirstRow[item[0]])
+    ngrams.clear()
+    ngramFirstRow.clear()
+    for ngram, count in ordered:
+        ngrams[ngram] = count
     print("Done ")
 
 
+# Numpy engine, see parseCsvNumpy
+COUPON_DTYPE = [('itinId', 'i8'), ('seqNum', 'i4'), ('sourceId', 'i4'), ('targetId', 'i4')]
+# All columns used by the engines, cached by the first parse of a file, see coupon_cache.py
+CACHE_DTYPE = [('itinId', 'i8'), ('mktId', 'i8'), ('seqNum', 'i4'), ('sourceId', 'i4'), ('targetId', 'i4')]
+
+def getFieldColumns():
+    return {'itinId': ITIN_ID, 'mktId': MKT_ID, 'seqNum': SEQ_NUM, 'sourceId': ORIGIN_AIRPORT_ID, 'targetId': DEST_AIRPORT_ID}
+
+def readCouponArrays(filename, chunkSize=1000000, start=None, end=None, dtype=COUPON_DTYPE):
+    """ Read itinerary id, sequence number, origin and destination airport id
+    of each coupon row, or each row starting in byte range [start, end),
+    to a structured array with COUPON_DTYPE, or the columns in dtype """
+    if not isPrezipped(filename):
+        print("Use non-prezipped file format")
+        useNonPrezippedFormat()
+    with ExitStack() as stack:
+        csvfile = stack.enter_context(openCsv(filename))
+        header = csvfile.readline()
+        dialect = csv.Sniffer().sniff(header)
+        fieldnames = next(csv.reader([header], dialect=dialect))
+        if start is not None:
+            csvfile = stack.enter_context(openRange(filename, start, end))
+        fieldColumns = getFieldColumns()
+        usecols = [fieldnames.index(fieldColumns[field]) for field, _ in dtype]
+        chunks = []
+        numRows = 0
+        with warnings.catch_warnings():
+            # loadtxt warns on the empty chunk at end of file
+            warnings.simplefilter("ignore", UserWarning)
+            while True:
+                chunk = np.loadtxt(csvfile, delimiter=dialect.delimiter, quotechar=dialect.quotechar,
+                    usecols=usecols, dtype=dtype, max_rows=chunkSize, ndmin=1)
+                if chunk.size == 0:
+                    break
+                chunks.append(chunk)
+                numRows += chunk.size
+                print("Processed {} rows...".format(numRows))
+    if not chunks:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(chunks)
+
+def iterCouponBigrams(coupons, batchSize=100000):
+    """ Generate (rowNr, Bigram) for each row of a coupon array with CACHE_DTYPE, like readBigrams """
+    rowNr = 0
+    for batchStart in range(0, len(coupons), batchSize):
+        batch = coupons[batchStart:batchStart + batchSize]
+        for itinId, mktId, seqNum, sourceId, targetId in zip(batch['itinId'].tolist(), batch['mktId'].tolist(),
+            batch['seqNum'].tolist(), batch['sourceId'].tolist(), batch['targetId'].tolist()):
+            rowNr += 1
+            yield rowNr, Bigram(str(sourceId), str(targetId), str(itinId), str(mktId), seqNum)
+        print("Processed {} rows...".format(rowNr))
+
+def readCachedCoupons(filename, cache, engine):
+    """ Return the coupon array of filename from the cache, or parse and cache it.
+    Returns None for the stream engine if not cached, as it would need all rows in memory """
+    coupons = cache.load(filename)
+    if coupons is not None or engine == 'stream':
+        return coupons
+    print('Parse airline data from "{}" to cache...'.format(filename))
+    try:
+        with metrics.stage("parse", filename=filename) as stage:
+            coupons = readCouponArrays(filename, dtype=CACHE_DTYPE)
+            stage.rows = len(coupons)
+    except ValueError as err:
+        print("Could not parse {} to integer columns, skip cache: {}".format(filename, err))
+        return None
+    cache.save(filename, coupons)
+    return coupons
+
+def encodePaths(paths, numBits):
+    """ Encode each row of a 2d array of small integers to one comparable value """
+    if paths.shape[1] * numBits <= 63:
+        keys = np.zeros(paths.shape[0], dtype=np.int64)
+        for column in paths.T:
+            keys = (keys << numBits) | column
+        return keys
+    paths = np.ascontiguousarray(paths)
+    return paths.view(np.dtype((np.void, paths.dtype.itemsize * paths.shape[1]))).ravel()
+
+def countCouponArrays(coupons):
+    """ Group coupon rows on itinerary id and count unique paths with array operations.
+    Returns a list of (paths, counts, firstRows) per path length, where paths is a
+    2d array of airport ids and firstRows the first row of the first itinerary of
+    each unique path """
+    numRows = coupons.size
+    if numRows == 0:
+        return []
+    print("Sort {} rows on itinerary and sequence number...".format(numRows))
+    order = np.lexsort((coupons['seqNum'], coupons['itinId']))
+    itinIds = coupons['itinId'][order]
+    seqNums = coupons['seqNum'][order]
+    sourceIds = coupons['sourceId'][order]
+    targetIds = coupons['targetId'][order]
+
+    isStart = np.empty(numRows, dtype=bool)
+    isStart[0] = True
+    np.not_equal(itinIds[1:], itinIds[:-1], out=isStart[1:])
+    starts = np.flatnonzero(isStart)
+    groupIndex = np.cumsum(isStart) - 1
+    lengths = np.diff(np.append(starts, numRows))
+    print("Done grouping bigrams to {} trips!".format(starts.size))
+
+    # assert a correct sequence order
+    bad = np.flatnonzero(seqNums != np.arange(numRows) - starts[groupIndex] + 1)
+    if bad.size > 0:
+        i = bad[0]
+        sys.exit("Itinerary {} has not correct seqNum {} at position {}".format(itinIds[i], seqNums[i], i - starts[groupIndex[i]] + 1))
+    # targetId of previous bigram should be sourceId for current bigram
+    broken = np.flatnonzero(~isStart[1:] & (sourceIds[1:] != targetIds[:-1])) + 1
+    if broken.size > 0:
+        i = broken[0]
+        sys.exit("Itinerary {} doesn't connect at seqNum {}".format(itinIds[i], seqNums[i]))
+
+    print("Aggregate to unique ngrams...")
+    # Path of each itinerary as the source of the first bigram followed by all targets
+    nodeStarts = starts + np.arange(starts.size)
+    nodes = np.empty(numRows + starts.size, dtype=np.int32)
+    nodes[nodeStarts] = sourceIds[starts]
+    nodes[np.arange(numRows) + groupIndex + 1] = targetIds
+    airports, nodeCodes = np.unique(nodes, return_inverse=True)
+    numBits = max(1, int(len(airports) - 1).bit_length())
+
+    # Visit itineraries in order of first appearance
+    firstRows = np.minimum.reduceat(order, starts)
+    byFirstRow = np.argsort(firstRows, kind='stable')
+    blocks = []
+    for length in np.unique(lengths):
+        groups = byFirstRow[lengths[byFirstRow] == length]
+        codes = nodeCodes.ravel()[nodeStarts[groups, None] + np.arange(length + 1)]
+        _, firstIndex, counts = np.unique(encodePaths(codes, numBits), return_index=True, return_counts=True)
+        blocks.append((airports[codes[firstIndex]], counts, firstRows[groups[firstIndex]]))
+    return blocks
+
+def countBlocksToNgrams(blocks):
+    """ Add path counts from countCouponArrays to ngrams in order of first appearance """
+    if not blocks:
+        return
+    paths = []
+    for block in blocks:
+        paths.extend(" ".join(map(str, path)) for path in block[0].tolist())
+    counts = np.concatenate([block[1] for block in blocks]).tolist()
+    firstRows = np.concatenate([block[2] for block in blocks])
+    for i in np.argsort(firstRows, kind='stable').tolist():
+        ngrams[paths[i]] += counts[i]
+
+def parseCsvNumpy(filename, coupons=None):
+    if coupons is None:
+        print('Parse airline data from "{}" to arrays...'.format(filename))
+        with metrics.stage("parse", filename=filename) as stage:
+            coupons = readCouponArrays(filename)
+            stage.rows = len(coupons)
+    with metrics.stage("group", rows=len(coupons)):
+        blocks = countCouponArrays(coupons)
+    with metrics.stage("aggregate", rows=sum(len(block[1]) for block in blocks)):
+        countBlocksToNgrams(blocks)
+    print("Done ")
+
 
 def writeCsv(docs, filename, fieldnames):
     print('Write to "{}"...'.format(filename))
@@ -100,35 +517,164 @@ def writeCsv(docs, filename, fieldnames):
             writer.writerow(doc)
 
 
-def run(filename, outputFilename):
+# Parallel parsing of one file, see parseCsvParallel
+def findChunkBoundaries(filename, numChunks):
+    """ Split the rows of the csv file in about numChunks byte ranges,
+    with each boundary moved forward to the next change of itinerary id.
+    Returns a list of (start, end) """
+    dialect, fieldnames, dataStart = readHeader(filename)
+    itinColumn = fieldnames.index(ITIN_ID)
+    def getItinId(line):
+        return next(csv.reader([line.decode()], dialect=dialect))[itinColumn]
+    size = os.path.getsize(filename)
+    boundaries = [dataStart]
+    with open(filename, mode='rb') as infile:
+        for i in range(1, numChunks):
+            target = dataStart + (size - dataStart) * i // numChunks
+            if target <= boundaries[-1]:
+                continue
+            # Start from the first complete line after target
+            infile.seek(target - 1)
+            infile.readline()
+            line = infile.readline()
+            if not line:
+                break
+            itinId = getItinId(line)
+            while True:
+                pos = infile.tell()
+                line = infile.readline()
+                if not line:
+                    pos = size
+                    break
+                if getItinId(line) != itinId:
+                    break
+            if pos >= size:
+                break
+            boundaries.append(pos)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def parseRange(task):
+    """ Worker, count ngrams in a byte range of the file.
+    Returns (ngrams, sorted unique itinerary ids), or None if some itinerary
+    is broken as it may continue in another range """
+    filename, start, end, engine = task
+    ngrams.clear()
+    try:
+        if engine == 'numpy':
+            coupons = readCouponArrays(filename, start=start, end=end)
+            countBlocksToNgrams(countCouponArrays(coupons))
+            itinIds = np.unique(coupons['itinId'])
+        else:
+            itinIds = np.unique(np.array([int(itinId) for itinId in parseCsv(filename, start, end)], dtype=np.int64))
+    except SystemExit:
+        return None
+    return Counter(ngrams), itinIds
+
+def parseCsvParallel(filename, workers, engine='memory'):
+    """ Count ngrams in byte ranges of the file in parallel and reduce the results.
+    Falls back to parse the file serially if some itinerary is not contained in one range """
+    if isZip(filename):
+        print("Can't split a zip archive in byte ranges, parse serially...")
+        return parse(filename, engine)
+    ranges = findChunkBoundaries(filename, workers)
+    print('Parse airline data from "{}" in {} chunks with {} workers...'.format(filename, len(ranges), workers))
+    with metrics.stage("parse", filename=filename, workers=workers), Pool(workers) as pool:
+        results = pool.map(parseRange, [(filename, start, end, engine) for start, end in ranges])
+    if None in results or np.unique(np.concatenate([result[1] for result in results])).size != sum(result[1].size for result in results):
+        print("Itineraries found in more than one chunk, parse serially...")
+        del results
+        return parse(filename, engine)
+    print("Reduce ngrams from {} chunks...".format(len(results)))
+    ngrams.clear()
+    with metrics.stage("aggregate", rows=sum(len(chunkNgrams) for chunkNgrams, _ in results)):
+        for chunkNgrams, _ in results:
+            ngrams.update(chunkNgrams)
+    print("Done ")
+    return ngrams
+
+def getOutputFilename(filename, binary=False):
+    return "{}_paths.{}".format(getName(filename), "bin" if binary else "net")
+
+def parse(filename, engine='memory', memoryBudget=512, window=1000, spillDir=None, cache=None):
+    """ Count ngrams from filename to the global ngrams with selected engine,
+    reading the columns from the CouponCache cache if given """
+    coupons = readCachedCoupons(filename, cache, engine) if cache is not None else None
+    if engine == 'stream':
+        with metrics.stage("stream", filename=filename):
+            parseCsvStreaming(filename, memoryBudget, window, spillDir, coupons)
+    elif engine == 'numpy':
+        parseCsvNumpy(filename, coupons)
+    elif coupons is not None:
+        countBigrams(iterCouponBigrams(coupons))
+    else:
+        parseCsv(filename)
+    return ngrams
+
+def writePaths(ngrams, outputFilename, binary=False):
+    with metrics.stage("write", filename=outputFilename, rows=len(ngrams)):
+        if binary:
+            print("Writing binary paths to {}...".format(outputFilename))
+            binary_paths.writeBinaryPaths(outputFilename, binary_paths.ngramsToBinaryPaths(ngrams))
+            print("Done!")
+            return
+        print("Writing paths to {}...".format(outputFilename))
+        with open(outputFilename, mode='w') as outfile:
+            outfile.write("*paths\n")
+            network_io.writeRows(outfile, "%s %s\n", [list(ngrams.keys()), list(ngrams.values())])
+        print("Done!")
+
+
+def run(filename, outputFilename, engine='memory', memoryBudget=512, window=1000, spillDir=None, workers=1, binary=False,
+    source='csv', years=None, quarters=None, airports=None, cache=None):
     print('\n==== Starting ==== \n')
-    t0, t1 = time.clock(), time.time()
-    parseCsv(filename)
+    if source == 'store':
+        parseStore(filename, years, quarters, airports)
+    elif workers > 1 and not isZip(filename) and (cache is None or not cache.has(filename)):
+        parseCsvParallel(filename, workers, engine)
+    else:
+        parse(filename, engine, memoryBudget, window, spillDir, cache)
     print('Done!')
-    print("Max memory usage: {} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6))
-    print("Clock time:       {}".format(time.clock() - t0))
-    print("Wall time:        {}".format(time.time() - t1))
-    print("User mode time:   {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_utime))
-    print("System time:      {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_stime))
-    print('\n== Finished at', strftime("%Y-%m-%d %H:%M:%S", gmtime()), '== \n')
     if not outputFilename:
-        outputFilename = "{}_paths.net".format(getName(filename))
-    print("Writing paths to {}...".format(outputFilename))
-    with open(outputFilename, mode='w') as outfile:
-        outfile.write("*paths\n")
-        for ngram in ngrams:
-            outfile.write("{} {}\n".format(ngram, ngrams[ngram]))
-    print("Done!")
-    
+        if source == 'store':
+            outputFilename = getStoreOutputFilename(filename, years, quarters, airports, binary)
+        else:
+            outputFilename = getOutputFilename(filename, binary)
+    writePaths(ngrams, outputFilename, binary)
+    metrics.printSummary()
+    print('\n== Finished at', strftime("%Y-%m-%d %H:%M:%S", gmtime()), '== \n')
 
 
 def main(argv):
     parser = argparse.ArgumentParser(description='Make paths from csv data.')
-    parser.add_argument('input', help='input csv file')
+    parser.add_argument('input', help='input csv file or zip archive with a csv file, or SQLite file with --source store')
     parser.add_argument('output', nargs='?', help='optional filename for output path data instead of default based on input')
+    parser.add_argument('-e', '--engine', choices=['memory', 'stream', 'numpy'], default='memory', help='memory: group all rows in memory, stream: group itineraries in a window with bounded memory, numpy: group and count with array operations (default: memory)')
+    parser.add_argument('-m', '--memory-budget', type=int, default=512, help='Memory budget in MB for the stream engine (default: 512)')
+    parser.add_argument('--window', type=int, default=1000, help='Number of open itineraries for the stream engine (default: 1000)')
+    parser.add_argument('--spill-dir', help='Directory for out-of-order rows spilled by the stream engine (default: system temp dir)')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='Parse chunks of the file in parallel with the memory or numpy engine (default: 1)')
+    parser.add_argument('-b', '--binary', action='store_true', help='Write paths in binary format, see binary_paths.py')
+    parser.add_argument('-s', '--source', choices=['csv', 'store'], default='csv', help='csv: parse a coupon csv file, store: query a coupon store made with coupon_store.py (default: csv)')
+    parser.add_argument('-y', '--years', nargs='+', type=int, help='Years to select from the store')
+    parser.add_argument('-q', '--quarters', nargs='+', type=int, default=[1,2,3,4], help='Quarters to select from the store (default: 1 2 3 4)')
+    parser.add_argument('-a', '--airports', nargs='+', type=int, help='Only itineraries from or to some of these airport ids in the store (default: all)')
+    parser.add_argument('--cache-size', type=int, default=4000, help='Max size in MB of the cache of parsed csv files next to them, least recently used are removed (default: 4000)')
+    parser.add_argument('--no-cache', action='store_true', help='Parse the csv file without using the cache, see coupon_cache.py')
+    metrics.addArguments(parser)
 
     args = parser.parse_args()
-    run(args.input, args.output)
+    metrics.configure(args)
+    if args.workers > 1 and args.engine == 'stream':
+        parser.error("the stream engine can't be used with more than one worker")
+    if args.source == 'store':
+        if not args.years:
+            parser.error("the store source needs years to select with -y")
+        if args.engine != 'memory' or args.workers > 1:
+            parser.error("the store source groups rows with the memory engine in one process")
+    cache = None if args.no_cache or args.source == 'store' else CouponCache(args.cache_size)
+    run(args.input, args.output, args.engine, args.memory_budget, args.window, args.spill_dir, args.workers, args.binary,
+        args.source, args.years, args.quarters, args.airports, cache)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
@@ -0,0 +1,129 @@
+import argparse
+import sys
+import resource, time
+from time import gmtime, strftime
+from collections import Counter
+from multiprocessing import Pool
+
+import make_paths
+
+def parseRange(arg):
+    """ Parse ranges like in download.js, e.g. '1995..2000,2010,2015' """
+    values = []
+    for part in arg.split(','):
+        v1, _, v2 = part.partition('..')
+        values.extend(range(int(v1), int(v2 or v1) + 1))
+    return values
+
+def getFilename(year, quarter, minimal=False, zipped=False):
+    return "data/{}_{}_Coupon{}.{}".format(year, quarter, "_min" if minimal else "", "zip" if zipped else "csv")
+
+def limitMemory(maxMemory):
+    """ Pool initializer, limit the address space of the worker to maxMemory MB """
+    if maxMemory:
+        limit = int(maxMemory * 1e6)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def makePaths(task):
+    """ Worker, parse one coupon file and write its paths.
+    Returns (filename, ngrams, stats) where ngrams is None on failure """
+    filename, engine, memoryBudget, keepNgrams, binary = task
+    t0, t1 = time.process_time(), time.time()
+    stats = {}
+    make_paths.ngrams.clear()
+    try:
+        ngrams = make_paths.parse(filename, engine, memoryBudget)
+        make_paths.writePaths(ngrams, make_paths.getOutputFilename(filename, binary), binary)
+        stats['numPaths'] = len(ngrams)
+    except (Exception, SystemExit) as err:
+        ngrams = None
+        stats['error'] = repr(err)
+    stats['cpuTime'] = time.process_time() - t0
+    stats['wallTime'] = time.time() - t1
+    # ru_maxrss is in kilobytes on Linux
+    stats['maxMemory'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    return filename, Counter(ngrams) if keepNgrams and ngrams is not None else None, stats
+
+def mergeNgrams(counters):
+    merged = Counter()
+    for ngrams in counters:
+        merged.update(ngrams)
+    return merged
+
+def printReport(results, maxMemory):
+    print("\n==== Report ====")
+    print("  Worker memory limit: {}".format("{} MB".format(maxMemory) if maxMemory else "none"))
+    print("  {:<36} {:>10} {:>10} {:>10} {:>12}".format("file", "wall (s)", "cpu (s)", "max MB", "paths"))
+    for filename, stats in results:
+        print("  {:<36} {:>10.1f} {:>10.1f} {:>10.1f} {:>12}".format(filename, stats['wallTime'], stats['cpuTime'],
+            stats['maxMemory'], stats.get('numPaths', "failed")))
+        if 'error' in stats:
+            print("    error: {}".format(stats['error']))
+
+def run(years, quarters, workers, engine, memoryBudget, maxMemory, merge, mergeOutput, minimal, binary=False, zipped=False):
+    t0 = time.time()
+    filenames = [getFilename(year, quarter, minimal, zipped) for year in years for quarter in quarters]
+    keepNgrams = merge != 'none'
+    tasks = [(filename, engine, memoryBudget, keepNgrams, binary) for filename in filenames]
+    print("Make paths from {} files with {} workers...".format(len(filenames), workers))
+    ngramsPerFile = {}
+    results = []
+    # One file per worker process to measure memory per file
+    with Pool(workers, initializer=limitMemory, initargs=(maxMemory,), maxtasksperchild=1) as pool:
+        for filename, ngrams, stats in pool.imap(makePaths, tasks):
+            print("Done {} in {:.1f}s{}".format(filename, stats['wallTime'], ", failed!" if 'error' in stats else ""))
+            ngramsPerFile[filename] = ngrams
+            results.append((filename, stats))
+
+    quartersString = "".join(map(str, quarters))
+    extension = "bin" if binary else "net"
+    if merge == 'year':
+        for year in years:
+            counters = [ngramsPerFile[getFilename(year, quarter, minimal, zipped)] for quarter in quarters]
+            if None in counters:
+                print("Skip merging year {} with failed files".format(year))
+                continue
+            make_paths.writePaths(mergeNgrams(counters), "data/{}_{}_Coupon_paths.{}".format(year, quartersString, extension), binary)
+    elif merge == 'all':
+        counters = [ngramsPerFile[filename] for filename in filenames]
+        if None in counters:
+            print("Skip merging with failed files")
+        else:
+            if not mergeOutput:
+                mergeOutput = "data/{}-{}_{}_Coupon_paths.{}".format(years[0], years[-1], quartersString, extension)
+            make_paths.writePaths(mergeNgrams(counters), mergeOutput, binary)
+
+    printReport(results, maxMemory)
+    print("Wall time:        {}".format(time.time() - t0))
+    print('\n== Finished at', strftime("%Y-%m-%d %H:%M:%S", gmtime()), '== \n')
+    return all('error' not in stats for filename, stats in results)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Make paths from csv data for many years and quarters in parallel.')
+    parser.add_argument('-y', '--year', required=True, type=parseRange, help='Select years from 1993-2017 (e.g. -y 1995..2000,2010,2015)')
+    parser.add_argument('-q', '--quarter', type=parseRange, default=[1,2,3,4], help='Select quarters from 1-4 (e.g. -q 1,4. Default 1..4)')
+    parser.add_argument('-j', '--workers', type=int, default=4, help='Number of worker processes (default: 4)')
+    parser.add_argument('-e', '--engine', choices=['memory', 'stream', 'numpy'], default='memory', help='Engine to parse each file with, see make_paths.py (default: memory)')
+    parser.add_argument('-m', '--memory-budget', type=int, default=512, help='Memory budget in MB for the stream engine (default: 512)')
+    parser.add_argument('--max-memory', type=int, help='Limit the memory of each worker to this many MB (default: no limit)')
+    parser.add_argument('--merge', choices=['none', 'year', 'all'], default='none', help='Also write paths merged per year or over all files (default: none)')
+    parser.add_argument('--merge-output', help='Filename for --merge all instead of default based on years and quarters')
+    parser.add_argument('--minimal', action='store_true', help='Use files downloaded with minimal number of data columns')
+    parser.add_argument('-b', '--binary', action='store_true', help='Write paths in binary format, see binary_paths.py')
+    parser.add_argument('-z', '--zip', action='store_true', help='Read the downloaded zip archives instead of extracted csv files')
+
+    args = parser.parse_args()
+    print("==== Starting ====")
+    print("  years: {}".format(args.year))
+    print("  quarters: {}".format(args.quarter))
+    print("  workers: {}".format(args.workers))
+    print("  engine: {}".format(args.engine))
+    print("  merge: {}".format(args.merge))
+    ok = run(args.year, args.quarter, args.workers, args.engine, args.memory_budget, args.max_memory,
+        args.merge, args.merge_output, args.minimal, args.binary, args.zip)
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
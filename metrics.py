@@ -0,0 +1,133 @@
+""" Timing, memory and profiling of named stages in the pipeline scripts
+
+Wrap each stage of a script, like parse, group, aggregate and write, in
+
+    with metrics.stage("parse", filename=filename) as stage:
+        ...
+        stage.rows += 1
+
+to measure its wall and cpu time, rows per second, peak memory (RSS) and
+the change in allocated memory blocks and garbage collections. Scripts add
+the command line options with addArguments and apply them with configure:
+--metrics appends one JSON line per stage to a file, and --profile writes
+cProfile data of each stage to a directory, to be read with pstats or
+snakeviz. printSummary prints the resource usage of the whole run.
+"""
+
+import cProfile
+import gc
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from time import gmtime, strftime
+
+scriptName = os.path.basename(sys.argv[0]).rsplit(".", maxsplit=1)[0] if sys.argv and sys.argv[0] else "python"
+metricsFilename = None
+profileDir = None
+# Records of finished stages in this process
+stages = []
+startClock, startTime = time.process_time(), time.time()
+isProfiling = False
+
+class Stage:
+    def __init__(self, name, rows, info):
+        self.name = name
+        self.rows = rows
+        self.info = info
+
+def getMaxMemory():
+    """ Peak memory (RSS) of this process in MB, ru_maxrss is in kilobytes on Linux """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1e6 if sys.platform == 'darwin' else maxrss / 1e3
+
+def getCollections():
+    return sum(generation['collections'] for generation in gc.get_stats())
+
+@contextmanager
+def stage(name, rows=0, **info):
+    """ Measure the stage in the with block, rows can also be set on the yielded Stage
+    and info is added to its record """
+    global isProfiling
+    current = Stage(name, rows, info)
+    profiler = None
+    if profileDir and not isProfiling:
+        # Only one profiler can be active, nested stages are in the profile of the outer stage
+        profiler = cProfile.Profile()
+        isProfiling = True
+    blocks, collections = sys.getallocatedblocks(), getCollections()
+    t0, t1 = time.process_time(), time.time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield current
+    finally:
+        if profiler:
+            profiler.disable()
+            isProfiling = False
+        wallTime = time.time() - t1
+        record = {
+            'script': scriptName,
+            'stage': name,
+            'pid': os.getpid(),
+            'date': strftime("%Y-%m-%d %H:%M:%S", gmtime()),
+            'wallTime': wallTime,
+            'cpuTime': time.process_time() - t0,
+            'rows': current.rows,
+            'rowsPerSecond': current.rows / wallTime if current.rows and wallTime > 0 else None,
+            'maxMemory': getMaxMemory(),
+            'allocatedBlocks': sys.getallocatedblocks() - blocks,
+            'gcCollections': getCollections() - collections,
+        }
+        record.update(current.info)
+        stages.append(record)
+        if profiler:
+            os.makedirs(profileDir, exist_ok=True)
+            profileFilename = os.path.join(profileDir, "{}_{}_{}_{}.prof".format(scriptName, os.getpid(), len(stages), name))
+            profiler.dump_stats(profileFilename)
+            record['profile'] = profileFilename
+        if metricsFilename:
+            writeRecord(record)
+
+def writeRecord(record):
+    # One write per line in append mode, so processes can share the file
+    with open(metricsFilename, mode='a') as outfile:
+        outfile.write(json.dumps(record) + "\n")
+
+def addArguments(parser):
+    parser.add_argument('--metrics', help='Append time, rows per second and memory of each stage as JSON lines to this file')
+    parser.add_argument('--profile', metavar='PROFILE_DIR', help='Write cProfile data of each stage to this directory')
+
+def configure(args, name=None):
+    """ Apply the options from addArguments """
+    global metricsFilename, profileDir, scriptName
+    metricsFilename = args.metrics
+    profileDir = args.profile
+    if name:
+        scriptName = name
+
+def printSummary():
+    """ Print the resource usage of the process and the time of each stage """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    if stages:
+        print("  {:<12} {:>10} {:>10} {:>14} {:>10}".format("stage", "wall (s)", "cpu (s)", "rows/s", "max MB"))
+        for record in stages:
+            print("  {:<12} {:>10.2f} {:>10.2f} {:>14} {:>10.1f}".format(record['stage'], record['wallTime'], record['cpuTime'],
+                "{:.0f}".format(record['rowsPerSecond']) if record['rowsPerSecond'] else "", record['maxMemory']))
+    print("Max memory usage: {} MB".format(getMaxMemory()))
+    print("Clock time:       {}".format(time.process_time() - startClock))
+    print("Wall time:        {}".format(time.time() - startTime))
+    print("User mode time:   {}".format(usage.ru_utime))
+    print("System time:      {}".format(usage.ru_stime))
+    if metricsFilename:
+        writeRecord({
+            'script': scriptName,
+            'stage': 'total',
+            'pid': os.getpid(),
+            'date': strftime("%Y-%m-%d %H:%M:%S", gmtime()),
+            'wallTime': time.time() - startTime,
+            'cpuTime': time.process_time() - startClock,
+            'maxMemory': getMaxMemory(),
+        })
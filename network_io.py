@@ -0,0 +1,278 @@
+""" Fast reading and writing of *states, *links and *paths sections
+
+Sections are read in large blocks of whole lines, with the numbers parsed
+straight into numpy arrays, and written with one format operation per
+batch of lines instead of one per line. The output is the same as
+formatting each line with "{} {} {}\\n".format(...).
+"""
+
+import re
+import sys
+import warnings
+from collections import namedtuple
+import numpy as np
+
+import binary_paths
+
+# Number of characters to read at once
+BLOCK_SIZE = 1 << 24
+
+StatesNetwork = namedtuple('StatesNetwork', ['stateIds', 'physIds', 'names', 'sources', 'targets', 'weights'])
+
+class SectionReader:
+    """ Read a network file section by section, like
+    *states
+    1 5 "1 5"
+    *links
+    1 2 3
+    where lines starting with # are comments """
+
+    def __init__(self, infile, blockSize=BLOCK_SIZE):
+        self.infile = infile
+        self.blockSize = blockSize
+        self.pending = ""
+
+    def readLine(self):
+        if self.pending:
+            line, newline, self.pending = self.pending.partition("\n")
+            return line + newline
+        return self.infile.readline()
+
+    def nextSection(self):
+        """ Skip to the next section, returns its header line in lower case,
+        as headers like *States and *states are the same, or None at the end of the file """
+        while True:
+            line = self.readLine()
+            if not line:
+                return None
+            if line[0] == '*':
+                return line.lower()
+
+    def blocks(self):
+        """ Generate blocks of whole lines until the next section, without comments """
+        while True:
+            block = self.pending or self.infile.read(self.blockSize)
+            self.pending = ""
+            if not block:
+                return
+            if block[-1] != "\n":
+                block += self.infile.readline()
+            if block[-1] != "\n":
+                # Last line of the file without a newline
+                block += "\n"
+            # Stop before the next section header
+            end = 0 if block[0] == '*' else block.find("\n*") + 1
+            if end > 0 or block[0] == '*':
+                self.pending = block[end:]
+                block = block[:end]
+            if block.startswith('#') or "\n#" in block:
+                block = "".join(line for line in block.splitlines(True) if line[0] != '#')
+            if block:
+                yield block
+            if self.pending:
+                return
+
+def parseNumbers(block, filename=""):
+    """ Parse whitespace separated numbers, as int64 if all are integers and else as float64 """
+    isFloat = any(c in block for c in ".eEnN")
+    with warnings.catch_warnings():
+        # Numpy warns and stops at text that is not a number
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(block, dtype=np.float64 if isFloat else np.int64, sep=' ')
+        except (DeprecationWarning, ValueError):
+            sys.exit("Could not parse numbers in {}".format(filename))
+
+def parseStateLines(block, filename=""):
+    """ Parse lines 'stateId physId "name"' to (stateIds, physIds, names) """
+    # Split on quotes to alternate between ids and names
+    parts = block.split('"')
+    names = parts[1::2]
+    numLines = block.count("\n")
+    if len(parts) == 2 * numLines + 1 and all(part[0] == "\n" for part in parts[2:-1:2]):
+        ids = parseNumbers(" ".join(parts[0::2]), filename)
+        if len(ids) == 2 * numLines:
+            return ids[0::2], ids[1::2], names
+    for line in block.splitlines():
+        if not re.match(r'\d+ \d+ ".+"$', line):
+            print("Line not matching a state node: '{}'".format(line))
+            sys.exit(1)
+    sys.exit("Could not parse state nodes in {}".format(filename))
+
+def readStates(filename):
+    """ Read a states network with format
+    *states
+    # stateId physId "name"
+    1 5 "1 5"
+    *links
+    # fromStateId toStateId weight
+    1 2 3
+    to a StatesNetwork of arrays and a list of names, with float weights """
+    stateIds, physIds, names = [], [], []
+    links = []
+    with open(filename, mode='r') as infile:
+        reader = SectionReader(infile)
+        section = reader.nextSection()
+        while section is not None:
+            if section.startswith("*states"):
+                for block in reader.blocks():
+                    blockStateIds, blockPhysIds, blockNames = parseStateLines(block, filename)
+                    stateIds.append(blockStateIds)
+                    physIds.append(blockPhysIds)
+                    names.extend(blockNames)
+            elif section.startswith("*links"):
+                for block in reader.blocks():
+                    links.append(parseNumbers(block, filename))
+            section = reader.nextSection()
+    links = np.concatenate(links).reshape(-1, 3) if links else np.empty((0, 3))
+    stateIds = np.concatenate(stateIds) if stateIds else np.empty(0, dtype=np.int64)
+    physIds = np.concatenate(physIds) if physIds else np.empty(0, dtype=np.int64)
+    return StatesNetwork(stateIds.astype(np.int64), physIds.astype(np.int64), names,
+        links[:, 0].astype(np.int64), links[:, 1].astype(np.int64), links[:, 2].astype(np.float64))
+
+def getMatrixFilename(filename):
+    """ Sparse matrix filename of a network file, e.g. data/net.net -> data/net.npz """
+    name, dot, extension = filename.rpartition('.')
+    if not dot or '/' in extension:
+        return filename + ".npz"
+    return name + ".npz"
+
+def writeSparseStates(filename, physIds, sources, targets, weights):
+    """ Write a states network with state ids 0..n-1 as a CSR matrix of the link
+    weights in the .npz format of scipy.sparse.save_npz, with the physical id
+    of each state in physIds. Read with readSparseStates or with
+    scipy.sparse.load_npz for the matrix alone """
+    numStates = len(physIds)
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(numStates + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=numStates), out=indptr[1:])
+    np.savez(filename,
+        format=np.array(b'csr'),
+        shape=np.array([numStates, numStates]),
+        indptr=indptr.astype(binary_paths.smallestDtype(len(order), '<i4', '<i8')),
+        indices=np.asarray(targets)[order].astype(binary_paths.smallestDtype(numStates, '<i4', '<i8')),
+        data=np.asarray(weights, dtype=np.float64)[order],
+        physIds=np.asarray(physIds, dtype=np.int64))
+
+def readSparseStates(filename):
+    """ Read a states network written with writeSparseStates to a StatesNetwork
+    without names, with links ordered by source """
+    with np.load(filename) as data:
+        indptr = data['indptr'].astype(np.int64)
+        numStates = len(indptr) - 1
+        return StatesNetwork(np.arange(numStates), data['physIds'], None,
+            np.repeat(np.arange(numStates), np.diff(indptr)), data['indices'].astype(np.int64), data['data'])
+
+def parseIntegerPaths(block):
+    """ Parse lines of integers separated by single spaces, like most paths,
+    returns (numbers, numbers per line) or None if the block has other text """
+    data = np.frombuffer(block.encode(), dtype=np.uint8)
+    isDigit = (data >= 48) & (data <= 57)
+    isSeparator = ~isDigit
+    isNewline = data == 10
+    if not (isDigit | isNewline | (data == 32)).all() or not isDigit[0] or not isNewline[-1] or \
+        (isSeparator[1:] & isSeparator[:-1]).any():
+        return None
+    # Numbers with leading zeros would not be written back the same
+    isStart = isDigit.copy()
+    isStart[1:] &= isSeparator[:-1]
+    if (isStart[:-1] & (data[:-1] == 48) & isDigit[1:]).any():
+        return None
+    newlines = np.flatnonzero(isNewline)
+    numNumbers = np.bincount(np.searchsorted(newlines, np.flatnonzero(data == 32)), minlength=len(newlines)) + 1
+    return parseNumbers(block), numNumbers
+
+def uniqueValues(values):
+    """ np.unique with first index and inverse, faster for integers in a small range """
+    if values.dtype == np.int64 and len(values) and values.max() - values.min() <= np.iinfo(np.uint16).max:
+        # Stable sort of 16 bit integers is a radix sort
+        minValue = values.min()
+        uniqueNodes, firstIndex, inverse = np.unique((values - minValue).astype(np.uint16), return_index=True, return_inverse=True)
+        return uniqueNodes + minValue, firstIndex, inverse
+    return np.unique(values, return_index=True, return_inverse=True)
+
+def iterTextPathBlocks(filename):
+    """ Generate the paths in the *paths section of a text paths file in blocks,
+    each as BinaryPaths with the ids of all blocks so far """
+    idIndex = {}
+    ids = []
+    with open(filename, mode='r') as infile:
+        reader = SectionReader(infile)
+        while True:
+            section = reader.nextSection()
+            if section is None:
+                return
+            if section.startswith("*paths"):
+                break
+        for block in reader.blocks():
+            integerPaths = parseIntegerPaths(block)
+            if integerPaths is not None:
+                tokens, numTokens = integerPaths
+            else:
+                tokens = np.array(block.split(), dtype=object)
+                numTokens = np.fromiter(map(len, map(str.split, block.splitlines())), dtype=np.int64)
+                numTokens = numTokens[numTokens > 0]
+            isWeight = np.zeros(len(tokens), dtype=bool)
+            isWeight[np.cumsum(numTokens) - 1] = True
+            weights = tokens[isWeight].astype(np.int64)
+            # Index node ids in order of first appearance
+            uniqueNodes, firstIndex, inverse = uniqueValues(tokens[~isWeight])
+            codes = np.empty(len(uniqueNodes), dtype=np.int32)
+            for i in np.argsort(firstIndex, kind='stable').tolist():
+                node = str(uniqueNodes[i])
+                code = idIndex.get(node)
+                if code is None:
+                    code = idIndex[node] = len(ids)
+                    ids.append(node)
+                codes[i] = code
+            offsets = np.zeros(len(numTokens) + 1, dtype=np.int64)
+            np.cumsum(numTokens - 1, out=offsets[1:])
+            yield binary_paths.BinaryPaths(ids, codes[inverse.reshape(-1)], offsets, weights)
+
+def readTextPaths(filename):
+    """ Read a text paths file to BinaryPaths """
+    ids, nodes, offsets, weights = [], [], [np.zeros(1, dtype=np.int64)], []
+    for paths in iterTextPathBlocks(filename):
+        ids = paths.ids
+        nodes.append(paths.nodes)
+        offsets.append(paths.offsets[1:] + offsets[-1][-1])
+        weights.append(paths.weights)
+    return binary_paths.BinaryPaths(ids, np.concatenate(nodes or [np.empty(0, dtype=np.int32)]),
+        np.concatenate(offsets), np.concatenate(weights or [np.empty(0, dtype=np.int64)]))
+
+def formatRows(rowFormat, columns):
+    """ Format rows of columns with a %-style rowFormat like "%s %s %s\\n" """
+    numRows = len(columns[0])
+    numColumns = len(columns)
+    values = [None] * (numRows * numColumns)
+    for i, column in enumerate(columns):
+        values[i::numColumns] = column.tolist() if isinstance(column, np.ndarray) else column
+    return (rowFormat * numRows) % tuple(values)
+
+def writeRows(outfile, rowFormat, columns, batchSize=100000):
+    """ Write rows of columns, numpy arrays or lists, formatted with rowFormat
+    in batches of batchSize rows. Using %s gives the same text as str.format """
+    numRows = len(columns[0])
+    for batchStart in range(0, numRows, batchSize):
+        outfile.write(formatRows(rowFormat, [column[batchStart:batchStart + batchSize] for column in columns]))
+
+def writeStates(outfile, stateIds, physIds, names, batchSize=100000):
+    """ Write state lines 'stateId physId "name"' of a *states section """
+    writeRows(outfile, "%s %s \"%s\"\n", [stateIds, physIds, names], batchSize)
+
+def writeLinks(outfile, sources, targets, weights, batchSize=100000):
+    """ Write link lines 'source target weight' of a *links section """
+    writeRows(outfile, "%s %s %s\n", [sources, targets, weights], batchSize)
+
+def writeTextPaths(outfile, paths, batchSize=100000):
+    """ Write the paths in BinaryPaths as lines 'node node ... weight' of a *paths section """
+    ids = paths.ids
+    numPaths = len(paths.weights)
+    for batchStart in range(0, numPaths, batchSize):
+        batchEnd = min(batchStart + batchSize, numPaths)
+        offsets = paths.offsets[batchStart:batchEnd + 1]
+        names = [ids[node] for node in paths.nodes[offsets[0]:offsets[-1]].tolist()]
+        starts = (offsets[:-1] - offsets[0]).tolist()
+        ends = (offsets[1:] - offsets[0]).tolist()
+        outfile.write("".join(["{} {}\n".format(" ".join(names[start:end]), weight)
+            for start, end, weight in zip(starts, ends, paths.weights[batchStart:batchEnd].tolist())]))
@@ -1,52 +1,88 @@
 import argparse
 import csv, json
-import sys, getopt
-import resource, time
+import sys, getopt, os
 from time import gmtime, strftime
-from collections import Counter, defaultdict
+import numpy as np
+
+import binary_paths
+import metrics
+import network_io
 
 # # inputName = 'data/2011_1_Coupon_paths_head.net'
 # inputName = 'data/2011_1_Coupon_paths.net'
 # # outputName = 'data/states.net'
 # outputName = 'data/2011_1_Coupon_states.net'
 
-stateNodes = Counter()
-stateLinks = Counter()
-intraLinks = defaultdict(Counter)
-stateNodeIndex = {}
+# Airport ids interned to integer codes
+nodeIndex = {}
+nodeIds = []
+# Links of each layer as (keys, weights) arrays in order of first appearance,
+# where each key packs the source and target codes as source << 32 | target
+intraLinks = {}
 
 def getName(filename):
     return filename.rsplit(".", maxsplit=1)[0]
 
+def internNode(node):
+    code = nodeIndex.get(node)
+    if code is None:
+        code = nodeIndex[node] = len(nodeIds)
+        nodeIds.append(node)
+    return code
+
 def getFilename(year, quarter):
+    """ Paths file of year and quarter, prefer binary format if available """
+    binaryFilename = "data/{}_{}_Coupon_paths.bin".format(year, quarter)
+    if os.path.exists(binaryFilename):
+        return binaryFilename
     return "data/{}_{}_Coupon_paths.net".format(year, quarter)
 
 def parsePaths(filename, layer):
+    """ Count the links of the paths in filename to layer, returns the number of paths """
     print('Parse paths data from "{}" and generate layer state nodes...'.format(filename))
-    # links = defaultdict(list)
-    links = intraLinks[layer]
-    with open(filename, mode='r') as infile:
-        rowNr = 0
-        for row in infile:
-            rowNr += 1
-            if rowNr == 1:
-                continue
-            path = row.split()
-            # print(path)
-            prevNode = path[0]
-            endIdx = len(path) - 1
-            weight = int(path[-1])
-            for idx, node in enumerate(path):
-                if idx == 0:
-                    continue
-                if idx == endIdx:
-                    break
-                
-                links[(prevNode, node)] += weight
-                prevNode = node
-            if rowNr % 100000 == 0:
-                print("Processed {} rows...".format(rowNr))
+    intraLinks.setdefault(layer, (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)))
+    if binary_paths.isBinaryPaths(filename):
+        return parseBinaryPaths(filename, layer)
+    numPaths = 0
+    for paths in network_io.iterTextPathBlocks(filename):
+        countPathLinks(paths, layer)
+        numPaths += len(paths.weights)
+        print("Processed {} rows...".format(numPaths))
     print("Done parsing paths!")
+    return numPaths
+
+def parseBinaryPaths(filename, layer):
+    """ Count the links of all paths in a binary paths file """
+    paths = binary_paths.readBinaryPaths(filename)
+    countPathLinks(paths, layer)
+    print("Done parsing {} paths!".format(len(paths.weights)))
+    return len(paths.weights)
+
+def countPathLinks(paths, layer):
+    """ Count the links of all paths in BinaryPaths to layer with array operations """
+    numNodes = len(paths.nodes)
+    if numNodes == 0:
+        return
+    # Link from each node to the next, except from the last node of each path
+    isLast = np.zeros(numNodes, dtype=bool)
+    isLast[paths.offsets[1:] - 1] = True
+    sources = np.flatnonzero(~isLast)
+    pathIndex = np.repeat(np.arange(len(paths.weights)), np.diff(paths.offsets))
+    codes = np.array([internNode(node) for node in paths.ids], dtype=np.int64)[paths.nodes]
+    keys = (codes[sources] << 32) | codes[sources + 1]
+    addLinks(layer, keys, paths.weights[pathIndex[sources]])
+
+def addLinks(layer, keys, weights):
+    """ Add the weights of links with packed keys to layer, keeping the order of first appearance """
+    layerKeys, layerWeights = intraLinks[layer]
+    keys = np.concatenate((layerKeys, keys))
+    uniqueKeys, firstIndex, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    weights = np.bincount(inverse.ravel(), weights=np.concatenate((layerWeights, weights)), minlength=len(uniqueKeys)).astype(np.int64)
+    order = np.argsort(firstIndex)
+    intraLinks[layer] = (uniqueKeys[order], weights[order])
+
+def getNumLinks():
+    return sum(len(weights) for _, weights in intraLinks.values())
 
 def writeMultilayer(filename):
     print("Writing multilayer network to {}...".format(filename))
@@ -56,12 +92,12 @@ def writeMultilayer(filename):
         layerIndex = 0
         outfile.write("*Intra\n")
         outfile.write("# layer node node weight\n")
-        for layer, links in intraLinks.items():
+        ids = np.array(nodeIds, dtype=object)
+        for layer, (keys, weights) in intraLinks.items():
             # layer node node weight
             # print("layer {} (index {})...".format(layer, layerIndex))
-            for link, weight in links.items():
-                # print(link, weight)
-                outfile.write("{} {} {} {}\n".format(layerIndex, link[0], link[1], weight))
+            sources, targets = ids[keys >> 32], ids[keys & 0xFFFFFFFF]
+            network_io.writeRows(outfile, "%s %s %s %s\n", [[layerIndex] * len(keys), sources, targets, weights])
             layerIndex += 1        
         # print("Writing {} multilayer links...".format(len(stateLinks)))
     print("Done!")
@@ -69,34 +105,30 @@ def writeMultilayer(filename):
 
 def run(years):
     print('\n==== Starting ==== \n')
-    t0, t1 = time.clock(), time.time()
     for year in years:
         for quarter in [1,2,3,4]:
             layer = "{}_{}".format(year, quarter)
-            parsePaths(getFilename(year, quarter), layer)
+            with metrics.stage("parse", layer=layer) as stage:
+                stage.rows = parsePaths(getFilename(year, quarter), layer)
     
     outname = "data/multilayer_{}_{}_states.net".format(years[0], years[-1])
-    writeMultilayer(outname)
+    with metrics.stage("write", filename=outname, rows=getNumLinks()):
+        writeMultilayer(outname)
     print('Done!')
-    print('MEMORY USAGE     : {} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000))
-    print('{} seconds process time, {} seconds wall time'.format(time.clock() - t0, time.time() - t1))
-    # write_time_file(outfile, str(time.clock() - t0) + ' seconds process time\n' + str(time.time() - t1) + ' seconds wall time')
+    metrics.printSummary()
     print('\n== Finished at', strftime("%Y-%m-%d %H:%M:%S", gmtime()), '== \n')
 
 def test(filename):
     print('\n==== Starting ==== \n')
-    t0, t1 = time.clock(), time.time()
     
-    parsePaths(filename, 0)
+    with metrics.stage("parse", filename=filename) as stage:
+        stage.rows = parsePaths(filename, 0)
     
     outname = "{}_mulitlayer_test.net".format(getName(filename))
-    writeMultilayer(outname)
+    with metrics.stage("write", filename=outname, rows=getNumLinks()):
+        writeMultilayer(outname)
     print('Done!')
-    print("Max memory usage: {} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6))
-    print("Clock time:       {}".format(time.clock() - t0))
-    print("Wall time:        {}".format(time.time() - t1))
-    print("User mode time:   {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_utime))
-    print("System time:      {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_stime))
+    metrics.printSummary()
     print('\n== Finished at', strftime("%Y-%m-%d %H:%M:%S", gmtime()), '== \n')
 
 
@@ -104,8 +136,10 @@ def main(argv):
     parser = argparse.ArgumentParser(description='Paths to multilayer states format.')
     parser.add_argument('input', nargs='?', default='', help='input')
     parser.add_argument('-y', '--years', nargs='+', type=int, help='years')
+    metrics.addArguments(parser)
 
     args = parser.parse_args()
+    metrics.configure(args)
     # print(args.input)
     # print(args.years)
     # test(args.input)
@@ -1,11 +1,14 @@
 import argparse
 import csv, json
-import sys, getopt
-import resource, time
+import sys, getopt, os
+import hashlib, shutil, tempfile
 from time import gmtime, strftime
 from collections import Counter, defaultdict
 from random import random
 
+import binary_paths
+import metrics
+
 paths = []
 validationPaths = []
 names = {}
@@ -27,31 +30,40 @@ def readNames(name_input):
     print("Parsed {} names!".format(len(names)))
 
 
+def readRows(filename):
+    """ Generate the lines of a text paths file, or of a binary paths file formatted as text """
+    if binary_paths.isBinaryPaths(filename):
+        yield "*paths\n"
+        for path in binary_paths.readPathRows(filename):
+            yield "{}\n".format(" ".join(map(str, path)))
+        return
+    with open(filename, mode='r') as infile:
+        yield from infile
+
 def parsePaths(filename, weight_threshold, split):
     print("Parse paths from {}...".format(filename))
 
-    with open(filename, mode='r') as infile:
-        rowNr = 0
-        numPaths = 0
-        numIgnoredByWeightThreshold = 0
-        for row in infile:
-            rowNr += 1
-            if rowNr % 10000 == 0:
-                print("Parsed {} rows...".format(rowNr))
-            # if rowNr == 1:
-            if row[0] == '*':
-                continue
-            numPaths += 1
-            path = row.split()
-            # print(path)
-            weight = int(path[-1])
-            if weight < weight_threshold:
-                numIgnoredByWeightThreshold += 1
-                continue
-            if random() < split:
-                validationPaths.append(row)
-            else:
-                paths.append(row)
+    rowNr = 0
+    numPaths = 0
+    numIgnoredByWeightThreshold = 0
+    for row in readRows(filename):
+        rowNr += 1
+        if rowNr % 10000 == 0:
+            print("Parsed {} rows...".format(rowNr))
+        # if rowNr == 1:
+        if row[0] == '*':
+            continue
+        numPaths += 1
+        path = row.split()
+        # print(path)
+        weight = int(path[-1])
+        if weight < weight_threshold:
+            numIgnoredByWeightThreshold += 1
+            continue
+        if random() < split:
+            validationPaths.append(row)
+        else:
+            paths.append(row)
     print("Done parsing {} paths from {} rows!".format(numPaths, rowNr))
     if weight_threshold > 0:
         print("  {} paths ignored by weight threshold".format(numIgnoredByWeightThreshold))
@@ -60,6 +72,7 @@ def parsePaths(filename, weight_threshold, split):
         print("  -> {} validation paths saved".format(len(validationPaths)))
     else:
         print("  -> {} paths saved".format(len(paths)))
+    return numPaths
 
 def writePaths(paths, outFilename):
     vertices = {}
@@ -84,23 +97,155 @@ def writePaths(paths, outFilename):
             outfile.write(p)
     print("Done!")
 
-def run(inFilenames, outFilename, weight_threshold, split, name_input):
-    t0, t1 = time.clock(), time.time()
+def getPathHash(row, seed):
+    """ Value in [0, 1) from a seeded hash of the nodes of a path row,
+    the same on all machines for the same path and seed """
+    nodes = row.rsplit(None, 1)[0]
+    digest = hashlib.blake2b(nodes.encode(), digest_size=8, key=str(seed).encode()).digest()
+    return int.from_bytes(digest, 'little') / 2**64
+
+class PathsWriter:
+    """ Write paths while they are parsed. Without names the paths go straight to
+    the output. With names, the vertices are collected in the same pass and the
+    paths go to a temporary file next to the output until close, where the output
+    is written with the vertices before the paths as in writePaths """
+
+    def __init__(self, outFilename):
+        self.outFilename = outFilename
+        self.vertices = {}
+        self.numPaths = 0
+        self.hasNames = len(names) > 0
+        if self.hasNames:
+            self.pathsFile = tempfile.NamedTemporaryFile(mode='w+', dir=os.path.dirname(os.path.abspath(outFilename)),
+                prefix=".paths_", delete=False)
+        else:
+            self.pathsFile = open(outFilename, mode='w')
+            self.pathsFile.write("*paths\n")
+
+    def write(self, row, path):
+        if self.hasNames:
+            for v in path[:-1]:
+                self.vertices[v] = getName(v)
+        self.pathsFile.write(row)
+        self.numPaths += 1
+
+    def close(self):
+        print("Writing {} paths to {}...".format(self.numPaths, self.outFilename))
+        if not self.hasNames:
+            self.pathsFile.close()
+            return
+        try:
+            with open(self.outFilename, mode='w') as outfile:
+                if len(self.vertices) > 0:
+                    outfile.write("*vertices {}\n".format(len(self.vertices)))
+                    for id,name in self.vertices.items():
+                        outfile.write("{} \"{}\"\n".format(id, name))
+                outfile.write("*paths\n")
+                self.pathsFile.seek(0)
+                shutil.copyfileobj(self.pathsFile, outfile, 1 << 20)
+        finally:
+            self.pathsFile.close()
+            os.remove(self.pathsFile.name)
+
+def streamPaths(filename, weight_threshold, getWriters):
+    """ Like parsePaths but write each path while reading, to the writers getWriters(row) returns """
+    print("Stream paths from {}...".format(filename))
+
+    rowNr = 0
+    numPaths = 0
+    numIgnoredByWeightThreshold = 0
+    for row in readRows(filename):
+        rowNr += 1
+        if rowNr % 10000 == 0:
+            print("Parsed {} rows...".format(rowNr))
+        if row[0] == '*':
+            continue
+        numPaths += 1
+        path = row.split()
+        weight = int(path[-1])
+        if weight < weight_threshold:
+            numIgnoredByWeightThreshold += 1
+            continue
+        for writer in getWriters(row):
+            writer.write(row, path)
+    print("Done parsing {} paths from {} rows!".format(numPaths, rowNr))
+    if weight_threshold > 0:
+        print("  {} paths ignored by weight threshold".format(numIgnoredByWeightThreshold))
+    return numPaths
+
+def getSplitFilenames(outFilename):
+    name = outFilename.rsplit(".", maxsplit=1)[0]
+    extension = outFilename.rsplit(".", maxsplit=1)[-1]
+    return "{}_training.{}".format(name, extension), "{}_validation.{}".format(name, extension)
+
+def getFoldFilenames(outFilename, fold):
+    name = outFilename.rsplit(".", maxsplit=1)[0]
+    extension = outFilename.rsplit(".", maxsplit=1)[-1]
+    return getSplitFilenames("{}_fold{}.{}".format(name, fold, extension))
+
+def streamAll(inFilenames, weight_threshold, writers, getWriters):
+    try:
+        for inFilename in inFilenames:
+            with metrics.stage("stream", filename=inFilename) as stage:
+                stage.rows = streamPaths(inFilename, weight_threshold, getWriters)
+    finally:
+        with metrics.stage("write", rows=sum(writer.numPaths for writer in writers)):
+            for writer in writers:
+                writer.close()
+
+def runStreaming(inFilenames, outFilename, weight_threshold, split, seed):
+    if split > 0:
+        outFilenameTraining, outFilenameValidation = getSplitFilenames(outFilename)
+        trainingWriter, validationWriter = PathsWriter(outFilenameTraining), PathsWriter(outFilenameValidation)
+        getWriters = lambda row: [validationWriter] if getPathHash(row, seed) < split else [trainingWriter]
+        streamAll(inFilenames, weight_threshold, [trainingWriter, validationWriter], getWriters)
+        print("  -> {} training paths saved".format(trainingWriter.numPaths))
+        print("  -> {} validation paths saved".format(validationWriter.numPaths))
+    else:
+        writer = PathsWriter(outFilename)
+        streamAll(inFilenames, weight_threshold, [writer], lambda row: [writer])
+        print("  -> {} paths saved".format(writer.numPaths))
+    print("Done!")
+
+def runFolds(inFilenames, outFilename, weight_threshold, folds, seed):
+    """ Write all k-fold training/validation pairs in one pass over the input files.
+    Each path is in the validation set of fold int(hash * folds) and in the training sets of the other folds """
+    trainingWriters, validationWriters = [], []
+    for fold in range(1, folds + 1):
+        outFilenameTraining, outFilenameValidation = getFoldFilenames(outFilename, fold)
+        trainingWriters.append(PathsWriter(outFilenameTraining))
+        validationWriters.append(PathsWriter(outFilenameValidation))
+    foldWriters = [[validationWriters[fold]] + trainingWriters[:fold] + trainingWriters[fold + 1:] for fold in range(folds)]
+    streamAll(inFilenames, weight_threshold, trainingWriters + validationWriters,
+        lambda row: foldWriters[int(getPathHash(row, seed) * folds)])
+    for fold in range(folds):
+        print("  -> fold {}: {} training and {} validation paths saved".format(fold + 1,
+            trainingWriters[fold].numPaths, validationWriters[fold].numPaths))
+    print("Done!")
+
+def run(inFilenames, outFilename, weight_threshold, split, name_input, stream=False, seed=0, folds=None):
     if name_input:
         readNames(name_input)
 
+    if folds is not None:
+        runFolds(inFilenames, outFilename, weight_threshold, folds, seed)
+        return
+
+    if stream:
+        runStreaming(inFilenames, outFilename, weight_threshold, split, seed)
+        return
+
     for inFilename in inFilenames:
-        parsePaths(inFilename, weight_threshold, split)
+        with metrics.stage("parse", filename=inFilename) as stage:
+            stage.rows = parsePaths(inFilename, weight_threshold, split)
     
-    if split > 0:
-        name = outFilename.rsplit(".", maxsplit=1)[0]
-        extension = outFilename.rsplit(".", maxsplit=1)[-1]
-        outFilenameTraining = "{}_training.{}".format(name, extension)
-        outFilenameValidation = "{}_validation.{}".format(name, extension)
-        writePaths(paths, outFilenameTraining)
-        writePaths(validationPaths, outFilenameValidation)
-    else:
-        writePaths(paths, outFilename)
+    with metrics.stage("write", rows=len(paths) + len(validationPaths)):
+        if split > 0:
+            outFilenameTraining, outFilenameValidation = getSplitFilenames(outFilename)
+            writePaths(paths, outFilenameTraining)
+            writePaths(validationPaths, outFilenameValidation)
+        else:
+            writePaths(paths, outFilename)
 
 def main(argv):
     parser = argparse.ArgumentParser(description='Filter paths.')
@@ -109,23 +254,27 @@ def main(argv):
     parser.add_argument('--name-input', help='external csv file with names to add to the paths')
     parser.add_argument('-w', '--weight-threshold', type=float, help='Ignore paths with weight less than this threshold (default: 0.0)', default=0.0)
     parser.add_argument('-s', '--split', type=float, help='Split to training/validation set with fraction <s> (between 0 and 1) of paths to validation set (default: 0.0)', default=0.0)
+    parser.add_argument('--stream', action='store_true', help='Write paths while reading with constant memory, split by a seeded hash of each path')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the hash to split paths with in stream mode (default: 0)')
+    parser.add_argument('-k', '--folds', type=int, help='Write k >= 2 training/validation pairs for k-fold cross-validation in one pass, assigned by the seeded hash')
+    metrics.addArguments(parser)
 
     args = parser.parse_args()
-    t0, t1 = time.clock(), time.time()
+    if args.folds is not None and args.folds < 2:
+        parser.error("-k/--folds must be at least 2")
+    metrics.configure(args)
     print("==== Starting ====")
     print("  input: {}".format(args.input))
     print("  output: {}".format(args.output))
     print("  name_input: {}".format(args.name_input))
     print("  weight_threshold: {}".format(args.weight_threshold))
     print("  split: {}".format(args.split))
+    print("  stream: {}".format(args.stream))
+    print("  folds: {}".format(args.folds))
     
-    run(args.input, args.output, args.weight_threshold, args.split, args.name_input)
+    run(args.input, args.output, args.weight_threshold, args.split, args.name_input, args.stream, args.seed, args.folds)
 
-    print("Max memory usage: {} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6))
-    print("Clock time:     {}".format(time.clock() - t0))
-    print("Wall time:      {}".format(time.time() - t1))
-    print("User mode time: {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_utime))
-    print("System time:    {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_stime))
+    metrics.printSummary()
 
 if __name__ == "__main__":
    main(sys.argv[1:])
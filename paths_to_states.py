@@ -1,18 +1,29 @@
 import argparse
 import csv, json
-import sys, getopt
-import resource, time
+import sys, getopt, os
 from time import gmtime, strftime
 from collections import Counter, defaultdict
+from array import array
+import numpy as np
+
+import binary_paths
+import metrics
+import network_io
+import states_cache
+from states_cache import StatesCache
 
 # # inputName = 'data/2011_1_Coupon_paths_head.net'
 # inputName = 'data/2011_1_Coupon_paths.net'
 # # outputName = 'data/states.net'
 # outputName = 'data/2011_1_Coupon_states.net'
 
-stateNodes = Counter()
-stateLinks = Counter()
-stateNodeIndex = {}
+# Airport ids interned to small integer codes
+nodeIndex = {}
+nodeIds = []
+# Counters of state nodes and links per markov order
+stateCounters = {}
+# Number of paths to count at once
+BATCH_SIZE = 500000
 
 def getName(filename):
     return filename.rsplit(".", maxsplit=1)[0]
@@ -21,166 +32,311 @@ def getNameWithoutPath(filename):
     return filename.rsplit(".", maxsplit=1)[0].split('/')[-1]
 
 def getFilename(year, quarter):
+    """ Paths file of year and quarter, prefer binary format if available """
+    binaryFilename = "data/{}_{}_Coupon_paths.bin".format(year, quarter)
+    if os.path.exists(binaryFilename):
+        return binaryFilename
     return "data/{}_{}_Coupon_paths.net".format(year, quarter)
 
-def parsePathToFirstOrderStates(path):
-    endIdx = len(path) - 1
-    weight = int(path[-1])
-
-    prevStateNode = path[0]
-    stateNodes[prevStateNode] += 1
-    for idx, node in enumerate(path):
-        # if idx < 1:
-        #     continue
-        if idx == endIdx:
-            break
-        stateNode = path[idx]
-        stateNodes[stateNode] += 1
-        stateLinks[(prevStateNode,stateNode)] += weight
-        prevStateNode = stateNode
-
-def parsePathToSecondOrderStates(path):
-    endIdx = len(path) - 1
-    weight = int(path[-1])
-    prevStateNode = (path[0], path[1])
-    stateNodes[prevStateNode] += 1
-    for idx, node in enumerate(path):
-        if idx < 1:
-            continue
-        if idx == endIdx:
-            break
-        stateNode = (path[idx-1], path[idx])
-        stateNodes[stateNode] += 1
-        stateLinks[(prevStateNode,stateNode)] += weight
-        prevStateNode = stateNode
-
-def parsePathToThirdOrderState(path):
-    endIdx = len(path) - 1
-    weight = int(path[-1])
-    prevStateNode = (path[0], path[1], path[2])
-    stateNodes[prevStateNode] += 1
-    for idx, node in enumerate(path):
-        if idx < 2:
-            continue
-        if idx == endIdx:
-            break
-        stateNode = (path[idx-2], path[idx-1], path[idx])
-        stateNodes[stateNode] += 1
-        stateLinks[(prevStateNode,stateNode)] += weight
-        prevStateNode = stateNode
-
-pathParsers = {
-    1: parsePathToFirstOrderStates,
-    2: parsePathToSecondOrderStates,
-    3: parsePathToThirdOrderState,
-}
-
-def parsePathsToStates(filename, order, count_threshold):
-    print("Parse paths data from {} and generate state nodes of order {}...".format(filename, order))
-
-    if order not in [1,2,3]:
-        sys.exit("Order not supported: {}".format(order))
-    
-    parser = pathParsers[order]
-    
-    with open(filename, mode='r') as infile:
-        rowNr = 0
-        numIgnoredByCountThreshold = 0
-        numIgnoredByLengthThreshold = 0
-        for row in infile:
-            rowNr += 1
-            if rowNr % 100000 == 0:
-                print("Processed {} rows...".format(rowNr))
-            if rowNr == 1:
-                continue
-            path = row.split()
-            # print(path)
-            endIdx = len(path) - 1
-            weight = int(path[-1])
-            if weight < count_threshold:
-                numIgnoredByCountThreshold += 1
-                continue
-            # Skip paths shorter than maximum used
-            if endIdx <= 3:
-                numIgnoredByLengthThreshold += 1
-                continue
-            parser(path)
-    print("Done parsing {} paths!".format(rowNr - 1))
+# Code marking the link from the first state of each path to itself, kept from
+# the original per order parsers to get the same networks
+SELF_LINK = 0xFFFF
+NODES_PER_WORD = 4
+
+def internNode(node):
+    code = nodeIndex.get(node)
+    if code is None:
+        code = nodeIndex[node] = len(nodeIds)
+        if code >= SELF_LINK:
+            sys.exit("Too many physical nodes: {}".format(code))
+        nodeIds.append(node)
+    return code
+
+def packRows(codes):
+    """ Pack rows of 16 bit node codes into rows of 64 bit words that sort in the same order """
+    numRows, numColumns = codes.shape
+    words = np.zeros((numRows, -(-numColumns // NODES_PER_WORD)), dtype=np.uint64)
+    for column in range(numColumns):
+        shift = np.uint64(16 * (NODES_PER_WORD - 1 - column % NODES_PER_WORD))
+        words[:, column // NODES_PER_WORD] |= codes[:, column].astype(np.uint64) << shift
+    return words
+
+def unpackRows(words, numColumns):
+    codes = np.empty((words.shape[0], numColumns), dtype=np.uint16)
+    for column in range(numColumns):
+        shift = np.uint64(16 * (NODES_PER_WORD - 1 - column % NODES_PER_WORD))
+        codes[:, column] = (words[:, column // NODES_PER_WORD] >> shift) & np.uint64(0xFFFF)
+    return codes
+
+def uniqueRows(words):
+    """ Like np.unique(words, axis=0, return_index=True, return_inverse=True)
+    where index is the first occurrence of each unique row """
+    numRows = words.shape[0]
+    order = np.lexsort(words.T[::-1])
+    sortedWords = words[order]
+    isNew = np.ones(numRows, dtype=bool)
+    if numRows > 1:
+        np.any(sortedWords[1:] != sortedWords[:-1], axis=1, out=isNew[1:])
+    groups = np.cumsum(isNew) - 1
+    inverse = np.empty(numRows, dtype=np.int64)
+    inverse[order] = groups
+    return sortedWords[isNew], order[isNew], inverse
+
+def findRows(sortedWords, words):
+    """ Index of each row of words in the unique sorted rows of sortedWords """
+    if sortedWords.shape[1] == 1:
+        return np.searchsorted(sortedWords[:, 0], words[:, 0])
+    # Big endian bytes of the words compare in the same order as the words
+    def getKeys(rows):
+        return np.ascontiguousarray(rows.astype('>u8')).view(np.dtype((np.void, 8 * rows.shape[1]))).ravel()
+    return np.searchsorted(getKeys(sortedWords), getKeys(words))
+
+def mergeRows(words, first, newWords, newFirst, weights=None, newWeights=None):
+    """ Merge rows keeping their first appearance, and summed weights if given """
+    uniqueWords, index, inverse = uniqueRows(np.concatenate((words, newWords)))
+    if weights is None:
+        return uniqueWords, np.concatenate((first, newFirst))[index]
+    summed = np.bincount(inverse, weights=np.concatenate((weights, newWeights)), minlength=len(uniqueWords)).astype(np.int64)
+    return uniqueWords, np.concatenate((first, newFirst))[index], summed
+
+
+class StateCounter:
+    """ Count state nodes and state links of one markov order from batches of paths.
+
+    A state of order k is a window of k consecutive nodes in a path, and each state
+    links to the next window. States and links are kept as packed rows of node codes
+    with the position of their first appearance, to write them in the same order as
+    they were found.
+    """
+
+    def __init__(self, order):
+        self.order = order
+        self.numWindows = 0
+        stateWords = -(-order // NODES_PER_WORD)
+        linkWords = -(-(order + 1) // NODES_PER_WORD)
+        self.stateWords = np.empty((0, stateWords), dtype=np.uint64)
+        self.stateFirst = np.empty(0, dtype=np.int64)
+        self.linkWords = np.empty((0, linkWords), dtype=np.uint64)
+        self.linkFirst = np.empty(0, dtype=np.int64)
+        self.linkWeights = np.empty(0, dtype=np.int64)
+
+    def addPaths(self, codes, offsets, weights):
+        """ Count states of paths given as node codes with path offsets,
+        all paths must have at least order + 1 nodes """
+        k = self.order
+        windowsPerPath = np.diff(offsets) - k + 1
+        numWindows = int(windowsPerPath.sum())
+        if numWindows == 0:
+            return
+        pathIndex = np.repeat(np.arange(len(weights)), windowsPerPath)
+        windowIndex = np.arange(numWindows) - np.repeat(np.cumsum(windowsPerPath) - windowsPerPath, windowsPerPath)
+        windowStarts = offsets[:-1][pathIndex] + windowIndex
+        states = codes[windowStarts[:, None] + np.arange(k)]
+        # Link from previous window to this, including the first node of the previous window
+        links = np.empty((numWindows, k + 1), dtype=np.uint16)
+        links[:, 0] = codes[np.maximum(windowStarts - 1, 0)]
+        links[:, 1:] = states
+        isFirst = windowIndex == 0
+        links[isFirst, :k] = states[isFirst]
+        links[isFirst, k] = SELF_LINK
+        # A self link of a state with one repeated node is the same as a link through that node
+        isRepeated = isFirst & np.all(states == states[:, :1], axis=1)
+        links[isRepeated, k] = states[isRepeated, 0]
+        positions = np.arange(self.numWindows, self.numWindows + numWindows)
+        self.numWindows += numWindows
+
+        self.stateWords, self.stateFirst = mergeRows(self.stateWords, self.stateFirst, packRows(states), positions)
+        self.linkWords, self.linkFirst, self.linkWeights = mergeRows(self.linkWords, self.linkFirst, packRows(links), positions,
+            self.linkWeights, np.asarray(weights)[pathIndex])
+
+    def getStates(self):
+        """ Return node codes of each state in order of first appearance """
+        return unpackRows(self.stateWords[np.argsort(self.stateFirst, kind='stable')], self.order)
+
+    def getLinks(self):
+        """ Return (source, target, weight) arrays in order of first appearance,
+        where source and target index the states from getStates """
+        k = self.order
+        stateOrder = np.argsort(self.stateFirst, kind='stable')
+        linkOrder = np.argsort(self.linkFirst, kind='stable')
+        links = unpackRows(self.linkWords[linkOrder], k + 1)
+        isSelf = links[:, k] == SELF_LINK
+        targets = links[:, 1:].copy()
+        targets[isSelf] = links[isSelf, :k]
+        # Find state index of link sources and targets in the sorted states
+        stateIndex = np.empty(len(stateOrder), dtype=np.int64)
+        stateIndex[stateOrder] = np.arange(len(stateOrder))
+        sources = stateIndex[findRows(self.stateWords, packRows(links[:, :k]))]
+        targets = stateIndex[findRows(self.stateWords, packRows(targets))]
+        return sources, targets, self.linkWeights[linkOrder]
+
+    def getArrays(self):
+        """ Return the counts as a dict of arrays in their smallest types,
+        to add to another counter with addArrays """
+        firstDtype = binary_paths.smallestDtype(self.numWindows, '<u4', '<i8')
+        return {
+            'numWindows': np.array(self.numWindows),
+            'stateWords': self.stateWords,
+            'stateFirst': self.stateFirst.astype(firstDtype),
+            'linkWords': self.linkWords,
+            'linkFirst': self.linkFirst.astype(firstDtype),
+            'linkWeights': self.linkWeights.astype(binary_paths.smallestDtype(self.linkWeights.max(initial=0), '<u4', '<i8')),
+        }
+
+    def addArrays(self, arrays, codeMap):
+        """ Add counts from getArrays of a counter of the same order, as if its paths
+        were added after the paths of this counter. codeMap maps its node codes to ours """
+        isIdentity = np.array_equal(codeMap, np.arange(len(codeMap)))
+        def remap(words, numColumns):
+            return words if isIdentity else packRows(codeMap[unpackRows(words, numColumns)])
+        k = self.order
+        if self.numWindows == 0:
+            self.stateWords, self.stateFirst = remap(arrays['stateWords'], k), arrays['stateFirst'].astype(np.int64)
+            self.linkWords, self.linkFirst = remap(arrays['linkWords'], k + 1), arrays['linkFirst'].astype(np.int64)
+            self.linkWeights = arrays['linkWeights'].astype(np.int64)
+            self.numWindows = int(arrays['numWindows'])
+            return
+        self.stateWords, self.stateFirst = mergeRows(self.stateWords, self.stateFirst,
+            remap(arrays['stateWords'], k), arrays['stateFirst'] + self.numWindows)
+        self.linkWords, self.linkFirst, self.linkWeights = mergeRows(self.linkWords, self.linkFirst,
+            remap(arrays['linkWords'], k + 1), arrays['linkFirst'] + self.numWindows,
+            self.linkWeights, arrays['linkWeights'])
+        self.numWindows += int(arrays['numWindows'])
+
+
+def getStateCounter(order):
+    if order not in stateCounters:
+        stateCounters[order] = StateCounter(order)
+    return stateCounters[order]
+
+def getMinPathLength(order):
+    """ Paths shorter than this are skipped, at least four nodes to use the same
+    paths for all orders up to three """
+    return max(3, order) + 1
+
+def selectPaths(codes, offsets, selected):
+    """ Return (codes, offsets) of the selected paths """
+    lengths = np.diff(offsets)[selected]
+    selectedOffsets = np.zeros(len(selected) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=selectedOffsets[1:])
+    nodeIndex = np.repeat(offsets[:-1][selected] - selectedOffsets[:-1], lengths) + np.arange(selectedOffsets[-1])
+    return codes[nodeIndex], selectedOffsets
+
+def addPathsToOrders(codes, offsets, weights, counters):
+    """ Count a batch of paths for the counter of each order, skipping paths too short for it """
+    lengths = np.diff(offsets)
+    for order, counter in counters.items():
+        isLong = lengths >= getMinPathLength(order)
+        if isLong.all():
+            counter.addPaths(codes, offsets, weights)
+        else:
+            selected = np.flatnonzero(isLong)
+            counter.addPaths(*selectPaths(codes, offsets, selected), weights[selected])
+
+def parsePathsToStates(filename, orders, count_threshold, counters=None):
+    """ Parse paths once and count states of each order in orders,
+    in the global counters or in counters by order if given.
+    Returns the number of paths parsed """
+    if isinstance(orders, int):
+        orders = [orders]
+    if counters is None:
+        counters = {order: getStateCounter(order) for order in orders}
+    print("Parse paths data from {} and generate state nodes of order {}...".format(filename, ", ".join(map(str, orders))))
+
+    if min(orders) < 1:
+        sys.exit("Order not supported: {}".format(min(orders)))
+
+    minLength = min(getMinPathLength(order) for order in orders)
+    if binary_paths.isBinaryPaths(filename):
+        blocks = [binary_paths.readBinaryPaths(filename)]
+    else:
+        blocks = network_io.iterTextPathBlocks(filename)
+
+    fileCodes = array('H')
+    numPaths = 0
+    numIgnoredByCountThreshold = 0
+    numIgnoredByLengthThreshold = 0
+    for paths in blocks:
+        # Intern ids new in this block, text blocks share the ids of earlier blocks
+        fileCodes.extend(internNode(node) for node in paths.ids[len(fileCodes):])
+        codes = np.frombuffer(fileCodes, dtype=np.uint16)
+        isCounted = paths.weights >= count_threshold
+        isLong = np.diff(paths.offsets) >= minLength
+        numIgnoredByCountThreshold += int((~isCounted).sum())
+        numIgnoredByLengthThreshold += int((isCounted & ~isLong).sum())
+        selected = np.flatnonzero(isCounted & isLong)
+        for batchStart in range(0, len(selected), BATCH_SIZE):
+            batch = selected[batchStart:batchStart + BATCH_SIZE]
+            nodes, offsets = selectPaths(paths.nodes, paths.offsets, batch)
+            addPathsToOrders(codes[nodes], offsets, paths.weights[batch].astype(np.int64), counters)
+        numPaths += len(paths.weights)
+        print("Processed {} paths...".format(numPaths))
+    print("Done parsing {} paths!".format(numPaths))
     print("  Number of paths ignored by count threshold:", numIgnoredByCountThreshold)
     print("  Number of paths ignored by length threshold:", numIgnoredByLengthThreshold)
+    return numPaths
+
+def getCacheKey(order, count_threshold):
+    return "states_{}_c{}".format(order, count_threshold)
+
+def countPathsCached(filename, orders, count_threshold, cache):
+    """ Add state counts of paths in filename to the global counters,
+    using counts cached from earlier runs and caching new counts.
+    Returns the number of paths parsed """
+    missingOrders = []
+    for order in orders:
+        arrays = cache.load(filename, getCacheKey(order, count_threshold))
+        if arrays is None:
+            missingOrders.append(order)
+            continue
+        print("Using cached states of order {} for {}".format(order, filename))
+        addCachedArrays(getStateCounter(order), arrays)
+    if not missingOrders:
+        return 0
+    counters = {order: StateCounter(order) for order in missingOrders}
+    numPaths = parsePathsToStates(filename, missingOrders, count_threshold, counters)
+    for order, counter in counters.items():
+        arrays = counter.getArrays()
+        arrays['ids'] = np.array(nodeIds, dtype=str)
+        cache.save(filename, getCacheKey(order, count_threshold), arrays)
+        addCachedArrays(getStateCounter(order), arrays)
+    return numPaths
+
+def addCachedArrays(counter, arrays):
+    """ Add counts from StateCounter.getArrays with their node ids to counter """
+    # Keep the self link code and map the codes of the cached ids to our codes
+    codeMap = np.arange(SELF_LINK + 1, dtype=np.uint16)
+    codeMap[:len(arrays['ids'])] = [internNode(node) for node in arrays['ids'].tolist()]
+    counter.addArrays(arrays, codeMap)
 
 
-def writeFirstOrderNetwork(filename):
-    print("Writing first order network to {}...".format(filename))
-    numStateNodes = len(stateNodes)
-    with open(filename, mode='w') as outfile:
-        print("Writing {} state nodes...".format(numStateNodes))
-        outfile.write("*vertices {}\n".format(numStateNodes))
-        idx = 0
-        for stateNode, count in stateNodes.items():
-            stateNodeIndex[stateNode] = idx
-            outfile.write("{} \"{}\"\n".format(idx, stateNode))
-            idx += 1        
-        print("Writing {} state links...".format(len(stateLinks)))
-        outfile.write("*arcs\n")
-        for stateLink, count in stateLinks.items():
-            # print(stateLink, count)
-            outfile.write("{} {}\n".format(stateNodeIndex[stateLink[0]], stateNodeIndex[stateLink[1]]))
-    print("Done!")
-
-def writeFirstOrderStates(filename):
-    print("Writing states to {}...".format(filename))
-    numStateNodes = len(stateNodes)
-    with open(filename, mode='w') as outfile:
-        print("Writing {} state nodes...".format(numStateNodes))
-        outfile.write("*states {}\n".format(numStateNodes))
-        idx = 0
-        for stateNode, count in stateNodes.items():
-            stateNodeIndex[stateNode] = idx
-            outfile.write("{} {} \"{}\"\n".format(idx, stateNode, stateNode))
-            idx += 1        
-        print("Writing {} state links...".format(len(stateLinks)))
-        outfile.write("*links\n")
-        for stateLink, weight in stateLinks.items():
-            # print(stateLink, weight)
-            outfile.write("{} {} {}\n".format(stateNodeIndex[stateLink[0]], stateNodeIndex[stateLink[1]], weight))
-    print("Done!")
-
-def writeSecondOrderStates(filename):
-    print("Writing states to {}...".format(filename))
-    numStateNodes = len(stateNodes)
-    with open(filename, mode='w') as outfile:
-        print("Writing {} state nodes...".format(numStateNodes))
-        outfile.write("*states {}\n".format(numStateNodes))
-        idx = 0
-        for stateNode, count in stateNodes.items():
-            stateNodeIndex[stateNode] = idx
-            outfile.write("{} {} \"{} {}\"\n".format(idx, stateNode[1], stateNode[0], stateNode[1]))
-            idx += 1        
-        print("Writing {} state links...".format(len(stateLinks)))
-        outfile.write("*links\n")
-        for stateLink, weight in stateLinks.items():
-            # print(stateLink, weight)
-            outfile.write("{} {} {}\n".format(stateNodeIndex[stateLink[0]], stateNodeIndex[stateLink[1]], weight))
-    print("Done!")
-
-def writeThirdOrderStates(filename):
-    print("Writing third order states to {}...".format(filename))
-    numStateNodes = len(stateNodes)
-    with open(filename, mode='w') as outfile:
-        print("Writing {} state nodes...".format(numStateNodes))
-        outfile.write("*states {}\n".format(numStateNodes))
-        idx = 0
-        for stateNode, count in stateNodes.items():
-            stateNodeIndex[stateNode] = idx
-            outfile.write("{} {} \"{} {} {}\"\n".format(idx, stateNode[2], stateNode[0], stateNode[1], stateNode[2]))
-            idx += 1        
-        print("Writing {} state links...".format(len(stateLinks)))
-        outfile.write("*links\n")
-        for stateLink, weight in stateLinks.items():
-            # print(stateLink, weight)
-            outfile.write("{} {} {}\n".format(stateNodeIndex[stateLink[0]], stateNodeIndex[stateLink[1]], weight))
-    print("Done!")
+def writeStates(filename, order, batchSize=100000, matrix=False):
+    """ Write the states network of order to filename, and with matrix
+    also as a sparse matrix to the getMatrixFilename of it """
+    with metrics.stage("write", filename=filename, order=order) as stage:
+        counter = getStateCounter(order)
+        print("Writing states of order {} to {}...".format(order, filename))
+        states = counter.getStates()
+        numStateNodes = len(states)
+        with open(filename, mode='w') as outfile:
+            print("Writing {} state nodes...".format(numStateNodes))
+            outfile.write("*states {}\n".format(numStateNodes))
+            # Format the name of each node in a state as a column
+            ids = np.array(nodeIds, dtype=object)
+            stateFormat = "%s %s \"{}\"\n".format(" ".join(["%s"] * order))
+            for batchStart in range(0, numStateNodes, batchSize):
+                names = [ids[column] for column in states[batchStart:batchStart + batchSize].T]
+                network_io.writeRows(outfile, stateFormat, [range(batchStart, batchStart + len(names[-1])), names[-1]] + names, batchSize)
+            sources, targets, weights = counter.getLinks()
+            print("Writing {} state links...".format(len(weights)))
+            outfile.write("*links\n")
+            network_io.writeLinks(outfile, sources, targets, weights, batchSize)
+        if matrix:
+            matrixFilename = network_io.getMatrixFilename(filename)
+            print("Writing sparse matrix to {}...".format(matrixFilename))
+            network_io.writeSparseStates(matrixFilename, ids[states[:, -1]].astype(np.int64) if numStateNodes else [], sources, targets, weights)
+        stage.rows = numStateNodes + len(weights)
+        print("Done!")
 
 def writeCsv(docs, filename, fieldnames):
     print('Write to "{}"...'.format(filename))
@@ -190,61 +346,65 @@ def writeCsv(docs, filename, fieldnames):
         for docid, doc in docs.items():
             writer.writerow(doc)
 
-def runSingle(pathsFilename, order, count_threshold):
-    parsePathsToStates(pathsFilename, order, count_threshold)
-    
-    outname = "data/{}_states_{}.net".format(getNameWithoutPath(pathsFilename), order)
-    if order == 1:
-        # writeFirstOrderNetwork("{}_{}_pajek.net".format(year, quartersString))
-        writeFirstOrderStates(outname)
-    elif order == 2:
-        writeSecondOrderStates(outname)
-    elif order == 3:
-        writeThirdOrderStates(outname)
-
-def run(year, order, quarters, count_threshold):
+def countPaths(pathsFilename, orders, count_threshold, cache=None):
+    with metrics.stage("parse", filename=pathsFilename, orders=orders) as stage:
+        if cache is None:
+            stage.rows = parsePathsToStates(pathsFilename, orders, count_threshold)
+        else:
+            stage.rows = countPathsCached(pathsFilename, orders, count_threshold, cache)
+
+def runSingle(pathsFilename, orders, count_threshold, cache=None, matrix=False):
+    countPaths(pathsFilename, orders, count_threshold, cache)
+
+    for order in orders:
+        outname = "data/{}_states_{}.net".format(getNameWithoutPath(pathsFilename), order)
+        writeStates(outname, order, matrix=matrix)
+
+def run(year, orders, quarters, count_threshold, cache=None, matrix=False, pathsFilenames=None):
+    """ Count the states of the paths of each quarter, from pathsFilenames in
+    the same order as quarters if given and else from getFilename """
     quartersString = "".join(map(str, quarters))
-    for quarter in quarters:
+    for i, quarter in enumerate(quarters):
         print("Collecting paths from quarter {}...".format(quarter))
-        pathsFilename = getFilename(year, quarter)
-        parsePathsToStates(pathsFilename, order, count_threshold)
-
-    outname = "data/{}_{}_states_{}.net".format(year, quartersString, order)
-    if order == 1:
-        # writeFirstOrderNetwork("{}_{}_pajek.net".format(year, quartersString))
-        writeFirstOrderStates(outname)
-    elif order == 2:
-        writeSecondOrderStates(outname)
-    elif order == 3:
-        writeThirdOrderStates(outname)
+        pathsFilename = pathsFilenames[i] if pathsFilenames else getFilename(year, quarter)
+        countPaths(pathsFilename, orders, count_threshold, cache)
+
+    for order in orders:
+        outname = "data/{}_{}_states_{}.net".format(year, quartersString, order)
+        writeStates(outname, order, matrix=matrix)
     print('\n== Finished at', strftime("%Y-%m-%d %H:%M:%S", gmtime()), '== \n')
 
 
 def main(argv):
     parser = argparse.ArgumentParser(description='Paths to states format.')
     parser.add_argument('input', nargs='?', help='optional input paths file to use instead of from args')
-    parser.add_argument('-o', '--order', type=int, help='markov order (default: 1)', default=1)
+    parser.add_argument('-o', '--order', type=int, nargs='+', help='markov order, give many to generate each from one pass over the paths (default: 1)', default=[1])
     parser.add_argument('-y', '--year', required=True, type=int, help='year', default=1)
     parser.add_argument('-q', '--quarter', required=True, help='quarter (1-4), use multiple times for many quarters', type=int, action='append')
     parser.add_argument('-c', '--count-threshold', type=int, help='Ignore paths with count less than this threshold (default: 2)', default=2)
+    parser.add_argument('--cache-dir', default='data/cache', help='Directory to cache state counts per paths file in (default: data/cache)')
+    parser.add_argument('--cache-size', type=int, default=states_cache.DEFAULT_CACHE_SIZE, help='Max size of the cache in MB, least recently used counts are removed (default: {})'.format(states_cache.DEFAULT_CACHE_SIZE))
+    parser.add_argument('-p', '--paths', action='append', help='paths file of each quarter in the same order as -q, instead of data/{year}_{quarter}_Coupon_paths.bin or .net')
+    parser.add_argument('--no-cache', action='store_true', help='Count states from the paths without using the cache')
+    parser.add_argument('--matrix', action='store_true', help='Also write each network as a sparse matrix with the physical node of each state to a .npz file')
+    metrics.addArguments(parser)
 
     args = parser.parse_args()
-    t0, t1 = time.clock(), time.time()
+    if args.paths and len(args.paths) != len(args.quarter):
+        parser.error("give one paths file with -p for each quarter")
+    metrics.configure(args)
     print("==== Starting ====")
     print("  order: {}".format(args.order))
     print("  year: {}".format(args.year))
     print("  quarter: {}".format(args.quarter))
     print("  count_threshold: {}".format(args.count_threshold))
+    cache = None if args.no_cache else StatesCache(args.cache_dir, args.cache_size)
     if args.input:
-        runSingle(args.input, args.order, args.count_threshold)
+        runSingle(args.input, args.order, args.count_threshold, cache, args.matrix)
     else:
-        run(args.year, args.order, args.quarter, args.count_threshold)
+        run(args.year, args.order, args.quarter, args.count_threshold, cache, args.matrix, args.paths)
 
-    print("Max memory usage: {} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6))
-    print("Clock time:     {}".format(time.clock() - t0))
-    print("Wall time:      {}".format(time.time() - t1))
-    print("User mode time: {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_utime))
-    print("System time:    {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_stime))
+    metrics.printSummary()
 
 if __name__ == "__main__":
    main(sys.argv[1:])
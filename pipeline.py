@@ -0,0 +1,337 @@
+""" Run the whole pipeline from coupon csv files to multilayer networks
+
+A JSON spec with years, quarters, orders, layer groupings and relax rates
+is expanded to a graph of tasks, each running one of the scripts as its
+own process:
+
+    make_paths.py                   one per year and quarter
+    paths_to_states.py              one per year and group of quarters, all orders in one pass
+    states_to_multilayer_states.py  one per year, grouping with many layers and order, all relax rates in one pass
+    Infomap                         optional, one per network
+
+A task is skipped if its command and the content of its inputs and outputs
+are the same as when it last succeeded, so only tasks depending on a
+changed file run again. Content hashes are remembered in the state file
+together with size and modification time, to not hash unchanged files
+again. Independent tasks run concurrently with at most --workers processes
+and --max-memory MB, estimated by the peak memory of the last run of each
+task. This module doesn't import numpy, as the peak memory of a child
+includes the memory of this process when started.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from time import gmtime, strftime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SPEC = {
+    'years': [2011],
+    'quarters': [1, 2, 3, 4],
+    'orders': [1, 2, 3],
+    # Groups of quarters separated by comma, one layer per group
+    'layers': ["1234", "12,34", "1,2,3,4"],
+    'relaxRates': [0.25],
+    'countThreshold': 2,
+    'engine': 'memory',
+    'binary': False,
+    'zip': False,
+    'minimal': False,
+    # Optional, like {"command": "./Infomap", "args": ["-i", "states", "-zd", "-N10"], "outDir": "data", "outputs": ["tree"]}
+    'infomap': None,
+}
+
+# Memory estimate in MB of tasks that have not run before
+DEFAULT_MEMORY = 1000
+
+class Task:
+    def __init__(self, name, command, inputs, outputs, deps=()):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.deps = list(deps)
+
+def getCouponFilename(year, quarter, minimal=False, zipped=False):
+    """ As getFilename in make_paths_batch.py """
+    return "data/{}_{}_Coupon{}.{}".format(year, quarter, "_min" if minimal else "", "zip" if zipped else "csv")
+
+def getSweepFilename(outFilename, relaxRate):
+    """ As getSweepFilename in states_to_multilayer_states.py """
+    name, dot, extension = outFilename.rpartition('.')
+    if not dot or '/' in extension:
+        return "{}_r{}".format(outFilename, relaxRate)
+    return "{}_r{}.{}".format(name, relaxRate, extension)
+
+def parseGrouping(grouping):
+    """ Parse a layer grouping like '12,34' to quarter groups ['12', '34'] """
+    groups = [group.strip() for group in str(grouping).split(',')]
+    if not all(group.isdigit() and set(group) <= set("1234") for group in groups):
+        sys.exit("Invalid layer grouping '{}', expected groups of quarters 1-4 separated by comma".format(grouping))
+    return groups
+
+def python(script, *args):
+    return [sys.executable, os.path.join(SCRIPT_DIR, script)] + list(args)
+
+def buildTasks(spec):
+    """ Return the tasks of spec in an order where each task comes after its dependencies """
+    tasks = []
+    pathsTasks = {}
+    statesTasks = {}
+    orders = spec['orders']
+    relaxRates = spec['relaxRates']
+    networks = []
+    for year in spec['years']:
+        groupings = [parseGrouping(grouping) for grouping in spec['layers']]
+        quarters = sorted(set(spec['quarters']) | {int(quarter) for groups in groupings for group in groups for quarter in group})
+        for quarter in quarters:
+            csvFilename = getCouponFilename(year, quarter, spec['minimal'], spec['zip'])
+            pathsFilename = "data/{}_{}_Coupon_paths.{}".format(year, quarter, "bin" if spec['binary'] else "net")
+            args = [csvFilename, pathsFilename, "-e", spec['engine']] + (["-b"] if spec['binary'] else [])
+            task = Task("paths_{}_{}".format(year, quarter), python("make_paths.py", *args), [csvFilename], [pathsFilename])
+            pathsTasks[(year, quarter)] = task
+            tasks.append(task)
+
+        for groups in groupings:
+            for group in groups:
+                if (year, group) in statesTasks:
+                    continue
+                deps = [pathsTasks[(year, int(quarter))] for quarter in group]
+                args = ["-y", str(year), "-o"] + list(map(str, orders)) + ["-c", str(spec['countThreshold'])]
+                # Give the paths files to not read a stale .bin or .net file of the other format
+                for quarter, dep in zip(group, deps):
+                    args += ["-q", quarter, "-p", dep.outputs[0]]
+                outputs = ["data/{}_{}_states_{}.net".format(year, group, order) for order in orders]
+                task = Task("states_{}_{}".format(year, group), python("paths_to_states.py", *args),
+                    [dep.outputs[0] for dep in deps], outputs, deps)
+                statesTasks[(year, group)] = task
+                tasks.append(task)
+
+        for groups in groupings:
+            if len(groups) == 1:
+                networks += [(statesTasks[(year, groups[0])], output) for output in statesTasks[(year, groups[0])].outputs]
+                continue
+            for order in orders:
+                deps = [statesTasks[(year, group)] for group in groups]
+                inputs = ["data/{}_{}_states_{}.net".format(year, group, order) for group in groups]
+                outFilename = "data/{}_{}_states_{}.net".format(year, "_".join(groups), order)
+                outputs = [getSweepFilename(outFilename, relaxRate) for relaxRate in relaxRates]
+                args = inputs + [outputs[0] if len(outputs) == 1 else outFilename, "-r"] + list(map(str, relaxRates))
+                task = Task("multilayer_{}_{}_o{}".format(year, "_".join(groups), order),
+                    python("states_to_multilayer_states.py", *args), inputs, outputs, deps)
+                tasks.append(task)
+                networks += [(task, output) for output in outputs]
+
+    infomap = spec.get('infomap')
+    if infomap:
+        outDir = infomap.get('outDir', "data")
+        for dep, network in networks:
+            name = os.path.basename(network).rsplit(".", maxsplit=1)[0]
+            outputs = [os.path.join(outDir, "{}.{}".format(name, extension)) for extension in infomap.get('outputs', ["tree"])]
+            tasks.append(Task("infomap_{}".format(name), [infomap['command'], network, outDir] + list(infomap.get('args', [])),
+                [network], outputs, [dep]))
+    return tasks
+
+def readSpec(filename):
+    spec = dict(DEFAULT_SPEC)
+    if filename:
+        with open(filename, mode='r') as infile:
+            spec.update(json.load(infile))
+    unknown = set(spec) - set(DEFAULT_SPEC)
+    if unknown:
+        sys.exit("Unknown spec keys: {}".format(", ".join(sorted(unknown))))
+    return spec
+
+
+class PipelineState:
+    """ Content hashes of files and the last successful run of each task, saved as JSON """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename, mode='r') as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            data = {}
+        self.files = data.get('files', {})
+        self.tasks = data.get('tasks', {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        tmpFilename = self.filename + ".tmp"
+        with open(tmpFilename, mode='w') as outfile:
+            json.dump({'files': self.files, 'tasks': self.tasks}, outfile, indent=2)
+        os.replace(tmpFilename, self.filename)
+
+    def fileHash(self, filename):
+        """ Content hash of filename or None if missing, reused while its size and modification time are unchanged """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        path = os.path.abspath(filename)
+        entry = self.files.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['hash']
+        print("Hashing {}...".format(filename))
+        sha1 = hashlib.sha1()
+        with open(filename, mode='rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                sha1.update(block)
+        self.files[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': sha1.hexdigest()}
+        return sha1.hexdigest()
+
+    def getHashes(self, filenames):
+        return {filename: self.fileHash(filename) for filename in filenames}
+
+    def isUpToDate(self, task):
+        record = self.tasks.get(task.name)
+        if record is None or record['command'] != task.command[1:]:
+            return False
+        return record['inputs'] == self.getHashes(task.inputs) and record['outputs'] == self.getHashes(task.outputs)
+
+    def getMemory(self, task):
+        record = self.tasks.get(task.name)
+        return record['maxMemory'] if record else DEFAULT_MEMORY
+
+    def setDone(self, task, wallTime, maxMemory):
+        self.tasks[task.name] = {
+            # Without the python executable to not run everything again with another python
+            'command': task.command[1:],
+            'inputs': self.getHashes(task.inputs),
+            'outputs': self.getHashes(task.outputs),
+            'wallTime': wallTime,
+            'maxMemory': maxMemory,
+            'date': strftime("%Y-%m-%d %H:%M:%S", gmtime()),
+        }
+        self.save()
+
+
+def startTask(task, logDir, metricsFilename):
+    os.makedirs(logDir, exist_ok=True)
+    logFile = open(os.path.join(logDir, "{}.log".format(task.name)), mode='w')
+    command = list(task.command)
+    if metricsFilename and command[0] == sys.executable:
+        command += ["--metrics", metricsFilename]
+    process = subprocess.Popen(command, stdout=logFile, stderr=subprocess.STDOUT)
+    return process, logFile
+
+def plan(tasks, state, force=False):
+    """ Print which tasks would run, tasks after a task to run are assumed to run too """
+    toRun = set()
+    for task in tasks:
+        if force or any(dep.name in toRun for dep in task.deps) or not state.isUpToDate(task):
+            toRun.add(task.name)
+            print("  {:<40} run: {}".format(task.name, " ".join(task.command[1:])))
+        else:
+            print("  {:<40} up to date".format(task.name))
+    print("{} of {} tasks to run".format(len(toRun), len(tasks)))
+
+def runTasks(tasks, state, workers, maxMemory, logDir, force=False, metricsFilename=None):
+    """ Run tasks not up to date, with at most workers processes and maxMemory MB at once.
+    Returns the names of the failed tasks """
+    pending = list(tasks)
+    done, failed = set(), set()
+    running = {}
+    while pending or running:
+        usedMemory = sum(memory for _, _, _, _, memory in running.values())
+        for task in list(pending):
+            if any(dep.name in failed for dep in task.deps):
+                print("Skip {}, a dependency failed".format(task.name))
+                failed.add(task.name)
+                pending.remove(task)
+                continue
+            if not all(dep.name in done for dep in task.deps):
+                continue
+            if not force and state.isUpToDate(task):
+                print("Up to date {}".format(task.name))
+                done.add(task.name)
+                pending.remove(task)
+                continue
+            memory = state.getMemory(task)
+            if len(running) >= workers or (running and maxMemory and usedMemory + memory > maxMemory):
+                continue
+            print("Run {} (~{:.0f} MB)...".format(task.name, memory))
+            process, logFile = startTask(task, logDir, metricsFilename)
+            running[process.pid] = (task, process, logFile, time.time(), memory)
+            usedMemory += memory
+            pending.remove(task)
+        if not running:
+            if pending:
+                print("Could not run {} tasks".format(len(pending)))
+                failed.update(task.name for task in pending)
+            break
+        # wait4 gives the resource usage of only the finished child
+        pid, status, rusage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+        task, process, logFile, t1, _ = running.pop(pid)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        logFile.close()
+        wallTime = time.time() - t1
+        # ru_maxrss is in kilobytes on Linux
+        taskMemory = rusage.ru_maxrss / 1e3
+        missing = [output for output in task.outputs if not os.path.exists(output)]
+        if process.returncode != 0 or missing:
+            print("Failed {} with exit code {}{}, see {}".format(task.name, process.returncode,
+                ", missing " + ", ".join(missing) if missing else "", logFile.name))
+            failed.add(task.name)
+        else:
+            print("Done {} in {:.1f}s, {:.1f} MB".format(task.name, wallTime, taskMemory))
+            state.setDone(task, wallTime, taskMemory)
+            done.add(task.name)
+    state.save()
+    return failed
+
+
+def run(specFilename, stateFilename, workers, maxMemory, logDir, force=False, dryRun=False, only=None, metricsFilename=None):
+    t1 = time.time()
+    spec = readSpec(specFilename)
+    tasks = buildTasks(spec)
+    if only:
+        tasks = selectTasks(tasks, only)
+    state = PipelineState(stateFilename)
+    if dryRun:
+        plan(tasks, state, force)
+        return True
+    print("Run {} tasks with {} workers{}...".format(len(tasks), workers, " and {} MB".format(maxMemory) if maxMemory else ""))
+    failed = runTasks(tasks, state, workers, maxMemory, logDir, force, metricsFilename)
+    if failed:
+        print("Failed tasks: {}".format(", ".join(sorted(failed))))
+    print("Done in {} seconds!".format(time.time() - t1))
+    return not failed
+
+def selectTasks(tasks, names):
+    """ Tasks with a name starting with any of names, and their dependencies """
+    byName = {task.name: task for task in tasks}
+    selected = set()
+    stack = [task.name for task in tasks if any(task.name.startswith(name) for name in names)]
+    while stack:
+        name = stack.pop()
+        if name not in selected:
+            selected.add(name)
+            stack.extend(dep.name for dep in byName[name].deps)
+    return [task for task in tasks if task.name in selected]
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run the pipeline from coupon csv files to multilayer networks.')
+    parser.add_argument('spec', nargs='?', help='JSON file with years, quarters, orders, layers and relaxRates (default: see pipeline.py)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='Max number of tasks to run at once (default: number of cpus)')
+    parser.add_argument('-m', '--max-memory', type=int, help='Max total memory in MB of tasks running at once, estimated by their last run (default: no limit)')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Print the tasks that would run')
+    parser.add_argument('-f', '--force', action='store_true', help='Run all tasks even if up to date')
+    parser.add_argument('-t', '--tasks', nargs='+', help='Only run tasks with names starting with these, and their dependencies')
+    parser.add_argument('--state', default='data/pipeline_state.json', help='File with content hashes of the last runs (default: data/pipeline_state.json)')
+    parser.add_argument('--log-dir', default='data/logs', help='Directory for the output of each task (default: data/logs)')
+    parser.add_argument('--metrics', help='Pass --metrics to the scripts to append their stage metrics to this file, see metrics.py')
+
+    args = parser.parse_args()
+    if not run(args.spec, args.state, args.workers, args.max_memory, args.log_dir, args.force, args.dry_run, args.tasks, args.metrics):
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -1,10 +1,11 @@
 
 import csv, json
 import sys, getopt
-import resource, time
 from time import gmtime, strftime
 from collections import Counter
 
+import metrics
+
 PREZIPPED = True
 # PREZIPPED = False
 infilename = 'data/2011_1_Coupon.csv'
@@ -53,14 +54,10 @@ def sortCsv(filename):
 
 def run():
     print('\n==== Starting ==== \n')
-    t0, t1 = time.clock(), time.time()
-    sortCsv(infilename)
+    with metrics.stage("sort", filename=infilename):
+        sortCsv(infilename)
     print('Done!')
-    print("Max memory usage: {} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6))
-    print("Clock time:       {}".format(time.clock() - t0))
-    print("Wall time:        {}".format(time.time() - t1))
-    print("User mode time:   {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_utime))
-    print("System time:      {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_stime))
+    metrics.printSummary()
     print('\n== Finished at', strftime("%Y-%m-%d %H:%M:%S", gmtime()), '== \n')
 
 def test():
@@ -0,0 +1,143 @@
+""" Stationary flow on state networks without Infomap
+
+Computes the flow of each state node by power iteration over the link arrays
+of a states network, with teleportation like Infomap with -d: with probability
+alpha from each node and always from dangling nodes, to nodes uniformly or
+proportional to their out-weight. Like Infomap, the teleportation is by
+default unrecorded, the flow of a node being the flow on its incoming links.
+The flow of the state nodes is summed per physical node, to rank for example
+airports by flow. Reads states networks in the text format or the .npz
+sparse matrices written with --matrix.
+"""
+
+import argparse
+import csv
+import sys
+import time
+from collections import namedtuple
+import numpy as np
+
+import network_io
+
+Flow = namedtuple('Flow', ['nodeFlow', 'iterations', 'error'])
+
+FLOW_MODELS = ['directed', 'undirected', 'rawdir']
+
+def readNetwork(filename):
+    """ Read a states network from a .npz sparse matrix or a text file, with
+    the state ids mapped to the indices 0..n-1 of the states """
+    if filename.endswith(".npz"):
+        return network_io.readSparseStates(filename)
+    network = network_io.readStates(filename)
+    order = np.argsort(network.stateIds, kind='stable')
+    stateIds = network.stateIds[order]
+    sourceIndex = np.searchsorted(stateIds, network.sources)
+    targetIndex = np.searchsorted(stateIds, network.targets)
+    sourceIndex[sourceIndex == len(stateIds)] = 0
+    targetIndex[targetIndex == len(stateIds)] = 0
+    if not (np.array_equal(stateIds[sourceIndex], network.sources) and np.array_equal(stateIds[targetIndex], network.targets)):
+        sys.exit("Links between undefined states in {}".format(filename))
+    return network._replace(stateIds=stateIds, physIds=network.physIds[order], sources=sourceIndex, targets=targetIndex)
+
+def getFlow(numNodes, sources, targets, weights, flowModel='directed', alpha=0.15, recordedTeleportation=False,
+        toLinks=False, tolerance=1e-15, maxIterations=200):
+    """ Return the Flow of the nodes 0..numNodes-1 with the links in the arrays
+    sources, targets and weights, summing to 1 """
+    weights = np.asarray(weights, dtype=np.float64)
+    if numNodes == 0 or weights.sum() == 0:
+        return Flow(np.full(numNodes, 1.0 / numNodes) if numNodes else np.zeros(0), 0, 0.0)
+    if flowModel == 'undirected':
+        nodeFlow = np.bincount(sources, weights, minlength=numNodes) + np.bincount(targets, weights, minlength=numNodes)
+        return Flow(nodeFlow / nodeFlow.sum(), 0, 0.0)
+    if flowModel == 'rawdir':
+        nodeFlow = np.bincount(targets, weights, minlength=numNodes)
+        return Flow(nodeFlow / nodeFlow.sum(), 0, 0.0)
+    outWeight = np.bincount(sources, weights, minlength=numNodes)
+    isDangling = outWeight == 0
+    # Nodes with only links of weight 0 are dangling, with no flow on those links
+    transition = np.divide(weights, outWeight[sources], out=np.zeros(len(weights)), where=outWeight[sources] > 0)
+    if toLinks:
+        teleportWeight = outWeight / outWeight.sum()
+    else:
+        teleportWeight = np.full(numNodes, 1.0 / numNodes)
+    nodeFlow = np.full(numNodes, 1.0 / numNodes)
+    error = 1.0
+    iterations = 0
+    while iterations < maxIterations and error > tolerance:
+        danglingFlow = nodeFlow[isDangling].sum()
+        teleportFlow = alpha * (1.0 - danglingFlow) + danglingFlow
+        newFlow = np.bincount(targets, nodeFlow[sources] * transition, minlength=numNodes) * (1.0 - alpha)
+        newFlow += teleportFlow * teleportWeight
+        newFlow /= newFlow.sum()
+        error = float(np.abs(newFlow - nodeFlow).sum())
+        nodeFlow = newFlow
+        iterations += 1
+    if not recordedTeleportation:
+        # Flow on the links without the teleportation steps
+        nodeFlow = np.bincount(targets, nodeFlow[sources] * transition, minlength=numNodes)
+        nodeFlow /= nodeFlow.sum()
+    return Flow(nodeFlow, iterations, error)
+
+def getPhysicalFlow(physIds, nodeFlow):
+    """ Return (physical ids, flow, number of states) ordered by decreasing flow """
+    ids, physIndex = np.unique(physIds, return_inverse=True)
+    physIndex = physIndex.ravel()
+    flow = np.bincount(physIndex, nodeFlow, minlength=len(ids))
+    numStates = np.bincount(physIndex, minlength=len(ids))
+    order = np.argsort(-flow, kind='stable')
+    return ids[order], flow[order], numStates[order]
+
+def writeFlow(filename, header, columns):
+    print('Write flow to "{}"...'.format(filename))
+    with open(filename, mode='w') as outfile:
+        writer = csv.writer(outfile, delimiter='\t', lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(zip(*[column.tolist() for column in columns]))
+
+def run(filename, flowModel='directed', alpha=0.15, recordedTeleportation=False, toLinks=False, top=20,
+        outFilename=None, statesFilename=None, tolerance=1e-15, maxIterations=200):
+    t1 = time.time()
+    print("Read network from {}...".format(filename))
+    network = readNetwork(filename)
+    numStates = len(network.physIds)
+    print("Calculate {} flow on {} state nodes and {} links...".format(flowModel, numStates, len(network.weights)))
+    flow = getFlow(numStates, network.sources, network.targets, network.weights, flowModel, alpha,
+        recordedTeleportation, toLinks, tolerance, maxIterations)
+    if flowModel == 'directed':
+        print("Power iterations: {}, error: {}".format(flow.iterations, flow.error))
+        if flow.error > tolerance:
+            print("Warning: flow not converged in {} iterations".format(maxIterations), file=sys.stderr)
+    physIds, physFlow, physStates = getPhysicalFlow(network.physIds, flow.nodeFlow)
+    isDangling = np.bincount(network.sources, network.weights, minlength=numStates) == 0
+    print("Physical nodes: {}, dangling state nodes: {}, state nodes without flow: {}".format(
+        len(physIds), int(isDangling.sum()), int(np.sum(flow.nodeFlow == 0))))
+    print("Top {} physical nodes by flow:".format(min(top, len(physIds))))
+    print("  {:>10} {:>12} {:>8}".format("physId", "flow", "states"))
+    for physId, nodeFlow, states in zip(physIds[:top].tolist(), physFlow[:top].tolist(), physStates[:top].tolist()):
+        print("  {:>10} {:>12.6f} {:>8}".format(physId, nodeFlow, states))
+    if outFilename:
+        writeFlow(outFilename, ['physId', 'flow', 'states'], [physIds, physFlow, physStates])
+    if statesFilename:
+        writeFlow(statesFilename, ['stateId', 'physId', 'flow'], [network.stateIds, network.physIds, flow.nodeFlow])
+    print("Done in {} seconds!".format(time.time() - t1))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Calculate the stationary flow of a state network.')
+    parser.add_argument('network', help='input states network, a .net file or a .npz sparse matrix written with --matrix')
+    parser.add_argument('-f', '--flow-model', choices=FLOW_MODELS, default='directed', help='Flow model like Infomap, directed (-d) with teleportation, undirected or raw directed link weights (default: directed)')
+    parser.add_argument('-p', '--teleportation-probability', type=float, default=0.15, help='Probability to teleport in each step of the directed flow (default: 0.15)')
+    parser.add_argument('--recorded-teleportation', action='store_true', help='Include the teleportation steps in the flow of the nodes')
+    parser.add_argument('--to-links', action='store_true', help='Teleport to nodes proportional to their out-weight instead of uniformly')
+    parser.add_argument('-n', '--top', type=int, default=20, help='Number of physical nodes with most flow to print (default: 20)')
+    parser.add_argument('-o', '--output', help='Write the flow of all physical nodes to this tab separated file')
+    parser.add_argument('-s', '--states-output', help='Write the flow of all state nodes to this tab separated file')
+    parser.add_argument('--tolerance', type=float, default=1e-15, help='Stop the power iteration when the flow changes less than this (default: 1e-15)')
+    parser.add_argument('--max-iterations', type=int, default=200, help='Max number of power iterations (default: 200)')
+
+    args = parser.parse_args()
+    run(args.network, args.flow_model, args.teleportation_probability, args.recorded_teleportation, args.to_links,
+        args.top, args.output, args.states_output, args.tolerance, args.max_iterations)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
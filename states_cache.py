@@ -0,0 +1,116 @@
+""" On-disk cache of arrays keyed by the content of an input file
+
+Entries are .npz files named by the sha1 of the input file and a key,
+so a changed input file gets new entries and never reads stale ones.
+The hash of each input file is remembered in index.json together with
+its size and modification time, to not hash unchanged files again.
+The least recently used entries are removed when the cache grows over
+its size limit.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+INDEX_FILENAME = "index.json"
+# Default max size of a cache in MB
+DEFAULT_CACHE_SIZE = 2000
+
+class StatesCache:
+    def __init__(self, cacheDir, maxSize=DEFAULT_CACHE_SIZE):
+        """ Cache in cacheDir using at most maxSize MB """
+        self.cacheDir = cacheDir
+        self.maxSize = int(maxSize * 1e6)
+        os.makedirs(cacheDir, exist_ok=True)
+        self.indexFilename = os.path.join(cacheDir, INDEX_FILENAME)
+        self.index = self.readIndex()
+
+    def readIndex(self):
+        try:
+            with open(self.indexFilename, mode='r') as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return {}
+
+    def fileHash(self, filename):
+        """ Content hash of filename, reused while its size and modification time are unchanged """
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        entry = self.index.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['hash']
+        print("Hashing {}...".format(filename))
+        sha1 = hashlib.sha1()
+        with open(filename, mode='rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                sha1.update(block)
+        # Keep the entries added by other processes sharing the cache since we read it
+        self.index.update(self.readIndex())
+        self.index[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': sha1.hexdigest()}
+        with self.atomicWrite(self.indexFilename, '.json', mode='w') as outfile:
+            json.dump(self.index, outfile, indent=2)
+        return sha1.hexdigest()
+
+    @contextmanager
+    def atomicWrite(self, filename, suffix, mode='wb'):
+        """ Open a temporary file with a name unique to this writer in the cache
+        directory, that replaces filename when closed without an error, so other
+        processes sharing the cache never see a partly written file """
+        fd, tmpFilename = tempfile.mkstemp(dir=self.cacheDir, suffix=suffix + ".tmp")
+        try:
+            with os.fdopen(fd, mode=mode) as outfile:
+                yield outfile
+            os.replace(tmpFilename, filename)
+        except BaseException:
+            os.remove(tmpFilename)
+            raise
+
+    def getEntryFilename(self, filename, key):
+        return os.path.join(self.cacheDir, "{}_{}.npz".format(self.fileHash(filename), key))
+
+    def load(self, filename, key):
+        """ Return dict of arrays cached for filename and key, or None if not cached """
+        entryFilename = self.getEntryFilename(filename, key)
+        try:
+            with np.load(entryFilename) as data:
+                arrays = dict(data)
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used, unless evicted by another process since it was read
+        try:
+            os.utime(entryFilename)
+        except FileNotFoundError:
+            pass
+        return arrays
+
+    def save(self, filename, key, arrays):
+        """ Cache dict of arrays for filename and key """
+        entryFilename = self.getEntryFilename(filename, key)
+        with self.atomicWrite(entryFilename, '.npz') as outfile:
+            np.savez(outfile, **arrays)
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits in its size limit """
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.cacheDir, name))
+                except FileNotFoundError:
+                    # Evicted by another process sharing the cache
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+            print("Evicting {} from cache...".format(name))
+            try:
+                os.remove(os.path.join(self.cacheDir, name))
+            except FileNotFoundError:
+                pass
+            totalSize -= size
@@ -1,11 +1,18 @@
 import argparse
 import csv, json
-import sys, getopt
-import resource, time
+import sys, getopt, os
+import shutil, tempfile
 from time import gmtime, strftime
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, namedtuple
 import re
-import networkx as nx
+from multiprocessing import Pool, shared_memory
+import numpy as np
+import metrics
+import network_io
+try:
+    import networkx as nx
+except ImportError:
+    nx = None
 
 stateNodes = Counter()
 stateLinks = Counter()
@@ -15,6 +22,15 @@ outDegreePerNode = defaultdict(float)
 outDegreePerNodePerLayer = {}
 multiStateNameToStateId = {}
 
+# Sparse engine, state names are indexed in a shared index over all layers
+stateNameIndex = {}
+stateNames = []
+layers = []
+# Links of a layer are kept as arrays of shared state indices
+StateLayer = namedtuple('StateLayer', ['nodes', 'physIds', 'sources', 'targets', 'weights'])
+# Multilayer links with the layer weight and out degrees of the source to relax them
+LinkArrays = namedtuple('LinkArrays', ['sources', 'targets', 'weights', 'outDegree', 'layerOutDegree', 'isIntra'])
+
 def parseStates(filename):
     """ Parse states network with format
     *states
@@ -31,52 +47,298 @@ def parseStates(filename):
     stateIdToName = {}
     outDegree = defaultdict(float)
     outDegreePerNodePerLayer[graphId] = outDegree
-    with open(filename, mode='r') as infile:
-        lineNr = 0
-        isStates = False
-        isLinks = False
-        reState = re.compile(r'(\d+) (\d+) "(.+)"')
-        for line in infile:
-            if line[0] == '#':
-                continue
-            if isLinks:
-                link = line.split()
-                # print("link:", link)
-                # g.add_edge(int(link[0]), int(link[1]), weight=float(link[2]))
-                sourceId, targetId, weight = int(link[0]), int(link[1]), float(link[2])
-                # sourceId = int(link[0])
-                # targetId = int(link[1])
-                # weight = float(link[2])
-                g.add_edge(stateIdToName[sourceId], stateIdToName[targetId], weight=weight)
-                g.graph['outDegree'] += weight
-                outDegreePerNode[stateIdToName[sourceId]] += weight
-                outDegree[stateIdToName[sourceId]] += weight
-            elif isStates:
-                if line.startswith("*links"):
-                    isLinks = True
-                    print("Parsing links...")
-                    continue
-                m = reState.match(line)
-                if not m:
-                    print("Line not matching a state node: '{}'".format(line))
-                    sys.exit(1)
-                stateId, physId, name = int(m.group(1)), int(m.group(2)), m.group(3)
-                stateIdToName[stateId] = name
-                # print("state node {} {}, name: {}".format(m.group(1), m.group(2), m.group(3)))
-                # Index node by name
-                g.add_node(name, stateId=stateId, physId=physId, name=name, graphId=graphId)
-            else:
-                if line.startswith("*states"):
-                    print("Parsing state nodes...")
-                    isStates = True
-            lineNr += 1
-            if lineNr % 10000 == 0:
-                print("Processed {} rows...".format(lineNr))
+    network = network_io.readStates(filename)
+    for stateId, physId, name in zip(network.stateIds.tolist(), network.physIds.tolist(), network.names):
+        stateIdToName[stateId] = name
+        # Index node by name
+        g.add_node(name, stateId=stateId, physId=physId, name=name, graphId=graphId)
+    for sourceId, targetId, weight in zip(network.sources.tolist(), network.targets.tolist(), network.weights.tolist()):
+        g.add_edge(stateIdToName[sourceId], stateIdToName[targetId], weight=weight)
+        g.graph['outDegree'] += weight
+        outDegreePerNode[stateIdToName[sourceId]] += weight
+        outDegree[stateIdToName[sourceId]] += weight
     print("Done parsing state network with {} state nodes and {} links!".format(g.number_of_nodes(), g.number_of_edges()))
     # print("Nodes:", g.nodes(data=True))
     # print("Edges:", g.edges(data=True))
 
 
+def readStates(filename):
+    network = network_io.readStates(filename)
+    print("Done parsing state network with {} state nodes and {} links!".format(len(network.names), len(network.weights)))
+    return network
+
+def addStateLayer(network):
+    """ Add a StatesNetwork from network_io.readStates as a StateLayer in layers """
+    nodes = np.empty(len(network.names), dtype=np.int64)
+    for i, name in enumerate(network.names):
+        index = stateNameIndex.get(name)
+        if index is None:
+            index = stateNameIndex[name] = len(stateNames)
+            stateNames.append(name)
+        nodes[i] = index
+    # Map state ids of the links to shared state indices
+    idOrder = np.argsort(network.stateIds, kind='stable')
+    def getNodes(ids):
+        return nodes[idOrder[np.searchsorted(network.stateIds, ids, sorter=idOrder)]]
+    layers.append(StateLayer(nodes, network.physIds, getNodes(network.sources), getNodes(network.targets), network.weights))
+
+def parseStatesSparse(filename):
+    """ Parse states network like parseStates to a StateLayer in layers """
+    addStateLayer(readStates(filename))
+
+
+class SparseMultilayerNetwork:
+    """ Multilayer network of the parsed layers, with the same state nodes and links
+    as generateMultilayerNetwork, but with each layer as a CSR matrix over the shared
+    state index instead of building the network.
+
+    A multilayer state node is a state node of one layer. It links to the targets of
+    its state in every layer, weighted by relaxRate over the total out degree of the
+    state over all layers, plus 1 - relaxRate over its out degree in its own layer
+    for links in its own layer.
+    """
+
+    def __init__(self, layers, numStates):
+        self.numLayers = len(layers)
+        self.outDegree = np.zeros(numStates)
+        self.layerOutDegree = []
+        self.indptr = []
+        self.targets = []
+        self.weights = []
+        # Multilayer state id of each shared state in each layer, -1 if not in layer
+        self.multiIds = []
+        numNodes = 0
+        for layer in layers:
+            order = np.argsort(layer.sources, kind='stable')
+            indptr = np.zeros(numStates + 1, dtype=np.int64)
+            np.cumsum(np.bincount(layer.sources, minlength=numStates), out=indptr[1:])
+            self.indptr.append(indptr)
+            self.targets.append(layer.targets[order])
+            self.weights.append(layer.weights[order])
+            outDegree = np.bincount(layer.sources, weights=layer.weights, minlength=numStates)
+            self.layerOutDegree.append(outDegree)
+            self.outDegree += outDegree
+            multiIds = np.full(numStates, -1, dtype=np.int64)
+            multiIds[layer.nodes] = np.arange(numNodes, numNodes + len(layer.nodes))
+            self.multiIds.append(multiIds)
+            numNodes += len(layer.nodes)
+        self.numNodes = numNodes
+        # Layer and shared state of each multilayer state id
+        self.nodeLayers = np.repeat(np.arange(len(layers)), [len(layer.nodes) for layer in layers])
+        self.nodeStates = np.concatenate([layer.nodes for layer in layers]) if layers else np.empty(0, dtype=np.int64)
+        self.physIds = np.concatenate([layer.physIds for layer in layers]) if layers else np.empty(0, dtype=np.int64)
+
+    def getArrays(self):
+        """ Return all arrays of the network by name, to share with fromArrays """
+        arrays = {'outDegree': self.outDegree, 'nodeLayers': self.nodeLayers, 'nodeStates': self.nodeStates, 'physIds': self.physIds}
+        for name in ['layerOutDegree', 'indptr', 'targets', 'weights', 'multiIds']:
+            for layer, data in enumerate(getattr(self, name)):
+                arrays["{}_{}".format(name, layer)] = data
+        return arrays
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        """ Network using the arrays from getArrays """
+        network = cls.__new__(cls)
+        for name in ['outDegree', 'nodeLayers', 'nodeStates', 'physIds']:
+            setattr(network, name, arrays[name])
+        network.numLayers = sum(1 for name in arrays if name.startswith('indptr_'))
+        for name in ['layerOutDegree', 'indptr', 'targets', 'weights', 'multiIds']:
+            setattr(network, name, [arrays["{}_{}".format(name, layer)] for layer in range(network.numLayers)])
+        network.numNodes = len(network.nodeStates)
+        return network
+
+    def getLinks(self, sources):
+        """ Return LinkArrays of the links from the multilayer state ids in sources,
+        ordered by source, then target layer and then order in layer """
+        nodeLayers = self.nodeLayers[sources]
+        states = self.nodeStates[sources]
+        hasOutDegree = self.outDegree[states] != 0
+        layerOutDegree = np.zeros(len(sources))
+        for layer1, outDegree in enumerate(self.layerOutDegree):
+            isLayer = nodeLayers == layer1
+            layerOutDegree[isLayer] = outDegree[states[isLayer]]
+        isIntraActive = hasOutDegree & (layerOutDegree != 0)
+        sourceIndex, targets, weights, isIntraLink = [], [], [], []
+        for layer2 in range(self.numLayers):
+            isIntra = nodeLayers == layer2
+            isActive = np.where(isIntra, isIntraActive, hasOutDegree)
+            indptr = self.indptr[layer2]
+            starts = indptr[states]
+            lengths = (indptr[states + 1] - starts) * isActive
+            numLinks = int(lengths.sum())
+            index = np.repeat(np.arange(len(sources)), lengths)
+            linkIndex = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(numLinks)
+            sourceIndex.append(index)
+            targets.append(self.multiIds[layer2][self.targets[layer2][linkIndex]])
+            weights.append(self.weights[layer2][linkIndex])
+            isIntraLink.append(isIntra[index])
+        sourceIndex = np.concatenate(sourceIndex)
+        order = np.argsort(sourceIndex, kind='stable')
+        sourceIndex = sourceIndex[order]
+        return LinkArrays(sources[sourceIndex], np.concatenate(targets)[order], np.concatenate(weights)[order],
+            self.outDegree[states][sourceIndex], layerOutDegree[sourceIndex], np.concatenate(isIntraLink)[order])
+
+    @staticmethod
+    def getLinkWeights(links, relaxRate):
+        """ Relaxed weights of LinkArrays, computed like generateMultilayerNetwork """
+        factor = relaxRate / links.outDegree
+        intra = links.isIntra
+        factor[intra] += (1.0 - relaxRate) / links.layerOutDegree[intra]
+        return factor * links.weights
+
+    def getChunkNodes(self, chunkStart, chunkEnd):
+        """ Return the multilayer state ids in order of first appearance as source
+        or target when adding the links of the sources from chunkStart to chunkEnd,
+        and the number of links """
+        sources = np.arange(chunkStart, chunkEnd)
+        links = self.getLinks(sources)
+        # Each source followed by its targets
+        blockLengths = np.bincount(links.sources - chunkStart, minlength=len(sources)) + 1
+        events = np.empty(int(blockLengths.sum()), dtype=np.int64)
+        isSource = np.zeros(len(events), dtype=bool)
+        isSource[np.cumsum(blockLengths) - blockLengths] = True
+        events[isSource] = sources
+        events[~isSource] = links.targets
+        uniqueEvents, firstIndex = np.unique(events, return_index=True)
+        return uniqueEvents[np.argsort(firstIndex)], len(links.targets)
+
+    def getChunks(self, batchSize):
+        return [(chunkStart, min(chunkStart + batchSize, self.numNodes)) for chunkStart in range(0, self.numNodes, batchSize)]
+
+    def getNodeOrder(self, batchSize=100000, pool=None):
+        """ Return multilayer state ids in order of first appearance as source
+        or target when adding links source by source, and the number of links """
+        chunks = self.getChunks(batchSize)
+        if pool is None:
+            chunkNodes = (self.getChunkNodes(*chunk) for chunk in chunks)
+        else:
+            chunkNodes = pool.imap(getSharedChunkNodes, chunks)
+        isSeen = np.zeros(self.numNodes, dtype=bool)
+        nodeOrder = []
+        numLinks = 0
+        for nodes, numChunkLinks in chunkNodes:
+            nodes = nodes[~isSeen[nodes]]
+            isSeen[nodes] = True
+            nodeOrder.append(nodes)
+            numLinks += numChunkLinks
+        return (np.concatenate(nodeOrder) if nodeOrder else np.empty(0, dtype=np.int64)), numLinks
+
+    def writeLinks(self, outfiles, sources, relaxRates):
+        """ Write the links of sources to each file in outfiles with the relax rate in relaxRates """
+        links = self.getLinks(sources)
+        sources, targets = links.sources.tolist(), links.targets.tolist()
+        for outfile, relaxRate in zip(outfiles, relaxRates):
+            network_io.writeLinks(outfile, sources, targets, self.getLinkWeights(links, relaxRate))
+
+    def write(self, outFilenames, relaxRates, batchSize=100000, pool=None):
+        """ Write network in the same order as writeMultilayerStateNetwork,
+        to each filename in outFilenames with the relax rate in relaxRates.
+        With a pool of workers attached to the network with attachNetwork,
+        the node order and links are generated in parallel in chunks of nodes """
+        nodeOrder, numLinks = self.getNodeOrder(batchSize, pool)
+        outfiles = [open(outFilename, mode='w') for outFilename in outFilenames]
+        try:
+            for outfile in outfiles:
+                print("Writing state network with {} state nodes and {} links to {}...".format(self.numNodes, numLinks, outfile.name))
+                outfile.write("*states {}\n".format(self.numNodes))
+            for batchStart in range(0, self.numNodes, batchSize):
+                nodes = nodeOrder[batchStart:batchStart + batchSize]
+                names = [stateNames[state] for state in self.nodeStates[nodes].tolist()]
+                lines = network_io.formatRows("%s %s \"%s %s\"\n", [nodes, self.physIds[nodes], self.nodeLayers[nodes], names])
+                for outfile in outfiles:
+                    outfile.write(lines)
+            for outfile in outfiles:
+                outfile.write("*links {}\n".format(numLinks))
+            if pool is None:
+                for batchStart in range(0, self.numNodes, batchSize):
+                    self.writeLinks(outfiles, nodeOrder[batchStart:batchStart + batchSize], relaxRates)
+            else:
+                # Each worker writes the links of a chunk of the node order to its own files, joined in order
+                for outfile in outfiles:
+                    outfile.flush()
+                chunkDir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outFilenames[0])))
+                try:
+                    tasks = [(chunkDir, chunkIndex, nodeOrder[batchStart:batchStart + batchSize], relaxRates)
+                        for chunkIndex, batchStart in enumerate(range(0, self.numNodes, batchSize))]
+                    for chunkFilenames in pool.imap(writeSharedLinks, tasks):
+                        for outfile, chunkFilename in zip(outfiles, chunkFilenames):
+                            with open(chunkFilename, mode='r') as chunkFile:
+                                shutil.copyfileobj(chunkFile, outfile, 1 << 20)
+                            os.remove(chunkFilename)
+                finally:
+                    shutil.rmtree(chunkDir, ignore_errors=True)
+        finally:
+            for outfile in outfiles:
+                outfile.close()
+        print("Done!")
+
+    def writeMatrix(self, outFilenames, relaxRates, batchSize=100000):
+        """ Write network as a sparse matrix over the multilayer state ids
+        to each filename in outFilenames with the relax rate in relaxRates """
+        sources, targets = [], []
+        weights = [[] for _ in relaxRates]
+        for chunkStart, chunkEnd in self.getChunks(batchSize):
+            links = self.getLinks(np.arange(chunkStart, chunkEnd))
+            sources.append(links.sources)
+            targets.append(links.targets)
+            for rateWeights, relaxRate in zip(weights, relaxRates):
+                rateWeights.append(self.getLinkWeights(links, relaxRate))
+        sources = np.concatenate(sources) if sources else np.empty(0, dtype=np.int64)
+        targets = np.concatenate(targets) if targets else np.empty(0, dtype=np.int64)
+        for outFilename, rateWeights in zip(outFilenames, weights):
+            print("Writing sparse matrix with {} state nodes and {} links to {}...".format(self.numNodes, len(targets), outFilename))
+            network_io.writeSparseStates(outFilename, self.physIds, sources, targets,
+                np.concatenate(rateWeights) if rateWeights else np.empty(0))
+
+
+# Network attached to shared memory in each worker process
+sharedNetwork = None
+sharedBlocks = []
+
+def shareArrays(arrays):
+    """ Copy arrays to shared memory, returns the SharedMemory blocks and
+    specs to attach to them with attachArrays """
+    blocks = []
+    specs = {}
+    for name, data in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[...] = data
+        blocks.append(block)
+        specs[name] = (block.name, data.shape, data.dtype.str)
+    return blocks, specs
+
+def attachArrays(specs):
+    blocks = []
+    arrays = {}
+    for name, (blockName, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=blockName)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return blocks, arrays
+
+def attachNetwork(specs):
+    """ Pool initializer, attach to the network arrays in shared memory """
+    global sharedNetwork, sharedBlocks
+    sharedBlocks, arrays = attachArrays(specs)
+    sharedNetwork = SparseMultilayerNetwork.fromArrays(arrays)
+
+def getSharedChunkNodes(chunk):
+    return sharedNetwork.getChunkNodes(*chunk)
+
+def writeSharedLinks(task):
+    """ Worker, write the links of a chunk of sources to one file per relax rate """
+    chunkDir, chunkIndex, sources, relaxRates = task
+    chunkFilenames = [os.path.join(chunkDir, "links_{}_{}.net".format(chunkIndex, rateIndex)) for rateIndex in range(len(relaxRates))]
+    outfiles = [open(chunkFilename, mode='w') for chunkFilename in chunkFilenames]
+    try:
+        sharedNetwork.writeLinks(outfiles, sources, relaxRates)
+    finally:
+        for outfile in outfiles:
+            outfile.close()
+    return chunkFilenames
+
+
 def generateMultilayerNetwork(relaxRate):
     print("Generate multilayer network from {} state networks...".format(len(graphs)))
     mg = nx.DiGraph(numLayers=len(graphs))
@@ -130,47 +392,203 @@ def writeMultilayerStateNetwork(network, outFilename):
     with open(outFilename, mode='w') as outfile:
         print("Writing state network with {} state nodes and {} links to {}...".format(numStateNodes, numLinks, outFilename))
         outfile.write("*states {}\n".format(numStateNodes))
-        for n, d in network.nodes_iter(data=True):
-            outfile.write("{} {} \"{}\"\n".format(multiStateNameToStateId[n], d['physId'], n))
+        nodes = [(multiStateNameToStateId[n], d['physId'], n) for n, d in network.nodes_iter(data=True)]
+        network_io.writeStates(outfile, *zip(*nodes) if nodes else ([], [], []))
         outfile.write("*links {}\n".format(numLinks))
-        for src, tgt, weight in network.edges_iter(data='weight'):
-            outfile.write("{} {} {}\n".format(multiStateNameToStateId[src], multiStateNameToStateId[tgt], weight))
+        links = [(multiStateNameToStateId[src], multiStateNameToStateId[tgt], weight) for src, tgt, weight in network.edges_iter(data='weight')]
+        network_io.writeLinks(outfile, *zip(*links) if links else ([], [], []))
     print("Done!")
 
 
 
-def run(inFilenames, outFilename, relaxRate):
-    t0, t1 = time.clock(), time.time()
+def getSweepFilename(outFilename, relaxRate):
+    """ Output filename for one relax rate of many, e.g. data/net.net -> data/net_r0.15.net """
+    name, dot, extension = outFilename.rpartition('.')
+    if not dot or '/' in extension:
+        return "{}_r{}".format(outFilename, relaxRate)
+    return "{}_r{}.{}".format(name, relaxRate, extension)
+
+def getWindowFilename(outFilename, first, last):
+    """ Output filename for one window of layers of many, with the 1-based
+    first and last layer, e.g. data/net.net -> data/net_w1-8.net """
+    name, dot, extension = outFilename.rpartition('.')
+    if not dot or '/' in extension:
+        return "{}_w{}-{}".format(outFilename, first, last)
+    return "{}_w{}-{}.{}".format(name, first, last, extension)
+
+def getWindows(numLayers, window=None):
+    """ (start, end) of each window of window consecutive layers, or of all layers """
+    if not window or window >= numLayers:
+        return [(0, numLayers)]
+    return [(start, start + window) for start in range(numLayers - window + 1)]
+
+def getFileKey(filename):
+    """ Key of an input file in a layer store, its path, size and modification time """
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+def loadLayerStore(storeFilename):
+    """ Return the StateLayers of a layer store by file key, with their state
+    names added to the shared state index, which must be empty """
+    try:
+        with np.load(storeFilename) as data:
+            arrays = dict(data)
+    except (OSError, ValueError):
+        return {}
+    names = arrays['names'].tobytes().decode().split("\n") if len(arrays['names']) else []
+    stateNames.extend(names)
+    stateNameIndex.update(zip(names, range(len(names))))
+    stored = {}
+    for i, key in enumerate(json.loads(str(arrays['files']))):
+        stored[tuple(key)] = StateLayer(*[arrays["{}_{}".format(field, i)] for field in StateLayer._fields])
+    print("Loaded {} stored layers with {} state names from {}".format(len(stored), len(names), storeFilename))
+    return stored
+
+def saveLayerStore(storeFilename, keys, storeLayers):
+    """ Save StateLayers with their file keys to a layer store, with only the
+    state names they use and the links sorted by source """
+    isUsed = np.zeros(len(stateNames), dtype=bool)
+    for layer in storeLayers:
+        isUsed[layer.nodes] = True
+    used = np.flatnonzero(isUsed)
+    stateIndex = np.full(len(stateNames), -1, dtype=np.int64)
+    stateIndex[used] = np.arange(len(used))
+    arrays = {
+        'names': np.frombuffer("\n".join([stateNames[state] for state in used.tolist()]).encode(), dtype=np.uint8),
+        'files': np.array(json.dumps(keys)),
+    }
+    for i, layer in enumerate(storeLayers):
+        order = np.argsort(layer.sources, kind='stable')
+        arrays.update({
+            'nodes_{}'.format(i): stateIndex[layer.nodes],
+            'physIds_{}'.format(i): layer.physIds,
+            'sources_{}'.format(i): stateIndex[layer.sources[order]],
+            'targets_{}'.format(i): stateIndex[layer.targets[order]],
+            'weights_{}'.format(i): layer.weights[order],
+        })
+    print("Saving {} layers with {} state names to {}...".format(len(storeLayers), len(used), storeFilename))
+    tmpFilename = storeFilename + ".tmp.npz"
+    np.savez(tmpFilename, **arrays)
+    os.replace(tmpFilename, storeFilename)
+
+def addLayers(inFilenames, keys, stored, networks):
+    """ Add a StateLayer to layers for each input file, from stored by file key
+    or else from the next parsed network in networks """
+    for inFilename, key in zip(inFilenames, keys):
+        with metrics.stage("parse", filename=inFilename) as stage:
+            if key in stored:
+                print("Using stored states of {}".format(inFilename))
+                layers.append(stored[key])
+            else:
+                print("Collecting states from {}...".format(inFilename))
+                addStateLayer(next(networks))
+            stage.rows = len(layers[-1].weights)
+
+def parseLayers(inFilenames, workers=1, storeFilename=None):
+    """ Parse the input files to layers for the sparse engine, in a pool of
+    workers if more than one. With a layer store, only the files that are
+    new or changed since they were stored are parsed, and the store is
+    updated to hold the layers of exactly the input files """
+    stored = loadLayerStore(storeFilename) if storeFilename else {}
+    keys = [getFileKey(inFilename) for inFilename in inFilenames]
+    missing = [inFilename for inFilename, key in zip(inFilenames, keys) if key not in stored]
+    if workers > 1 and len(missing) > 1:
+        with Pool(workers) as pool:
+            addLayers(inFilenames, keys, stored, pool.imap(readStates, missing))
+    else:
+        addLayers(inFilenames, keys, stored, map(readStates, missing))
+    if storeFilename and list(stored) != keys:
+        with metrics.stage("store", filename=storeFilename):
+            saveLayerStore(storeFilename, keys, layers)
+
+def writeNetwork(network, outFilenames, relaxRates, workers=1, matrix=False):
+    """ Write a SparseMultilayerNetwork for each relax rate, generating the
+    links in a pool of workers if more than one """
+    if workers > 1:
+        blocks, specs = shareArrays(network.getArrays())
+        try:
+            with metrics.stage("write", workers=workers), Pool(workers, initializer=attachNetwork, initargs=(specs,)) as pool:
+                network.write(outFilenames, relaxRates, pool=pool)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    else:
+        with metrics.stage("write", relaxRates=relaxRates):
+            network.write(outFilenames, relaxRates)
+    if matrix:
+        with metrics.stage("matrix"):
+            network.writeMatrix([network_io.getMatrixFilename(outFilename) for outFilename in outFilenames], relaxRates)
+
+def run(inFilenames, outFilename, relaxRates, engine='sparse', workers=1, matrix=False, storeFilename=None, window=None):
+    """ Write the multilayer network for each relax rate in relaxRates,
+    to outFilename if only one and else to the getSweepFilename of each,
+    and with matrix also as a sparse matrix to the getMatrixFilename of each.
+    With window, one network is written per window of that many consecutive
+    layers, to the getWindowFilename of outFilename """
+    if isinstance(relaxRates, float):
+        relaxRates = [relaxRates]
+    def getOutFilenames(outFilename):
+        return [outFilename] if len(relaxRates) == 1 else [getSweepFilename(outFilename, relaxRate) for relaxRate in relaxRates]
+    if engine == 'sparse':
+        parseLayers(inFilenames, workers, storeFilename)
+        windows = getWindows(len(layers), window)
+        for start, end in windows:
+            windowFilename = outFilename if len(windows) == 1 else getWindowFilename(outFilename, start + 1, end)
+            if workers > 1:
+                print("Generate multilayer network from {} state networks with {} workers...".format(end - start, workers))
+            else:
+                print("Generate multilayer network from {} state networks...".format(end - start))
+            with metrics.stage("generate", layers=end - start):
+                network = SparseMultilayerNetwork(layers[start:end], len(stateNames))
+            writeNetwork(network, getOutFilenames(windowFilename), relaxRates, workers, matrix)
+        return
+
+    if nx is None:
+        sys.exit("The networkx engine requires networkx")
+    if matrix or storeFilename or window:
+        sys.exit("Sparse matrices, layer stores and windows require the sparse engine")
     for inFilename in inFilenames:
         print("Collecting states from {}...".format(inFilename))
-        parseStates(inFilename)
-    
-    network = generateMultilayerNetwork(relaxRate)
+        with metrics.stage("parse", filename=inFilename) as stage:
+            parseStates(inFilename)
+            stage.rows = graphs[-1].number_of_edges()
 
-    writeMultilayerStateNetwork(network, outFilename)
+    for outFilename, relaxRate in zip(getOutFilenames(outFilename), relaxRates):
+        print("Relax rate {}:".format(relaxRate))
+        with metrics.stage("generate", relaxRate=relaxRate):
+            network = generateMultilayerNetwork(relaxRate)
+        with metrics.stage("write", filename=outFilename, rows=network.number_of_edges()):
+            writeMultilayerStateNetwork(network, outFilename)
 
 
 def main(argv):
     parser = argparse.ArgumentParser(description='Join states to multilayer states')
     parser.add_argument('input', nargs='+', help='input states files')
     parser.add_argument('output', help='output filename')
-    parser.add_argument('-r', '--relax-rate', type=float, default=0.15, help='Multilayer relax rate')
+    parser.add_argument('-r', '--relax-rate', type=float, nargs='+', default=[0.15], help='Multilayer relax rate, give many to write one network per rate from one parse (default: 0.15)')
+    parser.add_argument('-e', '--engine', choices=['sparse', 'networkx'], default='sparse', help='Engine to generate the network with, sparse matrices per layer or networkx graphs (default: sparse)')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='Number of worker processes for the sparse engine (default: 1)')
+    parser.add_argument('--matrix', action='store_true', help='Also write each network as a sparse matrix with the physical node of each state to a .npz file, with the sparse engine')
+    parser.add_argument('--store', help='Layer store file to reuse the parsed layers of unchanged input files from, updated to the layers of the input files, with the sparse engine')
+    parser.add_argument('-w', '--window', type=int, help='Write a network for each window of this many consecutive input layers, with the sparse engine')
+    metrics.addArguments(parser)
     
     args = parser.parse_args()
-    t0, t1 = time.clock(), time.time()
+    metrics.configure(args)
     print("==== Starting ====")
     print("  input: {}".format(args.input))
     print("  output: {}".format(args.output))
     print("  relax-rate: {}".format(args.relax_rate))
+    print("  engine: {}".format(args.engine))
+    print("  workers: {}".format(args.workers))
+    print("  store: {}".format(args.store))
+    print("  window: {}".format(args.window))
 
-    run(args.input, args.output, args.relax_rate)
+    run(args.input, args.output, args.relax_rate, args.engine, args.workers, args.matrix, args.store, args.window)
 
     print("Done!")
-    print("Max memory usage: {} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6))
-    print("Clock time:       {}".format(time.clock() - t0))
-    print("Wall time:        {}".format(time.time() - t1))
-    print("User mode time:   {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_utime))
-    print("System time:      {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_stime))
+    metrics.printSummary()
 
 
 if __name__ == "__main__":
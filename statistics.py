@@ -1,66 +1,195 @@
+""" Module statistics of Infomap cluster files
+
+Cluster files with lines 'node module flow' are parsed to arrays, and the
+number of modules, entropy and perplexity of the module flow and module
+assignments per physical node are computed with array operations. Given
+many files, directories or globs, the files are parsed in parallel and the
+statistics written to one table, optionally comparing each run to the first
+or previous run by the mutual information and Rand index of the module with
+most flow of each physical node in both runs.
+"""
+
 import argparse
+import csv
+import glob
 import math
+import os
 import sys
-# import csv, json
-import resource, time
-# from time import gmtime, strftime
-from collections import Counter, defaultdict
+import time
+from collections import namedtuple
+from multiprocessing import Pool
+import numpy as np
+
+import network_io
+
+Clusters = namedtuple('Clusters', ['nodes', 'modules', 'flows'])
+
+COLUMNS = ['file', 'numNodes', 'numModules', 'entropy', 'perplexity', 'numModuleAssignments', 'maxModuleAssignments',
+    'compareTo', 'numCommonNodes', 'nmi', 'ari']
 
 def entropy(P):
-    H = 0.0
-    for p in P:
-        if p > 0 and p < 1:
-            H -= p * math.log2(p)
-    # return -sum(0 if p is 0 else p * math.log2(p) for p in P)
-    return H
+    """ Entropy in bits of the probabilities P, ignoring 0 and 1 """
+    P = np.asarray(P, dtype=np.float64)
+    P = P[(P > 0) & (P < 1)]
+    return float(-np.sum(P * np.log2(P)))
 
-def run(filename):
-    nodesPerModule = defaultdict(list)
-    modulesPerNode = defaultdict(list)
-
-    with open(filename, 'r') as infile:
-        for line in infile:
-            if line[0] == '#':
-                continue
-            row = line.split()
-            node = int(row[0])
-            module = int(row[1])
-            flow = float(row[2])
-            nodesPerModule[module].append((node, flow))
-            modulesPerNode[node].append(module)
-    
-    moduleFlow = []
-    numModules = len(nodesPerModule)
-    numPhysicalNodes = len(modulesPerNode)
-    for module, nodes in nodesPerModule.items():
-        moduleFlow.append(sum(n[1] for n in nodes))
+def readClusters(filename):
+    """ Parse a cluster file with lines 'node module flow', possibly with more columns, to Clusters """
+    with open(filename, mode='r') as infile:
+        text = infile.read()
+    if '#' in text:
+        text = "".join(line for line in text.splitlines(keepends=True) if line[0] != '#')
+    firstLine = text.lstrip().split("\n", maxsplit=1)[0]
+    numColumns = len(firstLine.split())
+    if numColumns == 0:
+        return Clusters(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0))
+    if numColumns < 3:
+        sys.exit("Expected lines 'node module flow' in {}".format(filename))
+    values = network_io.parseNumbers(text, filename)
+    if len(values) % numColumns != 0:
+        sys.exit("Not the same number of columns on each line in {}".format(filename))
+    values = values.reshape(-1, numColumns)
+    return Clusters(values[:, 0].astype(np.int64), values[:, 1].astype(np.int64), values[:, 2].astype(np.float64))
+
+def getClusterStatistics(clusters):
+    """ Return the number of physical nodes and modules, module flow entropy and perplexity
+    and the average and max number of modules per physical node """
+    numRows = len(clusters.nodes)
+    if numRows == 0:
+        return {'numNodes': 0, 'numModules': 0, 'entropy': 0.0, 'perplexity': 1.0, 'numModuleAssignments': 0, 'maxModuleAssignments': 0}
+    _, moduleIndex = np.unique(clusters.modules, return_inverse=True)
+    moduleFlow = np.bincount(moduleIndex.ravel(), weights=clusters.flows)
     H = entropy(moduleFlow)
-    numModuleAssignments = 0
-    for node, modules in modulesPerNode.items():
-        numModuleAssignments += len(modules)
-    numModuleAssignments /= numPhysicalNodes
-    print("numModules:", numModules, "entropy:", H, "perplexity:", math.pow(2, H),
-        "numModuleAssignments:", numModuleAssignments)
+    _, modulesPerNode = np.unique(clusters.nodes, return_counts=True)
+    return {
+        'numNodes': len(modulesPerNode),
+        'numModules': len(moduleFlow),
+        'entropy': H,
+        'perplexity': math.pow(2, H),
+        'numModuleAssignments': numRows / len(modulesPerNode),
+        'maxModuleAssignments': int(modulesPerNode.max()),
+    }
 
+def getStatistics(filename):
+    """ Return the number of modules, module flow entropy and perplexity and the
+    average number of modules per node of a cluster file """
+    return getClusterStatistics(readClusters(filename))
 
+def getTopModules(clusters):
+    """ Return (sorted physical nodes, module with most flow of each node) """
+    order = np.lexsort((-clusters.flows, clusters.nodes))
+    nodes = clusters.nodes[order]
+    isFirst = np.ones(len(nodes), dtype=bool)
+    isFirst[1:] = nodes[1:] != nodes[:-1]
+    return nodes[isFirst], clusters.modules[order][isFirst]
 
-def main(argv):
-    # print('\n==== Starting ==== \n')
-    # t0, t1 = time.clock(), time.time()
+def comparePartitions(nodes1, modules1, nodes2, modules2):
+    """ Normalized mutual information and adjusted Rand index of two partitions
+    of the physical nodes, on the nodes in both """
+    common, index1, index2 = np.intersect1d(nodes1, nodes2, assume_unique=True, return_indices=True)
+    n = len(common)
+    result = {'numCommonNodes': n, 'nmi': None, 'ari': None}
+    if n == 0:
+        return result
+    _, labels1 = np.unique(modules1[index1], return_inverse=True)
+    _, labels2 = np.unique(modules2[index2], return_inverse=True)
+    labels1, labels2 = labels1.ravel(), labels2.ravel()
+    # Contingency table of the non-zero module pairs
+    numLabels2 = labels2.max() + 1
+    pairs, pairCounts = np.unique(labels1 * numLabels2 + labels2, return_counts=True)
+    counts1 = np.bincount(labels1).astype(np.float64)
+    counts2 = np.bincount(labels2).astype(np.float64)
+    p = pairCounts / n
+    p1 = counts1[pairs // numLabels2] / n
+    p2 = counts2[pairs % numLabels2] / n
+    mutualInformation = float(np.sum(p * np.log2(p / (p1 * p2))))
+    H1, H2 = entropy(counts1 / n), entropy(counts2 / n)
+    result['nmi'] = 2 * mutualInformation / (H1 + H2) if H1 + H2 > 0 else 1.0
+    # Number of node pairs together in both, in the first and in the second partition
+    index = np.sum(pairCounts * (pairCounts - 1)) / 2
+    sum1 = np.sum(counts1 * (counts1 - 1)) / 2
+    sum2 = np.sum(counts2 * (counts2 - 1)) / 2
+    expected = sum1 * sum2 / (n * (n - 1) / 2) if n > 1 else 0.0
+    maxIndex = (sum1 + sum2) / 2
+    result['ari'] = float((index - expected) / (maxIndex - expected)) if maxIndex != expected else 1.0
+    return result
 
-    parser = argparse.ArgumentParser(description='Calculate cluster statistics.')
-    # parser.add_argument('-i', '--input', nargs=1, type=argparse.FileType('r'), required=True)
-    parser.add_argument('input', help='input cluster file')
+def findFiles(inputs):
+    """ Cluster files in inputs of files, directories searched recursively for .clu files, and globs """
+    filenames = []
+    for name in inputs:
+        if os.path.isdir(name):
+            filenames += sorted(glob.glob(os.path.join(name, "**", "*.clu"), recursive=True))
+        elif os.path.exists(name):
+            filenames.append(name)
+        else:
+            matches = sorted(glob.glob(name, recursive=True))
+            if not matches:
+                sys.exit("No files matching {}".format(name))
+            filenames += matches
+    return filenames
 
-    args = parser.parse_args()
-    run(args.input)
+def readFileStatistics(filename):
+    """ Worker, returns (statistics, top modules) of a cluster file """
+    try:
+        clusters = readClusters(filename)
+    except SystemExit as err:
+        # Exit would leave the pool waiting for the result
+        raise ValueError(err.code)
+    return dict(getClusterStatistics(clusters), file=filename), getTopModules(clusters)
+
+def writeTable(rows, outfile):
+    writer = csv.DictWriter(outfile, delimiter='\t', fieldnames=COLUMNS, lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
+
+def runBatch(filenames, outFilename, workers=1, compare=None):
+    t1 = time.time()
+    print("Parse {} cluster files with {} workers...".format(len(filenames), workers), file=sys.stderr)
+    rows = []
+    first = previous = None
+    with Pool(workers) as pool:
+        results = pool.imap(readFileStatistics, filenames, chunksize=max(1, len(filenames) // (workers * 4)))
+        try:
+            for row, topModules in results:
+                reference = first if compare == 'first' else previous
+                if compare and reference is not None:
+                    row['compareTo'] = reference[0]
+                    row.update(comparePartitions(*reference[1], *topModules))
+                if first is None:
+                    first = (row['file'], topModules)
+                previous = (row['file'], topModules)
+                rows.append(row)
+                if len(rows) % 1000 == 0:
+                    print("Processed {} files...".format(len(rows)), file=sys.stderr)
+        except ValueError as err:
+            sys.exit(str(err))
+    if outFilename:
+        with open(outFilename, mode='w') as outfile:
+            writeTable(rows, outfile)
+    else:
+        writeTable(rows, sys.stdout)
+    print("Done {} files in {} seconds!".format(len(rows), time.time() - t1), file=sys.stderr)
+
+def run(filename):
+    stats = getStatistics(filename)
+    print("numModules:", stats['numModules'], "entropy:", stats['entropy'], "perplexity:", stats['perplexity'],
+        "numModuleAssignments:", stats['numModuleAssignments'])
 
 
-    # print("Max memory usage: {} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6))
-    # print("Clock time:       {}".format(time.clock() - t0))
-    # print("Wall time:        {}".format(time.time() - t1))
-    # print("User mode time:   {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_utime))
-    # print("System time:      {}".format(resource.getrusage(resource.RUSAGE_SELF).ru_stime))
+def main(argv):
+    parser = argparse.ArgumentParser(description='Calculate cluster statistics.')
+    parser.add_argument('input', nargs='+', help='input cluster files, directories with .clu files or globs like "data/infomap/**/*.clu"')
+    parser.add_argument('-o', '--output', help='Write a table of the statistics of all files to this tab separated file (default: stdout)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='Number of processes parsing files (default: number of cpus)')
+    parser.add_argument('-c', '--compare', choices=['first', 'previous'], help='Compare the modules of the physical nodes of each file to the first or previous file')
+
+    args = parser.parse_args()
+    filenames = findFiles(args.input)
+    if len(filenames) == 1 and not args.output and not args.compare:
+        run(filenames[0])
+    else:
+        runBatch(filenames, args.output, args.workers, args.compare)
 
 if __name__ == "__main__":
-   main(sys.argv[1:])
\ No newline at end of file
+   main(sys.argv[1:])
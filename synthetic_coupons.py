@@ -0,0 +1,158 @@
+""" Deterministic synthetic DB1B coupon files
+
+Itineraries get the number of coupons from the frequencies in
+DB1B_COUPON 2017 Q1 (see README.md), and most itineraries with an even
+number of coupons are round trips. Airports are drawn with a Zipf-like
+popularity, and connections go through a small set of hubs. Like in the
+real data, where popular itineraries are flown by many passengers, each
+itinerary is drawn with a Zipf popularity from a catalog of routes shared
+by all quarters, so most paths repeat and pass the count threshold of
+paths_to_states.py. The same seed, year, quarter and number of rows
+always give the same file.
+"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+import network_io
+
+# Number of itineraries with 1, 2, ... coupons in DB1B_COUPON 2017 Q1
+COUPON_FREQUENCIES = [534072, 1717666, 285497, 904186, 60448, 32452, 3203, 958, 213, 84, 21, 9, 1, 1]
+NUM_AIRPORTS = 400
+NUM_HUBS = 30
+HUB_PROBABILITY = 0.7
+ROUND_TRIP_PROBABILITY = 0.9
+CHUNK_ITINERARIES = 250000
+# Number of distinct itineraries and the Zipf exponent of their popularity
+NUM_ROUTES = 50000
+ROUTE_EXPONENT = 1.0
+
+HEADER = "ItinID,MktID,SeqNum,Coupons,Year,OriginAirportID,Quarter,DestAirportID\n"
+
+def getAirports(seed):
+    """ Return (airport ids, popularity) with the most popular first """
+    rng = np.random.default_rng([seed, 0])
+    airports = 10000 + np.sort(rng.choice(6000, NUM_AIRPORTS, replace=False))
+    rng.shuffle(airports)
+    popularity = 1 / np.arange(1, NUM_AIRPORTS + 1)
+    return airports, popularity / popularity.sum()
+
+def generateItineraries(rng, numItineraries, popularity):
+    """ Return (nodes, lengths, isRoundTrip) where nodes are airport indices
+    of all itineraries after each other, with lengths + 1 nodes each """
+    frequencies = np.array(COUPON_FREQUENCIES, dtype=np.float64)
+    lengths = rng.choice(np.arange(1, len(frequencies) + 1), numItineraries, p=frequencies / frequencies.sum())
+    isRoundTrip = (lengths % 2 == 0) & (rng.random(numItineraries) < ROUND_TRIP_PROBABILITY)
+    starts = np.zeros(numItineraries + 1, dtype=np.int64)
+    np.cumsum(lengths + 1, out=starts[1:])
+    numNodes = starts[-1]
+    first = starts[:-1]
+    last = starts[1:] - 1
+    isInterior = np.ones(numNodes, dtype=bool)
+    isInterior[first] = False
+    isInterior[last] = False
+    # Destination of a round trip at the middle node
+    isInterior[(first + lengths // 2)[isRoundTrip]] = False
+
+    def sample(positions):
+        hubs = rng.integers(NUM_HUBS, size=len(positions))
+        airports = rng.choice(NUM_AIRPORTS, len(positions), p=popularity)
+        return np.where(isInterior[positions] & (rng.random(len(positions)) < HUB_PROBABILITY), hubs, airports)
+
+    nodes = sample(np.arange(numNodes))
+    nodes[last[isRoundTrip]] = nodes[first[isRoundTrip]]
+    isFixed = np.zeros(numNodes, dtype=bool)
+    isFixed[last[isRoundTrip]] = True
+    isFixed[first] = True
+    isStart = np.zeros(numNodes, dtype=bool)
+    isStart[first] = True
+    # No coupon from an airport to itself, draw the non fixed node of such coupons again
+    while True:
+        bad = np.flatnonzero((nodes[1:] == nodes[:-1]) & ~isStart[1:]) + 1
+        if len(bad) == 0:
+            break
+        bad = np.where(isFixed[bad], bad - 1, bad)
+        nodes[bad] = sample(bad)
+    return nodes, lengths, isRoundTrip
+
+def getRoutes(seed, popularity):
+    """ Return (nodes, offsets, lengths, isRoundTrip, route popularity) of the
+    catalog of routes, with the nodes of route i in nodes[offsets[i]:offsets[i + 1]] """
+    rng = np.random.default_rng([seed, 1])
+    nodes, lengths, isRoundTrip = generateItineraries(rng, NUM_ROUTES, popularity)
+    offsets = np.zeros(NUM_ROUTES + 1, dtype=np.int64)
+    np.cumsum(lengths + 1, out=offsets[1:])
+    routePopularity = 1 / np.arange(1, NUM_ROUTES + 1) ** ROUTE_EXPONENT
+    return nodes, offsets, lengths, isRoundTrip, routePopularity / routePopularity.sum()
+
+def drawItineraries(rng, numItineraries, routes):
+    """ Return (nodes, lengths, isRoundTrip) like generateItineraries, of
+    itineraries drawn from the catalog of routes by their popularity """
+    routeNodes, routeOffsets, routeLengths, routeIsRoundTrip, routePopularity = routes
+    index = rng.choice(len(routeLengths), numItineraries, p=routePopularity)
+    numNodes = routeLengths[index] + 1
+    starts = np.repeat(routeOffsets[index] - (np.cumsum(numNodes) - numNodes), numNodes)
+    return routeNodes[starts + np.arange(int(numNodes.sum()))], routeLengths[index], routeIsRoundTrip[index]
+
+def writeCoupons(outfile, rng, year, quarter, itinStart, numItineraries, airports, routes):
+    """ Write coupon rows of numItineraries itineraries, returns the number of rows """
+    nodes, lengths, isRoundTrip = drawItineraries(rng, numItineraries, routes)
+    numRows = int(lengths.sum())
+    itinerary = np.repeat(np.arange(numItineraries), lengths)
+    starts = np.zeros(numItineraries, dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    seqNums = np.arange(numRows) - starts[itinerary] + 1
+    # Node of each coupon origin, the destination is the next node
+    origins = np.arange(numRows) + itinerary
+    itinIds = itinStart + itinerary
+    # Second market of a round trip starts after the middle node
+    markets = (isRoundTrip[itinerary] & (seqNums > lengths[itinerary] // 2)).astype(np.int64)
+    network_io.writeRows(outfile, "%s,%s,%s,%s,%s,%s,%s,%s\n", [itinIds, itinIds * 10 + markets, seqNums,
+        lengths[itinerary], np.full(numRows, year), airports[nodes[origins]], np.full(numRows, quarter),
+        airports[nodes[origins + 1]]])
+    return numRows
+
+def generate(filename, year, quarter, numRows, seed=0):
+    """ Write a coupon csv file with about numRows rows """
+    print("Generate about {} coupon rows to {}...".format(numRows, filename))
+    airports, popularity = getAirports(seed)
+    routes = getRoutes(seed, popularity)
+    rng = np.random.default_rng([seed, year, quarter])
+    meanLength = np.dot(np.arange(1, len(COUPON_FREQUENCIES) + 1), COUPON_FREQUENCIES) / sum(COUPON_FREQUENCIES)
+    numItineraries = max(1, int(round(numRows / meanLength)))
+    itinStart = (year * 10 + quarter) * 10**9
+    rowsWritten = 0
+    with open(filename, mode='w') as outfile:
+        outfile.write(HEADER)
+        for chunkStart in range(0, numItineraries, CHUNK_ITINERARIES):
+            chunkSize = min(CHUNK_ITINERARIES, numItineraries - chunkStart)
+            rowsWritten += writeCoupons(outfile, rng, year, quarter, itinStart + chunkStart, chunkSize, airports, routes)
+            print("Processed {} rows...".format(rowsWritten))
+    print("Done writing {} rows in {} itineraries!".format(rowsWritten, numItineraries))
+    return rowsWritten
+
+
+def run(outDir, years, quarters, numRows, seed=0):
+    t1 = time.time()
+    os.makedirs(outDir, exist_ok=True)
+    for year in years:
+        for quarter in quarters:
+            generate(os.path.join(outDir, "{}_{}_Coupon.csv".format(year, quarter)), year, quarter, numRows, seed)
+    print("Done in {} seconds!".format(time.time() - t1))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate synthetic coupon csv files.')
+    parser.add_argument('-y', '--years', nargs='+', type=int, default=[2011], help='years (default: 2011)')
+    parser.add_argument('-q', '--quarters', nargs='+', type=int, default=[1,2,3,4], help='quarters (default: 1 2 3 4)')
+    parser.add_argument('-n', '--rows', type=int, default=100000, help='Approximate number of coupon rows per file (default: 100000)')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('-o', '--output-dir', default='data', help='Directory to write {year}_{quarter}_Coupon.csv files to (default: data)')
+
+    args = parser.parse_args()
+    run(args.output_dir, args.years, args.quarters, args.rows, args.seed)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,41 @@
+""" Load coupon csv files to a store """
+
+import pytest
+
+import coupon_store
+
+HEADER = "ItinID,MktID,SeqNum,Coupons,Year,OriginAirportID,Quarter,DestAirportID\n"
+
+def writeCoupons(tmp_path, name, rows):
+    filename = str(tmp_path / name)
+    with open(filename, mode='w') as outfile:
+        outfile.write(HEADER)
+        for itinId, seqNum, year, quarter, origin, dest in rows:
+            outfile.write("{},{},{},2,{},{},{},{}\n".format(itinId, itinId * 10, seqNum, year, origin, quarter, dest))
+    return filename
+
+def test_load_same_quarter_from_two_files(tmp_path):
+    dbFilename = str(tmp_path / "coupons.db")
+    first = writeCoupons(tmp_path, "2011_1_Coupon.csv", [(1, 1, 2011, 1, 10, 11), (1, 2, 2011, 1, 11, 12)])
+    copy = writeCoupons(tmp_path, "copy_Coupon.csv", [(2, 1, 2011, 2, 10, 11), (1, 1, 2011, 1, 10, 11), (1, 2, 2011, 1, 11, 12)])
+    coupon_store.run(dbFilename, [first])
+    with pytest.raises(SystemExit, match="2011 Q1 .* already loaded from .*2011_1_Coupon.csv"):
+        coupon_store.run(dbFilename, [copy], batchSize=1)
+    store = coupon_store.CouponStore(dbFilename)
+    assert store.summary() == [(2011, 1, 2)]
+    assert [row[0] for row in store.connection.execute("SELECT Path FROM files")] == [first]
+    assert list(store.queryCoupons([2011], [1])) == [(1, 10, 1, 10, 11), (1, 10, 2, 11, 12)]
+    store.close()
+
+def test_reload_changed_file(tmp_path):
+    dbFilename = str(tmp_path / "coupons.db")
+    filename = writeCoupons(tmp_path, "2011_1_Coupon.csv", [(1, 1, 2011, 1, 10, 11)])
+    coupon_store.run(dbFilename, [filename])
+    filename = writeCoupons(tmp_path, "2011_1_Coupon.csv", [(1, 1, 2011, 1, 10, 11), (2, 1, 2011, 1, 12, 13)])
+    coupon_store.run(dbFilename, [filename])
+    store = coupon_store.CouponStore(dbFilename)
+    assert store.summary() == [(2011, 1, 2)]
+    # The rows of a changed file are removed with the index on FileID
+    plan = store.connection.execute("EXPLAIN QUERY PLAN DELETE FROM coupons WHERE FileID = 1").fetchall()
+    assert "coupons_file" in " ".join(str(row[-1]) for row in plan)
+    store.close()
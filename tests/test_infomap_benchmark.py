@@ -0,0 +1,85 @@
+""" Run infomap_benchmark with a stub Infomap executable """
+
+import csv
+import os
+import stat
+import sys
+
+import infomap_benchmark
+
+# Prints Infomap-like output and writes a .clu file with one module per link
+# of the network, so each row can be checked against its own network
+STUB = """#!{python}
+import os, sys, time
+network, outDir = sys.argv[1], sys.argv[2]
+if "--sleep" in sys.argv:
+    time.sleep(60)
+with open(network) as infile:
+    numLinks = len(infile.read().split("*Links", 1)[1].split()) // 3
+name = os.path.basename(network).rsplit(".", 1)[0]
+print("Per level codelength total: [1.0, {{0}}.5] (sum: {{1}}.5)".format(numLinks, numLinks + 1))
+print("Found 3 levels with codelength {{}}.5".format(numLinks + 1))
+print("Elapsed time: 0d 0h 1m {{}}.25s".format(numLinks))
+with open(os.path.join(outDir, name + ".clu"), "w") as outfile:
+    outfile.write("# node module flow\\n")
+    for i in range(numLinks):
+        outfile.write("{{}} {{}} {{}}\\n".format(i + 1, i + 1, 1.0 / numLinks))
+"""
+
+def writeNetwork(filename, numLinks):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, mode='w') as outfile:
+        outfile.write("*Vertices 2\n1 \"a\"\n2 \"b\"\n*States\n1 1 \"a\"\n2 2 \"b\"\n*Links\n")
+        for i in range(numLinks):
+            outfile.write("{} {} 1\n".format(i % 2 + 1, (i + 1) % 2 + 1))
+    return filename
+
+def writeStub(tmp_path):
+    filename = str(tmp_path / "Infomap")
+    with open(filename, mode='w') as outfile:
+        outfile.write(STUB.format(python=sys.executable))
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR)
+    return filename
+
+def readResults(filename):
+    with open(filename, mode='r') as infile:
+        return list(csv.DictReader(infile, delimiter='\t'))
+
+def test_run(tmp_path):
+    # Same filename in two directories
+    networks = [writeNetwork(str(tmp_path / "a" / "2011_12_34_states_2_r0.25.net"), 3),
+        writeNetwork(str(tmp_path / "b" / "2011_12_34_states_2_r0.25.net"), 5),
+        writeNetwork(str(tmp_path / "2011_1234_states_1.net"), 4)]
+    outFilename = str(tmp_path / "results.tsv")
+    assert infomap_benchmark.run(networks, ["-i states"], writeStub(tmp_path), str(tmp_path / "out"), outFilename, workers=3)
+    results = readResults(outFilename)
+    assert [row["Network"] for row in results] == networks
+    for row, numLinks in zip(results, [3, 5, 4]):
+        assert row["Status"] == "ok"
+        assert float(row["Codelength"]) == numLinks + 1.5
+        assert int(row["Levels"]) == 3
+        assert float(row["Seconds"]) == 60 + numLinks + 0.25
+        assert int(row["Modules"]) == numLinks
+        assert int(row["Links"]) == numLinks
+        assert int(row["State nodes"]) == 2
+    assert [row["Relax rate"] for row in results] == ["0.25", "0.25", ""]
+    assert [row["Quarters"] for row in results] == ["1+2,3+4", "1+2,3+4", "1+2+3+4"]
+    assert set(os.listdir(str(tmp_path / "out"))) == {"2011_12_34_states_2_r0.25_n1", "2011_12_34_states_2_r0.25_n2", "2011_1234_states_1"}
+
+def test_run_timeout(tmp_path):
+    networks = [writeNetwork(str(tmp_path / "2011_1_2_states_2_r15.net"), 2)]
+    outFilename = str(tmp_path / "results.tsv")
+    assert not infomap_benchmark.run(networks, ["--sleep", "-i states", "-i states -N2"], writeStub(tmp_path),
+        str(tmp_path / "out"), outFilename, workers=1, timeout=1)
+    results = readResults(outFilename)
+    assert [row["Status"] for row in results] == ["timeout", "ok", "ok"]
+    assert results[0]["Codelength"] == "" and float(results[0]["Wall seconds"]) < 30
+    assert [row["Codelength"] for row in results[1:]] == ["3.5", "3.5"]
+    # Relax rate in percent in older filenames
+    assert all(row["Relax rate"] == "0.15" for row in results)
+
+def test_network_info():
+    assert infomap_benchmark.getNetworkInfo("data/2011_1_2_3_4_states_2_r0.15.net")["Relax rate"] == 0.15
+    assert infomap_benchmark.getNetworkInfo("data/2011_1_2_3_4_states_2_r25.net")["Relax rate"] == 0.25
+    assert infomap_benchmark.getNetworkInfo("data/2011_1234_states_1.net")["Relax rate"] == ""
+    assert infomap_benchmark.getNetworkInfo("data/network.net") == {}
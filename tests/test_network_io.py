@@ -0,0 +1,189 @@
+""" Compare network_io with the line by line readers and writers it replaced """
+
+import io
+
+import numpy as np
+import pytest
+
+import network_io
+
+STATES = """# A states network
+*Vertices 3
+1 "10001"
+2 "10002"
+3 "10003"
+*states 4
+# stateId physId "name"
+0 10002 "10001 10002"
+1 10003 "10002 10003"
+2 10001 "10003 10001"
+7 10003 "10001 10003"
+*links 6
+# source target weight
+0 1 3
+1 2 1.5
+2 0 0.1
+7 2 2
+0 7 12345678901
+2 7 0.30000000000000004
+"""
+
+def readStatesByLine(filename):
+    """ readStatesArrays from states_to_multilayer_states.py before network_io,
+    returns (names, stateIds, physIds, links) """
+    names = []
+    stateIds = []
+    physIds = []
+    links = []
+    with open(filename, mode='r') as infile:
+        for line in infile:
+            if line.startswith("*states"):
+                break
+        for line in infile:
+            if line[0] == '#':
+                continue
+            if line.startswith("*links"):
+                break
+            stateId, physId, name = line.split(' ', 2)
+            name = name.rstrip()
+            names.append(name[1:-1])
+            stateIds.append(int(stateId))
+            physIds.append(int(physId))
+        lines = [line for line in infile.readlines() if line[0] != '#']
+        if lines:
+            links.append(np.array(" ".join(lines).split(), dtype=np.float64).reshape(-1, 3))
+    links = np.concatenate(links) if links else np.empty((0, 3))
+    return names, np.array(stateIds, dtype=np.int64), np.array(physIds, dtype=np.int64), links
+
+def writeStatesByLine(outfile, stateIds, physIds, names):
+    outfile.writelines(["{} {} \"{}\"\n".format(*state) for state in zip(stateIds, physIds, names)])
+
+def writeLinksByLine(outfile, sources, targets, weights):
+    outfile.writelines(["{} {} {}\n".format(*link) for link in zip(sources, targets, weights)])
+
+def writeFile(tmp_path, text, name="network.net"):
+    filename = str(tmp_path / name)
+    with open(filename, mode='w') as outfile:
+        outfile.write(text)
+    return filename
+
+def assertSameNetwork(network, filename):
+    names, stateIds, physIds, links = readStatesByLine(filename)
+    assert network.names == names
+    assert np.array_equal(network.stateIds, stateIds)
+    assert np.array_equal(network.physIds, physIds)
+    assert np.array_equal(network.sources, links[:, 0].astype(np.int64))
+    assert np.array_equal(network.targets, links[:, 1].astype(np.int64))
+    assert np.array_equal(network.weights, links[:, 2])
+    assert network.weights.dtype == np.float64
+
+def test_read_states(tmp_path):
+    filename = writeFile(tmp_path, STATES)
+    network = network_io.readStates(filename)
+    assertSameNetwork(network, filename)
+    # *Vertices is not read as states
+    assert network.names == ["10001 10002", "10002 10003", "10003 10001", "10001 10003"]
+
+def test_read_states_without_trailing_newline(tmp_path):
+    filename = writeFile(tmp_path, STATES.rstrip("\n"))
+    assertSameNetwork(network_io.readStates(filename), filename)
+    statesOnly = STATES[:STATES.index("*links")].rstrip("\n")
+    filename = writeFile(tmp_path, statesOnly, "states.net")
+    network = network_io.readStates(filename)
+    assertSameNetwork(network, filename)
+    assert len(network.names) == 4 and len(network.weights) == 0
+
+def test_read_capitalized_sections(tmp_path):
+    # Infomap headers are case insensitive, the line reader only knew lower case
+    filename = writeFile(tmp_path, STATES.replace("*states", "*States").replace("*links", "*Links"), "capitalized.net")
+    network = network_io.readStates(filename)
+    assertSameNetwork(network, writeFile(tmp_path, STATES))
+
+@pytest.mark.parametrize("text", [
+    "*states 0\n*links 0\n",
+    "*states 0\n*links 0",
+    "*states\n# no states\n*links\n",
+    "",
+])
+def test_read_empty_sections(tmp_path, text):
+    filename = writeFile(tmp_path, text)
+    network = network_io.readStates(filename)
+    assertSameNetwork(network, filename)
+    assert network.stateIds.dtype == np.int64 and network.sources.dtype == np.int64
+
+def test_section_reader_blocks():
+    # Blocks of a few characters still end at whole lines and at the next section
+    reader = network_io.SectionReader(io.StringIO(STATES), blockSize=7)
+    sections = []
+    section = reader.nextSection()
+    while section is not None:
+        sections.append((section.split()[0], "".join(reader.blocks())))
+        section = reader.nextSection()
+    assert [name for name, _ in sections] == ["*vertices", "*states", "*links"]
+    assert sections[1][1] == '0 10002 "10001 10002"\n1 10003 "10002 10003"\n2 10001 "10003 10001"\n7 10003 "10001 10003"\n'
+    assert sections[2][1].count("\n") == 6
+
+def test_parse_state_lines():
+    block = '0 10002 "10001 10002"\n12 10003 "a "\n'
+    stateIds, physIds, names = network_io.parseStateLines(block)
+    assert stateIds.tolist() == [0, 12] and physIds.tolist() == [10002, 10003]
+    assert names == ["10001 10002", "a "]
+    with pytest.raises(SystemExit):
+        network_io.parseStateLines('0 10002 10001\n')
+
+@pytest.mark.parametrize("batchSize", [1, 2, 100000])
+def test_write_states_and_links(tmp_path, batchSize):
+    _, stateIds, physIds, links = readStatesByLine(writeFile(tmp_path, STATES))
+    names = ["10001 10002", "10002 10003", "10003 10001", "10001 10003"]
+    sources, targets, weights = links[:, 0].astype(np.int64), links[:, 1].astype(np.int64), links[:, 2]
+    expected, actual = io.StringIO(), io.StringIO()
+    writeStatesByLine(expected, stateIds.tolist(), physIds.tolist(), names)
+    writeLinksByLine(expected, sources.tolist(), targets.tolist(), weights.tolist())
+    network_io.writeStates(actual, stateIds, physIds, names, batchSize)
+    network_io.writeLinks(actual, sources, targets, weights, batchSize)
+    assert actual.getvalue() == expected.getvalue()
+
+def test_write_rows_of_lists_and_arrays():
+    columns = [range(3), np.array([1, 2, 3], dtype=np.int64), ["a", "b c", ""], np.array([1.0, 0.1, 1e-20])]
+    expected = "".join("{} {} \"{}\" {}\n".format(*row) for row in zip(range(3), [1, 2, 3], ["a", "b c", ""], [1.0, 0.1, 1e-20]))
+    assert network_io.formatRows("%s %s \"%s\" %s\n", columns) == expected
+    outfile = io.StringIO()
+    network_io.writeRows(outfile, "%s %s \"%s\" %s\n", columns, batchSize=2)
+    assert outfile.getvalue() == expected
+    assert network_io.formatRows("%s %s\n", [[], []]) == ""
+
+def test_sparse_states_round_trip(tmp_path):
+    filename = writeFile(tmp_path, STATES.replace("7 ", "3 "))
+    network = network_io.readStates(filename)
+    matrixFilename = network_io.getMatrixFilename(filename)
+    assert matrixFilename == str(tmp_path / "network.npz")
+    network_io.writeSparseStates(matrixFilename, network.physIds, network.sources, network.targets, network.weights)
+    sparse = network_io.readSparseStates(matrixFilename)
+    assert np.array_equal(sparse.stateIds, network.stateIds)
+    assert np.array_equal(sparse.physIds, network.physIds)
+    # Links ordered by source, in their order in the file within each source
+    order = np.argsort(network.sources, kind='stable')
+    assert np.array_equal(sparse.sources, network.sources[order])
+    assert np.array_equal(sparse.targets, network.targets[order])
+    assert np.array_equal(sparse.weights, network.weights[order])
+
+def test_sparse_states_empty(tmp_path):
+    matrixFilename = str(tmp_path / "empty.npz")
+    network_io.writeSparseStates(matrixFilename, [], np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), [])
+    sparse = network_io.readSparseStates(matrixFilename)
+    assert len(sparse.physIds) == 0 and len(sparse.weights) == 0
+
+def test_sparse_states_scipy(tmp_path):
+    sparseModule = pytest.importorskip("scipy.sparse")
+    filename = writeFile(tmp_path, STATES.replace("7 ", "3 "))
+    network = network_io.readStates(filename)
+    matrixFilename = network_io.getMatrixFilename(filename)
+    network_io.writeSparseStates(matrixFilename, network.physIds, network.sources, network.targets, network.weights)
+    matrix = sparseModule.load_npz(matrixFilename)
+    expected = np.zeros((4, 4))
+    np.add.at(expected, (network.sources, network.targets), network.weights)
+    assert np.array_equal(matrix.toarray(), expected)
+
+def test_matrix_filename():
+    assert network_io.getMatrixFilename("data/2011_1_states_2.net") == "data/2011_1_states_2.npz"
+    assert network_io.getMatrixFilename("data.dir/network") == "data.dir/network.npz"
@@ -0,0 +1,64 @@
+""" Run pipeline.py on synthetic coupons with concurrent tasks """
+
+import filecmp
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+
+from conftest import REPO_DIR
+import binary_paths
+
+SPEC = {
+    'years': [2011],
+    'quarters': [1, 2, 3, 4],
+    'orders': [1, 2],
+    # Overlapping groups count the same quarters at once and share the states cache
+    'layers': ["3", "34", "1234", "12,34", "1,2,3,4"],
+    'relaxRates': [0.15, 0.25],
+    'countThreshold': 1,
+}
+
+STALE_AIRPORT = "99999"
+
+def runScript(workDir, script, *args):
+    return subprocess.run([sys.executable, os.path.join(REPO_DIR, script)] + list(args), cwd=workDir,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+def runPipeline(workDir, workers):
+    os.makedirs(os.path.join(workDir, "data"))
+    result = runScript(workDir, "synthetic_coupons.py", "-n", "5000")
+    assert result.returncode == 0, result.stdout
+    # A stale paths file of the other format must not be read
+    binary_paths.writeBinaryPaths(os.path.join(workDir, "data", "2011_3_Coupon_paths.bin"), binary_paths.BinaryPaths(
+        [STALE_AIRPORT, "10000", "10001", "10002"], np.array([0, 1, 2, 3], dtype=np.int32), np.array([0, 4]), np.array([100])))
+    with open(os.path.join(workDir, "spec.json"), mode='w') as outfile:
+        json.dump(SPEC, outfile)
+    return runScript(workDir, "pipeline.py", "spec.json", "-j", str(workers))
+
+def getNetworks(workDir):
+    dataDir = os.path.join(workDir, "data")
+    return sorted(name for name in os.listdir(dataDir) if name.endswith(".net") and "_states_" in name)
+
+def test_concurrent_run_matches_serial_run(tmp_path):
+    serialDir, concurrentDir = str(tmp_path / "serial"), str(tmp_path / "concurrent")
+    serial = runPipeline(serialDir, 1)
+    assert serial.returncode == 0, serial.stdout
+    concurrent = runPipeline(concurrentDir, 4)
+    assert concurrent.returncode == 0, concurrent.stdout
+    assert "Failed" not in concurrent.stdout
+
+    networks = getNetworks(serialDir)
+    assert "2011_12_34_states_2_r0.25.net" in networks
+    assert "2011_1_2_3_4_states_1_r0.15.net" in networks
+    assert networks == getNetworks(concurrentDir)
+    _, mismatch, errors = filecmp.cmpfiles(os.path.join(serialDir, "data"), os.path.join(concurrentDir, "data"), networks, shallow=False)
+    assert mismatch == [] and errors == []
+
+    with open(os.path.join(concurrentDir, "data", "2011_3_states_1.net"), mode='r') as infile:
+        assert STALE_AIRPORT not in infile.read()
+
+    rerun = runScript(concurrentDir, "pipeline.py", "spec.json", "-j", "4", "-n")
+    assert rerun.returncode == 0, rerun.stdout
+    assert " run:" not in rerun.stdout
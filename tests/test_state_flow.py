@@ -0,0 +1,38 @@
+""" Stationary flow of state networks """
+
+import numpy as np
+import pytest
+
+import state_flow
+
+# Links 0 -> 1 -> 2 -> 0 and 1 -> 3, with state 3 dangling
+SOURCES = np.array([0, 1, 2, 1], dtype=np.int64)
+TARGETS = np.array([1, 2, 0, 3], dtype=np.int64)
+WEIGHTS = np.array([1.0, 2.0, 1.0, 1.0])
+
+@pytest.mark.parametrize("recordedTeleportation", [False, True])
+@pytest.mark.parametrize("toLinks", [False, True])
+def test_zero_weight_links(recordedTeleportation, toLinks):
+    # State 3 only has links of weight 0, it is still dangling
+    sources = np.append(SOURCES, [3, 3])
+    targets = np.append(TARGETS, [0, 2])
+    weights = np.append(WEIGHTS, [0.0, 0.0])
+    flow = state_flow.getFlow(4, sources, targets, weights, recordedTeleportation=recordedTeleportation, toLinks=toLinks)
+    expected = state_flow.getFlow(4, SOURCES, TARGETS, WEIGHTS, recordedTeleportation=recordedTeleportation, toLinks=toLinks)
+    assert not np.isnan(flow.nodeFlow).any()
+    assert np.allclose(flow.nodeFlow, expected.nodeFlow, rtol=0, atol=1e-12)
+    assert flow.nodeFlow.sum() == pytest.approx(1.0)
+
+def test_directed_flow():
+    flow = state_flow.getFlow(4, SOURCES, TARGETS, WEIGHTS, alpha=0.15, recordedTeleportation=True)
+    # Stationary distribution of the transition matrix with teleportation
+    transition = np.zeros((4, 4))
+    np.add.at(transition, (SOURCES, TARGETS), WEIGHTS)
+    transition[3] = 0.25
+    transition /= transition.sum(axis=1, keepdims=True)
+    isDangling = np.array([False, False, False, True])
+    google = np.where(isDangling[:, None], 0.25, 0.85 * transition + 0.15 / 4)
+    values, vectors = np.linalg.eig(google.T)
+    expected = np.real(vectors[:, np.argmax(np.real(values))])
+    assert np.allclose(flow.nodeFlow, expected / expected.sum(), rtol=0, atol=1e-10)
+    assert flow.error <= 1e-15